@@ -0,0 +1,173 @@
+import os
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+MIDI_NAME = 'music.mid'
+XML_NAME = 'sheet.xml'
+
+
+def atomic_write(path, data):
+  '''Write bytes to a temp file next to path and rename it over path'''
+  directory = os.path.dirname(path) or '.'
+  os.makedirs(directory, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      f.write(data)
+    os.replace(tmp_path, path)
+  except BaseException:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+    raise
+
+
+class Artifact:
+  def __init__(self, data, path=None):
+    self.data = data
+    self.path = path
+    self.sha256 = hashlib.sha256(data).hexdigest()
+    self.size = len(data)
+
+
+class Generation:
+  def __init__(self, gen_id, source=None):
+    self.id = gen_id
+    self.source = source  # what the artifacts are rendered from
+    self.artifacts = {}
+    self.rendering = {}  # name: Future of the render in flight
+    self.created = time.time()
+    self.size = 0
+
+
+class ArtifactStore:
+  '''
+  The rendered files of every generation, in memory and keyed by generation id,
+  so concurrent generations never overwrite each other. Each artifact records
+  its sha256 and size. Artifacts can also be rendered on first request from
+  the source of the generation (get_or_render) and are then kept like the
+  others. Generations older than ttl seconds, or the least recently used ones
+  past max_bytes in total, are evicted. With persist the files are also
+  written (atomically) under root/<generation id>/.
+  '''
+
+  def __init__(self, root='app/generations', max_bytes=256 * 2 ** 20, ttl=3600, persist=False):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.persist = persist
+    self.generations = OrderedDict()  # least recently used first
+    self.latest = None
+    self._lock = threading.Lock()
+    # stats
+    self.renders = 0
+    self.render_hits = 0
+    self.render_waits = 0
+
+  def new_id(self):
+    return uuid.uuid4().hex
+
+  def _add(self, generation, name, data):
+    path = None
+    if self.persist:
+      path = os.path.join(self.root, generation.id, name)
+      atomic_write(path, data)
+    artifact = generation.artifacts[name] = Artifact(data, path)
+    generation.size += len(data)
+    return artifact
+
+  def put(self, gen_id, files=None, source=None):
+    '''
+    @param files: {name: bytes} of the generation, e.g. {MIDI_NAME: ..., XML_NAME: ...}
+    @param source: what get_or_render renders the missing artifacts from
+    '''
+    generation = Generation(gen_id, source)
+    for name, data in (files or {}).items():
+      if data is not None:
+        self._add(generation, name, data)
+    with self._lock:
+      self.generations[gen_id] = generation
+      self.latest = gen_id
+      self._evict()
+    return generation
+
+  def get(self, gen_id, name):
+    with self._lock:
+      self._evict()
+      generation = self.generations.get(gen_id)
+      if generation is None or name not in generation.artifacts:
+        return None
+      self.generations.move_to_end(gen_id)
+      return generation.artifacts[name]
+
+  def get_or_render(self, gen_id, name, render):
+    '''
+    The artifact, rendered with render(source) on the first request for it.
+    Requests that arrive while it renders wait for that render instead of
+    starting another one. None if the generation is unknown (or evicted).
+    '''
+    with self._lock:
+      self._evict()
+      generation = self.generations.get(gen_id)
+      if generation is None:
+        return None
+      self.generations.move_to_end(gen_id)
+      if name in generation.artifacts:
+        self.render_hits += 1
+        return generation.artifacts[name]
+      pending = generation.rendering.get(name)
+      owner = pending is None
+      if owner:
+        pending = generation.rendering[name] = Future()
+        self.renders += 1
+      else:
+        self.render_waits += 1
+    if not owner:
+      return pending.result()
+
+    try:
+      data = render(generation.source)
+      with self._lock:
+        artifact = self._add(generation, name, data) if data is not None else None
+        generation.rendering.pop(name, None)
+        self._evict()
+    except BaseException as e:
+      with self._lock:
+        generation.rendering.pop(name, None)  # a later request renders again
+      pending.set_exception(e)
+      raise
+    pending.set_result(artifact)
+    return artifact
+
+  def _evict(self):
+    now = time.time()
+    total = sum(g.size for g in self.generations.values())
+    for gen_id in list(self.generations):
+      generation = self.generations[gen_id]
+      if now - generation.created <= self.ttl and total <= self.max_bytes:
+        continue
+      total -= generation.size
+      del self.generations[gen_id]
+      if self.latest == gen_id:
+        self.latest = None
+      if self.persist:
+        shutil.rmtree(os.path.join(self.root, gen_id), ignore_errors=True)
+
+  def status(self):
+    with self._lock:
+      return {'generations': len(self.generations),
+              'bytes': sum(g.size for g in self.generations.values()),
+              'max_bytes': self.max_bytes, 'ttl': self.ttl, 'persist': self.persist,
+              'renders': self.renders, 'render_hits': self.render_hits, 'render_waits': self.render_waits}
+
+
+def store_from_env():
+  return ArtifactStore(root=os.environ.get('SITHSYNTH_STORE_DIR', 'app/generations'),
+                       max_bytes=int(float(os.environ.get('SITHSYNTH_STORE_MAX_MB', 256)) * 2 ** 20),
+                       ttl=float(os.environ.get('SITHSYNTH_STORE_TTL', 3600)),
+                       persist=os.environ.get('SITHSYNTH_STORE_PERSIST', '0') == '1')
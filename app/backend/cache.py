@@ -0,0 +1,125 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+
+SOURCE_NAME = 'source.json'
+
+
+def cache_key(params, seed, version):
+  '''sha256 of what a seeded lead sheet is a function of'''
+  payload = json.dumps([list(params), seed, version], sort_keys=True)
+  return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+  '''
+  Seeded generations on disk under root/<key>/, content addressed by
+  cache_key: the decoded tokens (source.json) and the rendered files. A hit
+  returns them without decoding or rendering again. The least recently used
+  entries are removed once all of them exceed max_bytes. Entries are written
+  into a temp dir and renamed into place, so readers never see partial ones.
+  root is only read on first use and created by the first put.
+  '''
+
+  def __init__(self, root='app/cache', max_bytes=64 * 2 ** 20):
+    self.root = root
+    self.max_bytes = max_bytes
+    self.entries = OrderedDict()  # key: size, least recently used first
+    self._lock = threading.Lock()
+    # stats
+    self.hits = 0
+    self.misses = 0
+    self._scanned = False
+
+  def _scan(self):
+    # with the lock held: the entries already on disk, once
+    if self._scanned:
+      return
+    self._scanned = True
+    if not os.path.isdir(self.root):
+      return
+    found = []
+    for key in os.listdir(self.root):
+      path = os.path.join(self.root, key)
+      if key.startswith('.tmp-') or not os.path.isfile(os.path.join(path, SOURCE_NAME)):
+        shutil.rmtree(path, ignore_errors=True)  # left over from an interrupted put
+        continue
+      found.append((os.path.getmtime(path), key, self._size(path)))
+    for _, key, size in sorted(found):
+      self.entries[key] = size
+
+  @staticmethod
+  def _size(path):
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+  def get(self, key):
+    '''
+    @return: (source, {name: bytes}) of the entry or None
+    '''
+    with self._lock:
+      self._scan()
+      if key not in self.entries:
+        self.misses += 1
+        return None
+      self.entries.move_to_end(key)
+      self.hits += 1
+      path = os.path.join(self.root, key)
+      with open(os.path.join(path, SOURCE_NAME), 'r') as f:
+        source = tuple(json.load(f))
+      files = {}
+      for name in os.listdir(path):
+        if name != SOURCE_NAME:
+          with open(os.path.join(path, name), 'rb') as f:
+            files[name] = f.read()
+      os.utime(path)
+    return source, files
+
+  def put(self, key, source, files):
+    with self._lock:
+      self._scan()  # before the first temp dir, which the scan would remove
+    os.makedirs(self.root, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(dir=self.root, prefix='.tmp-')
+    try:
+      with open(os.path.join(tmp_path, SOURCE_NAME), 'w') as f:
+        json.dump(list(source), f)
+      for name, data in files.items():
+        if data is not None:
+          with open(os.path.join(tmp_path, name), 'wb') as f:
+            f.write(data)
+      size = self._size(tmp_path)
+      with self._lock:
+        path = os.path.join(self.root, key)
+        if key in self.entries:  # the same result, put by a concurrent request
+          shutil.rmtree(tmp_path)
+          return
+        os.replace(tmp_path, path)
+        self.entries[key] = size
+        self._evict()
+    except BaseException:
+      shutil.rmtree(tmp_path, ignore_errors=True)
+      raise
+
+  def _evict(self):
+    total = sum(self.entries.values())
+    while total > self.max_bytes and self.entries:
+      key, size = self.entries.popitem(last=False)
+      total -= size
+      shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+
+  def status(self):
+    with self._lock:
+      self._scan()
+      return {'entries': len(self.entries), 'bytes': sum(self.entries.values()),
+              'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+def cache_from_env():
+  '''The result cache of seeded generations, unless SITHSYNTH_CACHE_MAX_MB is 0'''
+  max_mb = float(os.environ.get('SITHSYNTH_CACHE_MAX_MB', 64))
+  if max_mb <= 0:
+    return None
+  return ResultCache(root=os.environ.get('SITHSYNTH_CACHE_DIR', 'app/cache'), max_bytes=int(max_mb * 2 ** 20))
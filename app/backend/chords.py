@@ -0,0 +1,97 @@
+from fractions import Fraction
+
+import music21 as m21
+
+from app.backend.decoding import is_chord_token
+
+
+def step_alter(pitch):
+  return pitch.step, int(pitch.alter)
+
+
+def xml_kind(kind):
+  '''The MusicXML name of a music21 chord kind ('dominant-seventh' -> 'dominant')'''
+  for alias, name in m21.harmony.CHORD_ALIASES.items():
+    if name == kind:
+      return alias
+  return kind
+
+
+class ChordEntry:
+  '''
+  What the renderers need of one chord symbol token: its MIDI pitches, pitch
+  names and common name (the piano part) and the MusicXML harmony fields
+  (root, kind, kind text, bass, degrees).
+  '''
+
+  def __init__(self, token):
+    symbol = m21.harmony.ChordSymbol(token)
+    chord = m21.chord.Chord([p for p in symbol.pitches])
+    self.token = token
+    self.name = chord.pitchedCommonName
+    root, bass = symbol.root(), symbol.bass()
+    self.root = step_alter(root)
+    self.bass = None if bass.name == root.name else step_alter(bass)
+    self.kind = xml_kind(symbol.chordKind)
+    self.kind_text = symbol.chordKindStr or None
+    # (degree-value, degree-alter, degree-type) of the added/altered degrees
+    self.degrees = tuple((d.degree, d.interval.chromatic.directed if d.interval is not None else None, d.modType)
+                         for d in symbol.getChordStepModifications())
+    # then, as the lead sheet streams did, the symbol is placed in a measure, which moves the root
+    # it shares with the chord up an octave when it is below C3 (Am: A2 -> A3)
+    symbol.writeAsChord = False
+    m21.stream.Measure().append(symbol)
+    self.pitches = tuple(p.midi for p in chord.pitches)
+    self.pitch_names = tuple(p.nameWithOctave for p in chord.pitches)
+
+
+class ChordTable:
+  '''
+  ChordEntry of every chord token of the decoder vocabulary, parsed once
+  instead of for every chord event of every rendering. Tokens outside of the
+  vocabulary are parsed on first use and kept.
+  '''
+
+  def __init__(self, tokens=()):
+    self.entries = {}
+    for token in tokens:
+      token = str(token)
+      if token != 'Rest' and is_chord_token(token):
+        self.entries[token] = ChordEntry(token)
+
+  def __getitem__(self, token):
+    entry = self.entries.get(token)
+    if entry is None:
+      entry = self.entries[token] = ChordEntry(token)
+    return entry
+
+  def __len__(self):
+    return len(self.entries)
+
+
+# used by the renderers when no table of the vocabulary is given
+default_chord_table = ChordTable()
+
+
+def chord_spans(f_chords, f_durs, f_bars, chords=None):
+  '''
+  The piano part of a lead sheet: [first event, bar, offset, duration, entry]
+  per sounding chord, identical consecutive chords of a bar merged into one
+  span. Offsets and durations are exact quarter lengths, entry is None for rests.
+  '''
+  table = default_chord_table if chords is None else chords
+  spans, name, bar = [], None, -1
+  offset = Fraction(0)
+  for i, (cho, dur) in enumerate(zip(f_chords, f_durs)):
+    dur = Fraction(dur)
+    entry = None if cho == 'Rest' else table[cho]
+    new_bar = f_bars[i] == 'bar'
+    bar += new_bar
+    event_name = 'Rest' if entry is None else entry.name
+    if spans and not new_bar and event_name == name:
+      spans[-1][3] += dur
+    else:
+      spans.append([i, bar, offset, dur, entry])
+      name = event_name
+    offset += dur
+  return spans
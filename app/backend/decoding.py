@@ -0,0 +1,546 @@
+import json
+import threading
+import numpy as np
+from fractions import Fraction
+
+
+def token_duration(token):
+  '''Exact duration of a duration token ('1.0', '0.25', '1/3') or None if it is not one'''
+  try:
+    if '/' in token:
+      nom, den = token.split('/')
+      return Fraction(int(nom), int(den))
+    if '.' in token:
+      return Fraction(token)
+  except (ValueError, ZeroDivisionError):
+    pass
+  return None
+
+
+def is_melody_token(token):
+  # midi pitches ('60') or 'Rest'
+  return token.isdigit() or token == 'Rest'
+
+
+def is_chord_token(token):
+  return token not in ('sos', 'eos', 'bar') and token_duration(token) is None and not token.isdigit()
+
+
+def fill_table(bar_lgt, durations):
+  '''Minimum number of events whose durations sum exactly to each amount <= bar_lgt'''
+  min_events = {Fraction(0): 0}
+  frontier = [Fraction(0)]
+  while frontier:
+    next_frontier = []
+    for amount in frontier:
+      for dur in durations:
+        new_amount = amount + dur
+        if new_amount <= bar_lgt and new_amount not in min_events:
+          min_events[new_amount] = min_events[amount] + 1
+          next_frontier.append(new_amount)
+    frontier = next_frontier
+  return min_events
+
+
+class DecoderGrammar:
+  '''
+  Decoding-time constraints over the decoder vocabulary (TransEncoders[1]).
+  A valid sequence is bar, then per bar (chord, melody, duration) events whose
+  durations fill the bar exactly followed by bar, numOfBars times, then eos.
+  Durations are only allowed when the rest of the bar can still be filled and
+  the whole piece still fits in dec_seq_length tokens, so every sequence
+  sampled under the mask passes validation_check.
+  '''
+
+  def __init__(self, dec_categories, timesig, numOfBars, dec_seq_length):
+    tokens = [str(t) for t in dec_categories]
+    self.vocab_size = len(tokens)
+    self.bar_idx = tokens.index('bar')
+    self.eos_idx = tokens.index('eos')
+    self.chord_mask = np.array([is_chord_token(t) for t in tokens])
+    self.melody_mask = np.array([is_melody_token(t) for t in tokens])
+    self.durations = {i: token_duration(t) for i, t in enumerate(tokens)
+                      if token_duration(t) is not None and token_duration(t) > 0}
+
+    timesig = json.loads(timesig)
+    self.bar_lgt = Fraction(4 * int(timesig[0]), int(timesig[1]))
+    self.numOfBars = numOfBars
+    self.dec_seq_length = dec_seq_length
+
+    self.min_events = fill_table(self.bar_lgt, set(self.durations.values()))
+    if self.bar_lgt not in self.min_events:
+      raise ValueError(f'No combination of duration tokens fills a {timesig[0]}/{timesig[1]} bar')
+    if 1 + self.tokens_to_finish(self.bar_lgt, 1) > dec_seq_length:
+      raise ValueError(f'{numOfBars} bars do not fit in {dec_seq_length} decoder tokens')
+
+    self.bar_only = self.single(self.bar_idx)
+    self.eos_only = self.single(self.eos_idx)
+
+  def single(self, idx):
+    mask = np.zeros(self.vocab_size, dtype=bool)
+    mask[idx] = True
+    return mask
+
+  def tokens_to_finish(self, remaining, bars):
+    '''Fewest tokens that complete the current bar (remaining), the bars left and eos'''
+    full_bar = 3 * self.min_events[self.bar_lgt] + 1
+    return 3 * self.min_events[remaining] + 1 + (self.numOfBars - bars) * full_bar + 1
+
+  def start(self):
+    return GrammarState(self)
+
+
+# the slots of GrammarState as the codes of the in-graph grammar, see grammar_tables
+SLOTS = ('bar', 'chord', 'melody', 'duration', 'eos')
+
+
+def grammar_tables(grammar, vocab_size):
+  '''
+  The DecoderGrammar as arrays, for the sampling loop of the LSTM decoder
+  (LSTMSampling) to mask the tokens in the graph:
+  slot_masks (len(SLOTS), vocab) the tokens allowed per slot but duration,
+  next_rest (rests, vocab) the index of the rest of the bar after a duration
+  token (-1 if not allowed), finish (rests,) the fewest tokens that fill each
+  rest, and params [numOfBars, tokens of a full bar, dec_seq_length, index of
+  a full bar, index of an empty one, constrained]. Without a grammar every
+  token is allowed.
+  '''
+  if grammar is None:
+    return (np.ones((len(SLOTS), vocab_size), dtype='float32'), np.zeros((1, vocab_size), dtype='int32'),
+            np.zeros(1, dtype='int32'), np.zeros(6, dtype='int32'))
+  rests = sorted(grammar.min_events)
+  index = {rest: i for i, rest in enumerate(rests)}
+  next_rest = np.full((len(rests), vocab_size), -1, dtype='int32')
+  for i, remaining in enumerate(rests):
+    for idx, dur in grammar.durations.items():
+      if remaining - dur in index:
+        next_rest[i, idx] = index[remaining - dur]
+  finish = np.array([3 * grammar.min_events[rest] for rest in rests], dtype='int32')
+  slot_masks = np.stack([grammar.bar_only, grammar.chord_mask, grammar.melody_mask,
+                         np.zeros(vocab_size, dtype=bool), grammar.eos_only]).astype('float32')
+  full_bar = 3 * grammar.min_events[grammar.bar_lgt] + 1
+  params = np.array([grammar.numOfBars, full_bar, grammar.dec_seq_length, index[grammar.bar_lgt],
+                     index[Fraction(0)], 1], dtype='int32')
+  return slot_masks, next_rest, finish, params
+
+
+class GrammarState:
+  '''Position of a single sequence inside the DecoderGrammar'''
+
+  def __init__(self, grammar):
+    self.grammar = grammar
+    self.length = 0  # tokens emitted so far
+    self.bars = 0  # bar tokens emitted so far
+    self.slot = 'bar'  # the kind of token that comes next
+    self.remaining = grammar.bar_lgt  # duration left in the current bar
+
+  def mask(self):
+    grammar = self.grammar
+    if self.slot == 'bar':
+      return grammar.bar_only
+    if self.slot == 'eos':
+      return grammar.eos_only
+    if self.slot == 'chord':
+      return grammar.chord_mask
+    if self.slot == 'melody':
+      return grammar.melody_mask
+    # duration: it has to leave a fillable rest of the bar within the length budget
+    allowed = np.zeros(grammar.vocab_size, dtype=bool)
+    for idx, dur in grammar.durations.items():
+      rest = self.remaining - dur
+      if rest in grammar.min_events and \
+          self.length + 1 + grammar.tokens_to_finish(rest, self.bars) <= grammar.dec_seq_length:
+        allowed[idx] = True
+    return allowed
+
+  def advance(self, token):
+    grammar = self.grammar
+    self.length += 1
+    if self.slot == 'bar':
+      self.bars += 1
+      self.remaining = grammar.bar_lgt
+      self.slot = 'eos' if self.bars == grammar.numOfBars + 1 else 'chord'
+    elif self.slot == 'chord':
+      self.slot = 'melody'
+    elif self.slot == 'melody':
+      self.slot = 'duration'
+    elif self.slot == 'duration':
+      self.remaining -= grammar.durations[token]
+      self.slot = 'bar' if self.remaining == 0 else 'chord'
+    else:
+      self.slot = 'done'
+
+
+def token_value(token):
+  '''The duration validation_check reads from a token, None if it cannot read one'''
+  try:
+    if '/' in token:
+      nom, den = token.split('/')
+      return Fraction(int(nom), int(den))
+    return Fraction(token)
+  except (ValueError, ZeroDivisionError, OverflowError):
+    return None
+
+
+class IncrementalValidator:
+  '''
+  The rules of validation_check applied token by token: numOfBars + 1 bar events,
+  aligned (chord, melody, duration) triplets between them and a total duration
+  of numOfBars bars of 4*n/d. It tells as soon as an attempt can no longer pass,
+  so the decoding loop can stop it instead of decoding up to dec_seq_length.
+  '''
+
+  def __init__(self, dec_categories, timesig, numOfBars):
+    tokens = [str(t) for t in dec_categories]
+    self.bar_idx = tokens.index('bar')
+    self.values = [token_value(t) for t in tokens]
+    self.numOfBars = numOfBars
+    timesig = json.loads(timesig)
+    self.total_dur = numOfBars * Fraction(4 * int(timesig[0]), int(timesig[1]))
+
+  def start(self):
+    return ValidatorState(self)
+
+
+class ValidatorState:
+  '''Bar count and running duration sum of a single attempt'''
+
+  def __init__(self, validator):
+    self.validator = validator
+    self.length = 0  # tokens pushed
+    self.bars = 0  # bar events so far
+    self.seg_len = 0  # tokens since the last bar event
+    self.dur_sum = Fraction(0)
+
+  def push(self, token):
+    '''@return: False once the attempt is doomed to fail validation_check'''
+    validator = self.validator
+    self.length += 1
+    if token == validator.bar_idx:
+      if self.bars > 0 and self.seg_len % 3 != 0:
+        return False  # chords, melody and durations would not have the same length
+      self.bars += 1
+      self.seg_len = 0
+      if self.bars > validator.numOfBars + 1:
+        return False
+      if self.bars == validator.numOfBars + 1 and self.dur_sum != validator.total_dur:
+        return False
+      return True
+    if self.bars == 0 or self.bars == validator.numOfBars + 1:
+      return True  # outside of the bars, convert_to_ChordDurMels ignores it
+    if self.seg_len % 3 == 2:  # duration slot
+      value = validator.values[token]
+      if value is None:
+        return False
+      self.dur_sum += value
+      if self.dur_sum > validator.total_dur:
+        return False
+    self.seg_len += 1
+    return True
+
+
+class AbortStats:
+  '''Process-wide counters of the attempts stopped early by the IncrementalValidator'''
+
+  def __init__(self):
+    self.attempts = 0
+    self.aborted = 0
+    self.tokens_decoded = 0
+    self.tokens_saved = 0  # upper bound: up to dec_seq_length per aborted attempt
+    self._lock = threading.Lock()
+
+  def record(self, length, dec_seq_length, aborted):
+    with self._lock:
+      self.attempts += 1
+      self.tokens_decoded += length
+      if aborted:
+        self.aborted += 1
+        self.tokens_saved += max(dec_seq_length - length, 0)
+
+  def snapshot(self):
+    with self._lock:
+      return {'attempts': self.attempts, 'aborted': self.aborted,
+              'tokens_decoded': self.tokens_decoded, 'tokens_saved': self.tokens_saved}
+
+
+abort_stats = AbortStats()
+
+
+class Candidate:
+  '''A single sequence decoded inside a batch, with its own grammar and validator state'''
+
+  def __init__(self, eos_idx, max_length, grammar=None, validator=None):
+    self.eos_idx = eos_idx
+    self.max_length = max_length
+    self.state = grammar.start() if grammar is not None else None
+    self.checker = validator.start() if validator is not None else None
+    self.tokens = []
+    self.done = False
+    self.aborted = False
+
+  def mask(self):
+    return self.state.mask() if self.state is not None else None
+
+  def push(self, token):
+    self.tokens.append(token)
+    if self.state is not None:
+      self.state.advance(token)
+    if self.checker is not None and not self.checker.push(token):
+      # doomed attempt, no need to decode the rest
+      self.aborted = True
+    self.done = self.aborted or token == self.eos_idx or len(self.tokens) >= self.max_length
+
+
+class TransformerRows:
+  '''
+  Per-row decoding state of the Transformer: encoder input, cross-attention
+  keys/values and the self-attention cache. Rows of different requests can be
+  merged, the caches are padded to the longest one and past_len marks the
+  valid part of each row.
+  '''
+
+  def __init__(self, enc_inp, cross, past, past_len):
+    self.enc_inp = enc_inp
+    self.cross = cross
+    self.past = past
+    self.past_len = past_len
+
+  def __len__(self):
+    return len(self.enc_inp)
+
+  def select(self, rows):
+    if len(rows) == len(self) and np.array_equal(rows, np.arange(len(self))):
+      return self  # every row continues, keep the (bucket sized) caches
+    past_len = self.past_len[rows]
+    max_len = int(past_len.max()) if len(past_len) else 0
+    return TransformerRows(self.enc_inp[rows], [c[rows] for c in self.cross],
+                           [p[rows][:, :, :max_len] for p in self.past], past_len)
+
+  def split(self, sizes):
+    offsets = np.cumsum([0] + list(sizes))
+    return [self.select(np.arange(offsets[i], offsets[i + 1])) for i in range(len(sizes))]
+
+  @staticmethod
+  def merge(parts):
+    if len(parts) == 1:
+      return parts[0]
+    max_len = max(part.past[0].shape[2] for part in parts)
+    past = []
+    for i in range(len(parts[0].past)):
+      padded = []
+      for part in parts:
+        p = part.past[i]
+        pad = max_len - p.shape[2]
+        padded.append(np.pad(p, ((0, 0), (0, 0), (0, pad), (0, 0))) if pad else p)
+      past.append(np.concatenate(padded, axis=0))
+    return TransformerRows(np.concatenate([part.enc_inp for part in parts], axis=0),
+                           [np.concatenate(cs, axis=0) for cs in zip(*[part.cross for part in parts])],
+                           past, np.concatenate([part.past_len for part in parts]))
+
+
+DEC_SEQ_LENGTH = 359  # the longest decoded sequence, so the longest self-attention cache
+DEC_BUCKETS = (16, 32, 64, 128, 256, DEC_SEQ_LENGTH)  # the self-attention cache lengths of the Transformer steps
+
+
+class ShapeBuckets:
+  '''
+  The few cache lengths the Transformer step runs with: a cache is padded (the
+  padding masked) to the shortest bucket that holds it, instead of growing by
+  one position every step. The buckets are warmed once at startup, a hit is a
+  step of a warmed (or already run) bucket and a miss the first run of one.
+  Caches longer than the last bucket are padded to a multiple of it, and
+  counted together as one overflow entry of the status.
+  '''
+
+  def __init__(self, lengths=DEC_BUCKETS):
+    self.lengths = tuple(sorted(lengths))
+    self.seen = set()
+    self._lock = threading.Lock()
+    # stats
+    self.hits = {}
+    self.misses = {}
+
+  def fit(self, length):
+    '''The bucket of a cache of length positions, counted as a hit or a miss'''
+    last = self.lengths[-1]
+    bucket = next((b for b in self.lengths if b >= length), -(-length // last) * last)
+    name = str(bucket) if bucket <= last else f'>{last}'
+    with self._lock:
+      counts = self.hits if bucket in self.seen else self.misses
+      counts[name] = counts.get(name, 0) + 1
+      self.seen.add(bucket)
+    return bucket
+
+  def covering(self, length):
+    '''Every bucket fit returns for the caches of up to length positions'''
+    last = self.lengths[-1]
+    return self.lengths + tuple(range(2 * last, -(-length // last) * last + 1, last))
+
+  def warmed(self, bucket):
+    with self._lock:
+      self.seen.add(bucket)
+
+  def status(self):
+    with self._lock:
+      names = [str(bucket) for bucket in self.lengths if bucket in self.seen or str(bucket) in self.misses]
+      names += [name for name in self.misses if name.startswith('>')]
+      return {name: {'hits': self.hits.get(name, 0), 'misses': self.misses.get(name, 0)} for name in names}
+
+
+def fit_cache(p, length):
+  '''A (rows, heads, positions, depth) cache padded or cut to length positions'''
+  if p.shape[2] < length:
+    return np.pad(p, ((0, 0), (0, 0), (0, length - p.shape[2]), (0, 0)))
+  return p[:, :, :length]
+
+
+class TransformerStepper:
+  '''
+  Batched incremental decoding with the Transformer prefill/step models. The
+  prefill (Encoder, cross-attention keys/values and the sos prediction) runs
+  once per request and is shared by all its rows. With buckets the caches are
+  kept at the bucket lengths, so the step model only sees a few shapes.
+  '''
+
+  def __init__(self, nnPrefill, nnStep, enc_inp, dec_sos_idx, buckets=None):
+    self.nnPrefill = nnPrefill
+    self.nnStep = nnStep
+    self.buckets = buckets
+    self.key = id(nnStep)  # rows of steppers with the same key can share a step
+    self.enc_inp = enc_inp
+    self.dec_sos_idx = dec_sos_idx
+    self.sos_pred = None
+
+  def prefill(self):
+    # lazily, so that it runs on the thread that decodes
+    prefill = self.nnPrefill.predict([self.enc_inp, np.array(self.dec_sos_idx).reshape(1, 1)])
+    num_cache = (len(prefill) - 1) // 2
+    self.sos_pred = prefill[0][:, -1, :]
+    self.sos_past = prefill[1:1 + num_cache]
+    self.cross = prefill[1 + num_cache:]
+
+  def start(self, n):
+    if self.sos_pred is None:
+      self.prefill()
+    rows = TransformerRows(np.repeat(self.enc_inp, n, axis=0), [np.repeat(c, n, axis=0) for c in self.cross],
+                           [np.repeat(p, n, axis=0) for p in self.sos_past], np.ones(n, dtype=int))
+    return np.repeat(self.sos_pred, n, axis=0), rows
+
+  def step(self, tokens, rows):
+    max_len = rows.past[0].shape[2]
+    if self.buckets is not None:
+      max_len = self.buckets.fit(int(rows.past_len.max()))
+    return self.decode(tokens, rows, max_len)
+
+  def warm(self):
+    '''Run the step once per bucket, so that the requests find them ready'''
+    _, rows = self.start(1)
+    for length in self.buckets.lengths:
+      self.decode([0], rows, length)
+      self.buckets.warmed(length)
+
+  def decode(self, tokens, rows, max_len):
+    n = len(tokens)
+    past = rows.past
+    if past[0].shape[2] != max_len:
+      past = [fit_cache(p, max_len) for p in past]
+    # zeros mark the padded cache positions (mask_zero of the decoder embedding)
+    past_tokens = (np.arange(max_len)[np.newaxis, :] < rows.past_len[:, np.newaxis]).astype('float32')
+    allPreds = self.nnStep.predict([np.array(tokens).reshape(n, 1) + 1, rows.past_len.reshape(n, 1),
+                                    rows.enc_inp, past_tokens] + past + rows.cross)
+    past = allPreds[1:]
+    # the new keys/values are appended after the padding, move them next to the valid part
+    for i in np.flatnonzero(rows.past_len < max_len):
+      for p in past:
+        p[i, :, rows.past_len[i]] = p[i, :, max_len]
+    rows = TransformerRows(rows.enc_inp, rows.cross, past, rows.past_len + 1)
+    if len(rows.past_len) and rows.past_len.max() <= max_len:
+      rows.past = [p[:, :, :max_len] for p in past]
+    return allPreds[0][:, -1, :], rows
+
+
+class LSTMRows:
+  '''Per-row decoding state of the LSTM: the (h, c) states of the 3 decoder layers'''
+
+  def __init__(self, states):
+    self.states = states
+
+  def __len__(self):
+    return len(self.states[0])
+
+  def select(self, rows):
+    return LSTMRows([s[rows] for s in self.states])
+
+  def split(self, sizes):
+    offsets = np.cumsum([0] + list(sizes))
+    return [self.select(np.arange(offsets[i], offsets[i + 1])) for i in range(len(sizes))]
+
+  @staticmethod
+  def merge(parts):
+    if len(parts) == 1:
+      return parts[0]
+    return LSTMRows([np.concatenate(ss, axis=0) for ss in zip(*[part.states for part in parts])])
+
+
+class LSTMStepper:
+  '''
+  Batched decoding with the LSTM encoder/decoder inference models. With a
+  sampler model (LSTMSampling) all the tokens of the rows can also be sampled
+  in one call, constrained or not, see sample.
+  '''
+
+  def __init__(self, nnEncoder, nnDecoder, enc_inp, dec_sos_idx, nnSampler=None):
+    self.nnEncoder = nnEncoder
+    self.nnDecoder = nnDecoder
+    self.nnSampler = nnSampler
+    self.key = id(nnDecoder)  # rows of steppers with the same key can share a step
+    self.enc_inp = enc_inp
+    self.dec_sos_idx = dec_sos_idx
+    self.enc_states = None
+
+  def encode(self, n):
+    if self.enc_states is None:
+      # the Encoder states are the same for every row and attempt
+      self.enc_states = self.nnEncoder.predict([self.enc_inp])
+    return [np.repeat(s, n, axis=0) for s in self.enc_states]
+
+  def start(self, n):
+    return self.decode(np.full((n, 1), self.dec_sos_idx), LSTMRows(self.encode(n)))
+
+  def sample(self, n, temperature, seed, grammar=None):
+    '''
+    @param seed: 2 integers, the sampled tokens only depend on them
+    @param grammar: optional DecoderGrammar, applied in the loop
+    @return: the tokens of n rows, each up to its eos
+    '''
+    # like the seed, the grammar tables are read from the first row
+    tables = grammar_tables(grammar, int(self.nnSampler.inputs[-4].shape[-1]))
+    tokens, lengths = self.nnSampler.predict([np.full((n, 1), self.dec_sos_idx)] + self.encode(n) +
+                                             [np.full((n, 1), temperature), np.tile(seed, (n, 1))] +
+                                             [np.repeat(table[np.newaxis], n, axis=0) for table in tables],
+                                             batch_size=n)
+    return [row[:length] for row, length in zip(tokens, lengths)]
+
+  def step(self, tokens, rows):
+    return self.decode(np.array(tokens).reshape(-1, 1) + 1, rows)
+
+  def decode(self, dec_inp, rows):
+    dec_out = self.nnDecoder.predict([dec_inp] + rows.states)
+    return dec_out[0].reshape(len(dec_inp), -1), LSTMRows(list(dec_out[1:]))
+
+
+def run_group_sampled(stepper, group):
+  '''Decode all the rows of a CandidateGroup with a single call of the in-graph sampling loop'''
+  seed = np.random.randint(2 ** 31, size=2) if group.rng is None else group.rng.integers(2 ** 31, size=2)
+  group.push_sequences(stepper.sample(group.num_candidates, group.temperature, seed, group.grammar))
+
+
+def run_group(stepper, group):
+  '''Decode the rows of a single CandidateGroup until it is finished'''
+  preds, rows = stepper.start(group.num_candidates)
+  while True:
+    keep = group.push(preds)
+    if group.finished:
+      return
+    rows = rows.select(keep)
+    preds, rows = stepper.step(group.last_tokens(), rows)
@@ -0,0 +1,93 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class QueueFull(Exception):
+  pass
+
+
+class Job:
+  def __init__(self, params):
+    self.id = uuid.uuid4().hex
+    self.params = params
+    self.status = 'queued'
+    self.result = None
+    self.error = None
+    self.created = time.time()
+    self.started = None
+    self.finished = None
+    self.future = None
+
+  def info(self):
+    info = {'job_id': self.id, 'status': self.status, 'created': self.created,
+            'started': self.started, 'finished': self.finished}
+    if self.error is not None:
+      info['error'] = str(self.error)
+    return info
+
+
+class JobManager:
+  '''
+  Runs generation jobs off the event loop in a bounded pool of worker threads.
+  At most max_queue jobs wait for a worker, further submissions raise
+  QueueFull. The last max_history finished jobs are kept for status/result.
+  '''
+
+  def __init__(self, work, workers=2, max_queue=16, max_history=1000):
+    self.work = work
+    self.workers = workers
+    self.max_queue = max_queue
+    self.max_history = max_history
+    self.jobs = OrderedDict()
+    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='generation')
+    self._lock = threading.Lock()
+
+  def submit(self, params):
+    with self._lock:
+      if self.count('queued') >= self.max_queue:
+        raise QueueFull(f'{self.max_queue} jobs are already queued')
+      job = Job(params)
+      self.jobs[job.id] = job
+      self._prune()
+      job.future = self._executor.submit(self._run, job)
+    return job
+
+  def _run(self, job):
+    job.status = 'running'
+    job.started = time.time()
+    try:
+      job.result = self.work(job.params)
+      job.status = 'done'
+    except Exception as e:
+      job.error = e
+      job.status = 'failed'
+    finally:
+      job.finished = time.time()
+    if job.error is not None:
+      raise job.error
+    return job.result
+
+  def _prune(self):
+    finished = [job_id for job_id, job in self.jobs.items() if job.status in ('done', 'failed')]
+    for job_id in finished[:max(len(finished) - self.max_history, 0)]:
+      del self.jobs[job_id]
+
+  def get(self, job_id):
+    return self.jobs.get(job_id)
+
+  def count(self, status):
+    return sum(1 for job in list(self.jobs.values()) if job.status == status)
+
+  def status(self):
+    return {'workers': self.workers, 'max_queue': self.max_queue,
+            'queued': self.count('queued'), 'running': self.count('running')}
+
+
+def job_manager_from_env(work, min_workers=0):
+  '''At least min_workers threads, so that every worker process can be kept busy'''
+  return JobManager(work, workers=max(int(os.environ.get('SITHSYNTH_JOB_WORKERS', 2)), min_workers),
+                    max_queue=int(os.environ.get('SITHSYNTH_JOB_QUEUE', 16)))
@@ -0,0 +1,235 @@
+import os
+import time
+import argparse
+import threading
+
+import numpy as np
+
+from app.backend.models import tf  # in graph mode, the converter runs on the session
+from app.backend.artifacts import atomic_write
+from app.backend.decoding import DEC_SEQ_LENGTH
+
+ENC_SEQ_LENGTH = 263  # the encoder input is always padded to it
+
+
+def fixed_shape_model(model, lengths, batch_size=None, unroll=False):
+  '''
+  The Keras model called on new inputs whose unknown dimensions (but the
+  batch) are set, per input, to lengths[i]. It shares the weights and the
+  graph with model. With unroll its recurrent layers are unrolled instead of
+  looping (TFLite cannot lower the loop of an unknown batch size).
+  '''
+  inputs = []
+  for tensor, length in zip(model.inputs, lengths):
+    shape = tuple(length if dim is None else dim for dim in tensor.shape.as_list()[1:])
+    inputs.append(tf.keras.layers.Input(shape=shape, batch_size=batch_size, dtype=tensor.dtype))
+  rnns = [layer for layer in model.submodules if isinstance(layer, tf.keras.layers.RNN)] if unroll else []
+  saved = [(layer.unroll, layer.__dict__.get('_could_use_gpu_kernel')) for layer in rnns]
+  for layer in rnns:
+    layer.unroll = True
+    if '_could_use_gpu_kernel' in layer.__dict__:
+      layer._could_use_gpu_kernel = False  # the fused kernel always loops
+  try:
+    return tf.keras.models.Model(inputs, model(inputs))
+  finally:
+    for layer, (unrolled, gpu_kernel) in zip(rnns, saved):
+      layer.unroll = unrolled
+      if gpu_kernel is not None:
+        layer._could_use_gpu_kernel = gpu_kernel
+
+
+def export_tflite(model, session=None, quantize=False):
+  '''
+  Converts a (fixed shape) Keras model of the graph/session to a TFLite
+  flatbuffer of builtin ops, which the interpreter runs with XNNPACK. With
+  quantize the weights are stored as int8 (dynamic range quantization).
+  '''
+  session = session or tf.compat.v1.keras.backend.get_session()
+  converter = tf.compat.v1.lite.TFLiteConverter.from_session(session, model.inputs, model.outputs)
+  if quantize:
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  return converter.convert()
+
+
+def fixed_inference_models(model, nnModel, cache_lengths=(DEC_SEQ_LENGTH,)):
+  '''
+  The inference models of generate_leadsheet to export, with fixed shapes:
+  the Transformer prefill and a step per cache length ({length: step}), and
+  the single step LSTM decoder with its (h, c) state inputs. The LSTM encoder
+  runs once per request and stays in Keras (TFLite cannot lower the loop over
+  its masked input), None here.
+  '''
+  if model == 'transformer':
+    prefill, step = nnModel[:2]
+    num_cache = (len(step.inputs) - 4) // 2
+    return (fixed_shape_model(prefill, [ENC_SEQ_LENGTH, 1]),
+            {length: fixed_shape_model(step, [1, 1, ENC_SEQ_LENGTH, length] +
+                                       [length] * num_cache + [ENC_SEQ_LENGTH] * num_cache)
+             for length in cache_lengths})
+  decoder = nnModel[1]
+  return None, fixed_shape_model(decoder, [1] * len(decoder.inputs), unroll=True)
+
+
+class LiteModel:
+  '''
+  predict() of a TFLite model like the Keras model it was exported from:
+  inputs and outputs in the same order. The batch is padded to a power of 2,
+  so the interpreter is only resized for a few batch sizes.
+  '''
+
+  def __init__(self, content, num_threads=None):
+    self.interpreter = tf.lite.Interpreter(model_content=content, num_threads=num_threads)
+    self.inputs = self.interpreter.get_input_details()
+    self.outputs = [d['index'] for d in self.interpreter.get_output_details()]
+    self.batch = None
+    self._lock = threading.Lock()  # an interpreter runs one call at a time
+
+  def predict(self, inputs):
+    n = len(inputs[0])
+    batch = 1 << (n - 1).bit_length()
+    with self._lock:
+      if batch != self.batch:
+        for detail in self.inputs:
+          self.interpreter.resize_tensor_input(detail['index'], [batch] + list(detail['shape_signature'][1:]))
+        self.interpreter.allocate_tensors()
+        self.batch = batch
+      for detail, x in zip(self.inputs, inputs):
+        x = np.asarray(x, dtype=detail['dtype'])
+        if batch > n:
+          x = np.concatenate([x, np.repeat(x[-1:], batch - n, axis=0)])
+        self.interpreter.set_tensor(detail['index'], x)
+      self.interpreter.invoke()
+      return [self.interpreter.get_tensor(index)[:n] for index in self.outputs]
+
+
+class LiteTransformerStep:
+  '''
+  The TFLite step models, one per cache length ({length: LiteModel}), behind
+  the growing caches of TransformerStepper: the caches are padded (and
+  masked) up to the shortest of these lengths and the new keys/values are
+  moved back after the ones of the call. With the same buckets as the
+  stepper no padding is left to do.
+  '''
+
+  def __init__(self, lites):
+    self.lites = dict(sorted(lites.items()))
+    self.num_cache = (len(next(iter(self.lites.values())).inputs) - 4) // 2
+
+  def predict(self, inputs):
+    past_tokens = inputs[3]
+    n, max_len = past_tokens.shape
+    cache_length = next((length for length in self.lites if length >= max_len), None)
+    if cache_length is None:
+      # the step models were exported for shorter caches: not an error of the request
+      raise RuntimeError(f'{max_len} cached tokens exceed the {max(self.lites)} of the TFLite step models')
+    lite = self.lites[cache_length]
+    if cache_length == max_len:
+      return lite.predict(inputs)
+    padded_tokens = np.zeros((n, cache_length), dtype='float32')
+    padded_tokens[:, :max_len] = past_tokens
+    past = []
+    for p in inputs[4:4 + self.num_cache]:
+      padded = np.zeros(p.shape[:2] + (cache_length,) + p.shape[3:], dtype='float32')
+      padded[:, :, :max_len] = p
+      past.append(padded)
+    outputs = lite.predict(list(inputs[:3]) + [padded_tokens] + past + list(inputs[4 + self.num_cache:]))
+    for p in outputs[1:]:
+      p[:, :, max_len] = p[:, :, cache_length]
+    return [outputs[0]] + [p[:, :, :max_len + 1] for p in outputs[1:]]
+
+
+def lite_inference_models(model, nnModel, quantize=False, cache_dir=None, version=None, session=None,
+                          num_threads=None, max_length=DEC_SEQ_LENGTH):
+  '''
+  The TFLite counterpart of the Keras inference models (nnModel) of a model,
+  same predict() interface so the steppers run either. The Transformer step
+  is exported for every bucket of nnModel (ShapeBuckets, if any) that a cache
+  of up to max_length positions is padded to, overflow buckets included. With
+  cache_dir and a version the flatbuffers are kept as
+  <model>-<part>-<version>[-int8].tflite and reused by later loads.
+  '''
+  buckets = nnModel[2] if model == 'transformer' and len(nnModel) > 2 else None
+  encoder, decoder = fixed_inference_models(model, nnModel,
+                                            buckets.covering(max_length) if buckets is not None else (max_length,))
+  parts = {'encoder': encoder}
+  if isinstance(decoder, dict):
+    parts.update({f'decoder{length}': fixed for length, fixed in decoder.items()})
+  else:
+    parts['decoder'] = decoder
+  lite = {}
+  for part, fixed in parts.items():
+    if fixed is None:
+      continue
+    path = None
+    if cache_dir is not None and version is not None:
+      path = os.path.join(cache_dir, f"{model}-{part}-{version[:12]}{'-int8' if quantize else ''}.tflite")
+    if path is not None and os.path.exists(path):
+      with open(path, 'rb') as f:
+        content = f.read()
+    else:
+      content = export_tflite(fixed, session, quantize)
+      if path is not None:
+        atomic_write(path, content)
+    lite[part] = LiteModel(content, num_threads)
+  if model == 'transformer':
+    step = LiteTransformerStep({length: lite[f'decoder{length}'] for length in decoder})
+    return (lite['encoder'], step) + tuple(nnModel[2:])
+  return nnModel[0], lite['decoder']
+
+
+def compare_steppers(keras_stepper, lite_stepper, steps=32, batch=4):
+  '''
+  Decodes the same tokens (the most likely ones of Keras) with both steppers
+  @return: the largest total variation distance between their token
+           distributions, the seconds each took and the speedup of TFLite
+  '''
+  seconds = [0.0, 0.0]
+
+  def timed(i, call, *args):
+    start = time.perf_counter()
+    out = call(*args)
+    seconds[i] += time.perf_counter() - start
+    return out
+
+  keras_pred, keras_rows = timed(0, keras_stepper.start, batch)
+  lite_pred, lite_rows = timed(1, lite_stepper.start, batch)
+  max_tv = 0.0
+  for _ in range(steps):
+    max_tv = max(max_tv, float(0.5 * np.abs(keras_pred - lite_pred).sum(axis=-1).max()))
+    tokens = list(np.argmax(keras_pred, axis=-1))
+    keras_pred, keras_rows = timed(0, keras_stepper.step, tokens, keras_rows)
+    lite_pred, lite_rows = timed(1, lite_stepper.step, tokens, lite_rows)
+  return {'max_tv': max_tv, 'keras_seconds': round(seconds[0], 4), 'lite_seconds': round(seconds[1], 4),
+          'speedup': round(seconds[0] / seconds[1], 2) if seconds[1] else None}
+
+
+def main():
+  from app.backend.decoding import LSTMStepper, TransformerStepper
+  from app.backend.registry import ModelRegistry
+
+  parser = argparse.ArgumentParser(description='Export the inference models to TFLite and check their parity')
+  parser.add_argument('--models', nargs='+', default=['transformer', 'lstm'])
+  parser.add_argument('--quantize', action='store_true', help='int8 weights (dynamic range quantization)')
+  parser.add_argument('--out', default='app/aux_files')
+  parser.add_argument('--steps', type=int, default=64)
+  parser.add_argument('--batch', type=int, default=4)
+  args = parser.parse_args()
+
+  registry = ModelRegistry('keras').load(args.models)
+  vocab = registry.vocabularies[0]
+  enc_inp = np.zeros((1, ENC_SEQ_LENGTH))
+  enc_inp[0, :3] = [vocab.shifted('sos'), vocab.shifted('bar'), vocab.shifted('eos')]
+  sos = registry.vocabularies[1].shifted('sos')
+  with registry.session_scope():
+    for name in args.models:
+      keras_models = registry.get_model(name)
+      lite_models = lite_inference_models(name, keras_models, args.quantize, args.out, registry.versions[name],
+                                          registry.session)
+      stepper = TransformerStepper if name == 'transformer' else LSTMStepper
+      report = compare_steppers(stepper(*keras_models[:2], enc_inp, sos), stepper(*lite_models[:2], enc_inp, sos),
+                                args.steps, args.batch)
+      print(name, report)
+
+
+if __name__ == '__main__':
+  main()
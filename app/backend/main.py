@@ -1,10 +1,28 @@
-import os
-import pickle
-from fastapi.responses import FileResponse
-from fastapi import FastAPI, HTTPException, Body
-from app.backend.utils import chords_mel_mid, create_static_conditions, generate_leadsheet
+import asyncio
+from typing import Literal, Optional
+from pydantic import BaseModel, Field
+from fastapi.responses import JSONResponse, Response
+from fastapi import FastAPI, HTTPException
+from app.backend.registry import registry, models_from_env
+from app.backend.jobs import QueueFull, job_manager_from_env
+from app.backend.pool import pool_from_env
+from app.backend.cache import cache_key, cache_from_env
+from app.backend.artifacts import MIDI_NAME, XML_NAME, store_from_env
+from app.backend.decoding import abort_stats
+from app.backend.scheduler import scheduler_from_env
+from app.backend.workers import workers_from_env
+from app.backend.utils import generate_leadsheet, render_leadsheet
 
 app = FastAPI()
+# generation in SITHSYNTH_WORKERS processes with their own models, off by default
+workers = workers_from_env("app.backend.main:work", setup="app.backend.main:load_models")
+# batches the decoder steps of concurrent requests (SITHSYNTH_MICROBATCH=0 disables it),
+# in the worker processes when there are workers
+decode_scheduler = scheduler_from_env(registry.session_scope) if workers is None else None
+# generated files are kept per generation id
+store = store_from_env()
+# seeded generations are kept on disk (SITHSYNTH_CACHE_MAX_MB=0 disables it)
+cache = cache_from_env()
 # Enable CORS so preflight OPTIONS are handled
 from fastapi.middleware.cors import CORSMiddleware
 app.add_middleware(
@@ -15,76 +33,277 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def load_models():
+    # encoders, templates and the inference models (both, unless SITHSYNTH_MODELS
+    # says otherwise) stay resident for the process, or for its worker processes
+    registry.load(models_from_env(), resident=workers is None)
+    if workers is not None:
+        workers.start()
+    if pool is not None:
+        for body in pool_params:
+            params = GenerateParams(**body)
+            if params.seed is None:  # seeded requests are served by the result cache
+                pool.add_key(generation_key(params), params)
+        pool.start()
+
+
+@app.on_event("shutdown")
+def stop_workers():
+    if workers is not None:
+        workers.close()
+
+
 @app.get("/")
 async def root():
     return {"message": "Hello World"}
 
-@app.post("/generate")
-async def generate_music(
-    temp: float = Body(..., title="Temperature"),
-    timsig_n: int = Body(..., title="Time Signature Numerator"),
-    timsig_d: int = Body(..., title="Time Signature Denominator"),
-    num_bars: int = Body(..., title="Number of Bars"),
-    val: str = Body(..., title="Valence"),
-    den: str = Body(..., title="Density"),
-    modl: str = Body(..., title="Model (transformer or lstm)")
-):
-    # Load global variables and dictionaries
-    encoders_trans = 'app/aux_files/chords_encoders_all.pickle'
-    with open(encoders_trans, 'rb') as handle:
-        TransEncoders = pickle.load(handle)
-
-    val_temp_path = 'app/aux_files/Valence_Templates.pickle'
-    with open(val_temp_path, 'rb') as handle:
-        val_templates = pickle.load(handle)
-
-    dense_temp_path = 'app/aux_files/Density_Templates.pickle'
-    with open(dense_temp_path, 'rb') as handle:
-        dense_templates = pickle.load(handle)
 
+@app.get("/models")
+async def get_models():
+    return registry.status()
+
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        # with workers nothing is decoded in this process
+        "early_abort": abort_stats.snapshot() if workers is None else None,
+        "scheduler": decode_scheduler.status() if decode_scheduler is not None else None,
+        "buckets": registry.buckets.status() if registry.buckets is not None else None,
+        "jobs": jobs.status(),
+        "workers": workers.status() if workers is not None else None,
+        "store": store.status(),
+        "pool": pool.status() if pool is not None else None,
+        "cache": cache.status() if cache is not None else None,
+    }
+
+
+class GenerateParams(BaseModel):
+    temp: float = Field(..., title="Temperature")
+    timsig_n: int = Field(..., title="Time Signature Numerator")
+    timsig_d: int = Field(..., title="Time Signature Denominator")
+    num_bars: int = Field(..., title="Number of Bars")
+    val: str = Field(..., title="Valence")
+    den: str = Field(..., title="Density")
+    modl: str = Field(..., title="Model (transformer or lstm)")
+    constrained: bool = Field(True, title="Constrain decoding to valid lead sheets")
+    num_candidates: int = Field(1, ge=1, le=64, title="Candidates decoded together per attempt")
+    formats: Literal["both", "midi", "xml", "tokens"] = Field("both", title="Formats to link (or tokens)")
+    seed: Optional[int] = Field(None, ge=0, title="Seed for a reproducible lead sheet")
+    top_k: Optional[int] = Field(None, ge=1, title="Sample among the top_k most likely tokens only")
+    top_p: Optional[float] = Field(None, gt=0, le=1, title="Sample among the top_p nucleus only")
+    return_all: bool = Field(False, title="Also return the tokens of every valid candidate")
+
+
+FORMATS = {"both": ("midi", "xml"), "midi": ("midi",), "xml": ("xml",), "tokens": ()}
+ARTIFACT_FORMATS = {MIDI_NAME: "midi", XML_NAME: "xml"}
+
+
+def generate_source(params):
     # Set user music parameters
-    temperature = temp
-    timesig = f"[{timsig_n}, {timsig_d}]"
-    numOfBars = num_bars
-    valence = val
-    density = den
-    model = modl
-
-    # Generate the lead sheet
-    allChords, allDurs, allMels = generate_leadsheet(
-        temperature,
-        timesig,
-        numOfBars,
-        valence,
-        density,
-        model,
-        TransEncoders,
-        val_templates,
-        dense_templates,
-    )
-
-    f_chords, f_durs, f_melody, f_bars = create_static_conditions(allChords, allDurs, allMels)
-    chords_mel_mid(f_chords,f_durs,f_bars,f_melody,timesig,model)
-
-    midi_file = 'app/generations/mid/music.mid'
-    xml_file = 'app/generations/xml/sheet.xml'
-
-    if not os.path.exists(midi_file) or not os.path.exists(xml_file):
-        raise HTTPException(status_code=500, detail="Failed to generate music files")
-
-    return {"midi_file": midi_file, "xml_file": xml_file}
+    temperature = params.temp
+    timesig = f"[{params.timsig_n}, {params.timsig_d}]"
+    numOfBars = params.num_bars
+    valence = params.val
+    density = params.den
+    model = params.modl
+
+    # Generate the lead sheet with the resident encoders, templates and model
+    with registry.session_scope():
+        generated = generate_leadsheet(
+            temperature,
+            timesig,
+            numOfBars,
+            valence,
+            density,
+            model,
+            registry.vocabularies,
+            registry.val_templates,
+            registry.dense_templates,
+            nnModel=registry.get_model(model),
+            constrained=params.constrained,
+            num_candidates=params.num_candidates,
+            scheduler=decode_scheduler,
+            seed=params.seed,
+            top_k=params.top_k,
+            top_p=params.top_p,
+            return_all=params.return_all,
+        )
+    if params.return_all:
+        # every valid candidate of the attempt, the first one is the lead sheet
+        allChords, allDurs, allMels = generated[0]
+        return allChords, allDurs, allMels, timesig, model, generated
+    allChords, allDurs, allMels = generated
+    return allChords, allDurs, allMels, timesig, model
+
+
+def publish(params, source, files=None):
+    allChords, allDurs, allMels = source[:3]
+    generation_id = store.new_id()
+    store.put(generation_id, files=files, source=source)
+
+    formats = FORMATS[params.formats]
+    result = {"generation_id": generation_id}
+    if "midi" in formats:
+        result["midi_file"] = f"/midi/{generation_id}"
+    if "xml" in formats:
+        result["xml_file"] = f"/xml/{generation_id}"
+    if not formats:
+        result["tokens"] = {"chords": allChords, "durations": allDurs, "melody": allMels}
+    if len(source) > 5:
+        result["candidates"] = [{"chords": chords, "durations": durs, "melody": mels}
+                                for chords, durs, mels in source[5]]
+    return result
+
+
+def run_generation(params):
+    if params.seed is None:
+        # nothing is rendered yet, each format is rendered on its first fetch
+        # (a worker process, when there are workers, only decodes)
+        if workers is not None:
+            return publish(params, workers.run("source", params))
+        return publish(params, generate_source(params))
+    # a seeded lead sheet is a function of the parameters, the seed and the model files,
+    # it is rendered right away and kept in the result cache
+    key = cache_key(generation_key(params), params.seed, registry.version(params.modl))
+    cached = cache.get(key) if cache is not None else None
+    if cached is None:
+        cached, _ = pregenerate(params)
+        if cache is not None:
+            cache.put(key, *cached)
+    return publish(params, *cached)
+
+
+def pregenerate(params):
+    # a pooled lead sheet is decoded and rendered before it is requested, by a
+    # worker process when there are workers
+    if workers is not None:
+        return workers.run("render", params)
+    return render_ahead(params)
+
+
+def render_ahead(params):
+    source = generate_source(params)
+    allChords, allDurs, allMels, timesig, model = source[:5]
+    rendered = render_leadsheet(allChords, allDurs, allMels, timesig, model, chords=registry.chord_table)
+    files = {MIDI_NAME: rendered.midi, XML_NAME: rendered.xml}
+    return (source, files), sum(len(data) for data in files.values())
+
+
+def work(task, params):
+    # the work of a worker process: the tokens only ("source") or also the files ("render")
+    return generate_source(params) if task == "source" else render_ahead(params)
+
 
+def generation_key(params):
+    # everything but formats (which only changes what the result links) and the seed
+    return (params.temp, params.timsig_n, params.timsig_d, params.num_bars, params.val, params.den,
+            params.modl, params.constrained, params.num_candidates, params.top_k, params.top_p,
+            params.return_all)
 
+
+def render_artifact(name):
+    fmt = ARTIFACT_FORMATS[name]
+
+    def render(source):
+        allChords, allDurs, allMels, timesig, model = source[:5]
+        rendered = render_leadsheet(allChords, allDurs, allMels, timesig, model, (fmt,),
+                                    chords=registry.chord_table)
+        return getattr(rendered, fmt)
+    return render
+
+
+# generation runs in a bounded worker pool, off the event loop
+# (SITHSYNTH_JOB_WORKERS workers, at most SITHSYNTH_JOB_QUEUE queued jobs)
+jobs = job_manager_from_env(run_generation, min_workers=workers.workers if workers is not None else 0)
+# lead sheets generated ahead of time for the configured (SITHSYNTH_POOL_KEYS) and
+# frequently requested parameters, off unless SITHSYNTH_POOL_DEPTH > 0
+pool, pool_params = pool_from_env(pregenerate)
+
+
+def submit_job(params):
+    try:
+        return jobs.submit(params)
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+def job_error(job):
+    if isinstance(job.error, ValueError):
+        return HTTPException(status_code=422, detail=str(job.error))
+    return HTTPException(status_code=500, detail=str(job.error))
+
+
+@app.post("/generate")
+async def generate_music(params: GenerateParams):
+    if pool is not None and params.seed is None:
+        pooled = pool.take(generation_key(params), params)
+        if pooled is not None:
+            return publish(params, *pooled)
+    job = submit_job(params)
+    try:
+        return await asyncio.wrap_future(job.future)
+    except Exception:
+        raise job_error(job)
+
+
+@app.post("/jobs", status_code=202)
+async def create_job(params: GenerateParams):
+    return submit_job(params).info()
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.info()
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status == 'failed':
+        raise job_error(job)
+    if job.status != 'done':
+        return JSONResponse(status_code=202, content=job.info())
+    return job.result
+
+
+async def get_artifact(generation_id, name, media_type):
+    artifact = None
+    if generation_id:
+        # rendered (or waited for) off the event loop, then served from the store
+        loop = asyncio.get_running_loop()
+        artifact = await loop.run_in_executor(None, store.get_or_render, generation_id, name,
+                                              render_artifact(name))
+    if artifact is None:
+        raise HTTPException(status_code=404, detail=f"{name} not found for this generation")
+    # served straight from memory
+    return Response(content=artifact.data, media_type=media_type,
+                    headers={"Content-Disposition": f'attachment; filename="{name}"',
+                             "ETag": f'"{artifact.sha256}"'})
+
+
+@app.get("/midi/{generation_id}")
+async def get_midi(generation_id: str):
+    return await get_artifact(generation_id, MIDI_NAME, 'audio/midi')
+
+
+@app.get("/xml/{generation_id}")
+async def get_xml(generation_id: str):
+    return await get_artifact(generation_id, XML_NAME, 'application/xml')
+
+
+# the most recent generation, for older clients
 @app.get("/midi")
-async def get_midi():
-    midi_file = 'app/generations/mid/music.mid'
-    if not os.path.exists(midi_file):
-        raise HTTPException(status_code=404, detail="MIDI file not found")
-    return FileResponse(midi_file, media_type='audio/midi', filename="music.mid")
+async def get_latest_midi():
+    return await get_midi(store.latest)
+
 
 @app.get("/xml")
-async def get_xml():
-    xml_file = 'app/generations/xml/sheet.xml'
-    if not os.path.exists(xml_file):
-        raise HTTPException(status_code=404, detail="XML file not found")
-    return FileResponse(xml_file, media_type='application/xml', filename="sheet.xml")
+async def get_latest_xml():
+    return await get_xml(store.latest)
@@ -0,0 +1,97 @@
+import json
+import struct
+from fractions import Fraction
+
+from app.backend.chords import chord_spans
+
+TICKS_PER_QUARTER = 1024
+VELOCITY = 90
+TEMPO_BPM = 100
+
+FLUTE = ('Flute', 73)
+PIANO = ('Piano', 0)
+
+# event order at the same tick, as music21 sorts its MIDI packets
+NOTE_OFF_ORDER = -20
+PITCH_BEND_ORDER = -10
+DEFAULT_ORDER = 0
+
+
+def var_len(value):
+  '''MIDI variable-length quantity'''
+  out = [value & 0x7F]
+  value >>= 7
+  while value:
+    out.append((value & 0x7F) | 0x80)
+    value >>= 7
+  return bytes(reversed(out))
+
+
+def meta(kind, data):
+  return bytes([0xFF, kind]) + var_len(len(data)) + data
+
+
+def to_ticks(quarters):
+  return int(round(quarters * TICKS_PER_QUARTER))
+
+
+class Track:
+  '''The events of one SMF track as (tick, order, bytes), sorted like music21 on output'''
+
+  def __init__(self, instrument, channel):
+    self.name, self.program = instrument
+    self.channel = channel - 1
+    self.events = []
+
+  def add(self, tick, data, order=DEFAULT_ORDER):
+    self.events.append((tick, order, data))
+
+  def note(self, start, quarters, pitches):
+    on = to_ticks(start)
+    off = on + to_ticks(quarters)
+    for pitch in pitches:
+      self.add(on, bytes([0x90 | self.channel, pitch, VELOCITY]))
+    for pitch in pitches:
+      self.add(off, bytes([0x80 | self.channel, pitch, 0]), NOTE_OFF_ORDER)
+
+  def chunk(self, header):
+    program = bytes([0xC0 | self.channel, self.program])
+    body = [var_len(0), meta(0x03, self.name.encode('ascii')), var_len(0), program]
+    events = [(0, PITCH_BEND_ORDER, bytes([0xE0 | self.channel, 0x00, 0x40])),
+              (0, DEFAULT_ORDER, program)] + [(0, DEFAULT_ORDER, data) for data in header] + self.events
+    last = 0
+    for tick, _, data in sorted(events, key=lambda e: (e[0], e[1])):
+      body.append(var_len(tick - last))
+      body.append(data)
+      last = tick
+    body.append(var_len(TICKS_PER_QUARTER))
+    body.append(meta(0x2F, b''))
+    body = b''.join(body)
+    return b'MTrk' + struct.pack('>I', len(body)) + body
+
+
+def leadsheet_midi(f_chords, f_durs, f_bars, f_melody, timesig, chords=None):
+  '''
+  Encodes the lead sheet straight to a format 1 SMF: a flute melody track and a
+  piano chord track. Timing, event order and meta events follow what music21
+  writes for the same streams (tempo 100, identical consecutive chords of a bar
+  merged, rests as gaps). The chord pitches come from the ChordTable chords.
+  '''
+  numerator, denominator = json.loads(timesig)
+  time_signature = meta(0x58, bytes([numerator, denominator.bit_length() - 1, 24, 8]))
+  tempo = meta(0x51, struct.pack('>I', round(60000000 / TEMPO_BPM))[1:])
+
+  melody = Track(FLUTE, 1)
+  offset = Fraction(0)
+  for dur, mel in zip(f_durs, f_melody):
+    dur = Fraction(dur)
+    if mel != 'Rest' and mel != 'eos':
+      melody.note(offset, dur, (int(mel),))
+    offset += dur
+  piano = Track(PIANO, 2)
+  for _, _, start, dur, entry in chord_spans(f_chords, f_durs, f_bars, chords):
+    if entry is not None:
+      piano.note(start, dur, entry.pitches)
+
+  header = b'MThd' + struct.pack('>IHHH', 6, 1, 2, TICKS_PER_QUARTER)
+  return header + melody.chunk([tempo, time_signature]) + piano.chunk([time_signature])
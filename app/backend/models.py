@@ -104,6 +104,39 @@ class Decoder(tf.keras.layers.Layer):
   def compute_mask(self, inputs, mask=None):
     return self.embedding.compute_mask(inputs[0])
 
+  def cross_cache(self, enc_output):
+    # keys and values of every decoder layer over the encoder output, they do
+    # not change while decoding so they are computed once
+    cross = []
+    for decoder_layer in self.decoder_layers:
+      attention = decoder_layer.multi_head_attention2
+      cross.append((attention.project_key(enc_output), attention.project_value(enc_output)))
+    return cross
+
+  def call_step(self, token, position, past, cross, enc_mask, past_mask=None):
+    '''
+    Incremental decoding of the newest token only
+    @param token: (batch, 1) the newest (shifted) token
+    @param position: (batch, 1) its position in the decoder sequence
+    @param past: per layer (key, value) heads of the previous tokens, None for the first token
+    @param cross: per layer (key, value) heads of the encoder output
+    @param enc_mask: the padding mask of the encoder input
+    @param past_mask: (batch, past length) the valid cache positions when rows are padded
+    @return: the decoder output for the token and the per layer (key, value) heads including it
+    '''
+    x = self.embedding(token)
+    # positional encoding
+    x *= tf.math.sqrt(tf.cast(self.d_model, tf.float32))
+    x += tf.gather(self.pos[0], position)
+
+    new_past = []
+    for i, decoder_layer in enumerate(self.decoder_layers):
+      x, key_value = decoder_layer.call_step(x, None if past is None else past[i], cross[i], enc_mask,
+                                             past_mask)
+      new_past.append(key_value)
+
+    return x, new_past
+
 
 class DecoderLayer(tf.keras.layers.Layer):
   def __init__(self, d_model=512, num_heads=8, dff=2048, dropout=0.0):
@@ -146,6 +179,35 @@ class DecoderLayer(tf.keras.layers.Layer):
 
     return x
 
+  def call_step(self, x, past, cross, enc_mask, past_mask=None):
+    # same as call() for a single query token, attending to the cached keys/values
+    attention_layer = self.multi_head_attention1
+    key = attention_layer.project_key(x)
+    value = attention_layer.project_value(x)
+    value_mask = None
+    if past is not None:
+      key = tf.concat([past[0], key], axis=2)
+      value = tf.concat([past[1], value], axis=2)
+      if past_mask is not None:
+        value_mask = tf.concat([tf.cast(past_mask, tf.float32), tf.ones_like(x[:, :, 0])], axis=1)
+    # every cached position is in the past of the query, no causal mask is needed
+    attention = attention_layer.attend(attention_layer.project_query(x), value, key, value_mask)
+    x = self.add_attention1([x, attention])
+    x = self.layer_norm_attention1(x)
+
+    attention_layer = self.multi_head_attention2
+    attention = attention_layer.attend(attention_layer.project_query(x), cross[1], cross[0], enc_mask)
+    x = self.add_attention1([x, attention])
+    x = self.layer_norm_attention1(x)
+
+    ## Feed Forward
+    dense = self.dense1(x)
+    dense = self.dense2(dense)
+    x = self.add_dense([x, dense])
+    x = self.layer_norm_dense(x)
+
+    return x, (key, value)
+
 
 class MultiHeadAttention(tf.keras.layers.Layer):
   def __init__(self, d_model=512, num_heads=8, causal=False, dropout=0.0):
@@ -153,6 +215,8 @@ class MultiHeadAttention(tf.keras.layers.Layer):
 
     assert d_model % num_heads == 0
     depth = d_model // num_heads
+    self.num_heads = num_heads
+    self.depth = depth
 
     self.w_query = tf.keras.layers.Dense(d_model)
     self.split_reshape_query = tf.keras.layers.Reshape((-1, num_heads, depth))
@@ -205,6 +269,174 @@ class MultiHeadAttention(tf.keras.layers.Layer):
 
     return x
 
+  def project_query(self, q):
+    query = self.w_query(q)
+    query = self.split_reshape_query(query)
+    return self.split_permute_query(query)
+
+  def project_value(self, v):
+    value = self.w_value(v)
+    value = self.split_reshape_value(value)
+    return self.split_permute_value(value)
+
+  def project_key(self, k):
+    key = self.w_key(k)
+    key = self.split_reshape_key(key)
+    return self.split_permute_key(key)
+
+  def attend(self, query, value, key, value_mask=None):
+    # the dot-product attention of self.attention on already projected heads
+    scores = tf.matmul(query, key, transpose_b=True)
+    if value_mask is not None:
+      padding_mask = 1. - tf.cast(value_mask, scores.dtype)
+      # (batch, 1, 1, keys), expand_dims instead of tf.newaxis slicing converts to builtin TFLite ops
+      scores -= 1.e9 * tf.expand_dims(tf.expand_dims(padding_mask, 1), 1)
+    weights = tf.nn.softmax(scores)
+    attention = tf.matmul(weights, value)
+    attention = self.join_permute_attention(attention)
+    attention = self.join_reshape_attention(attention)
+
+    return self.dense(attention)
+
+
+def flatten_cache(cache):
+  return [t for key_value in cache for t in key_value]
+
+
+def unflatten_cache(tensors):
+  return [(tensors[i], tensors[i + 1]) for i in range(0, len(tensors), 2)]
+
+
+class TransformerPrefill(tf.keras.layers.Layer):
+  '''
+  Encodes the input once and decodes the first (sos) token. Returns the token
+  probabilities, the self-attention cache of every decoder layer and the
+  cross-attention keys/values over the encoder output.
+  '''
+  def __init__(self, encoder, decoder, dec_output):
+    super(TransformerPrefill, self).__init__()
+
+    self.encoder = encoder
+    self.decoder = decoder
+    self.dec_output = dec_output
+
+  def call(self, inputs):
+    enc_input, dec_input = inputs
+    enc_output = self.encoder(enc_input)
+    enc_mask = self.encoder.compute_mask(enc_input)
+
+    cross = self.decoder.cross_cache(enc_output)
+    position = tf.zeros_like(dec_input, dtype=tf.int32)
+    x, past = self.decoder.call_step(dec_input, position, None, cross, enc_mask)
+
+    return [self.dec_output(x)] + flatten_cache(past) + flatten_cache(cross)
+
+
+class TransformerStep(tf.keras.layers.Layer):
+  '''
+  Decodes one new token against the cached keys/values. Inputs are the token,
+  its position, the encoder input (for its padding mask), the past tokens (zero
+  where a row's cache is padded), the self-attention cache and the
+  cross-attention keys/values. Returns the token probabilities and the
+  self-attention cache with the new token appended.
+  '''
+  def __init__(self, encoder, decoder, dec_output):
+    super(TransformerStep, self).__init__()
+
+    self.encoder = encoder
+    self.decoder = decoder
+    self.dec_output = dec_output
+
+  def call(self, inputs):
+    token, position, enc_input, past_tokens = inputs[:4]
+    num_cache = 2 * len(self.decoder.decoder_layers)
+    past = unflatten_cache(inputs[4:4 + num_cache])
+    cross = unflatten_cache(inputs[4 + num_cache:])
+    enc_mask = self.encoder.compute_mask(enc_input)
+    past_mask = self.decoder.embedding.compute_mask(past_tokens)
+
+    x, past = self.decoder.call_step(token, position, past, cross, enc_mask, past_mask)
+
+    return [self.dec_output(x)] + flatten_cache(past)
+
+
+class LSTMSampling(tf.keras.layers.Layer):
+  '''
+  The whole LSTM decoding loop in the graph: step the decoder model, sample
+  the next token with temperature and stop once every row has its eos or
+  max_length tokens, so the states never leave the graph. Inputs are the sos
+  token, the 6 Encoder states, the temperature, a stateless seed and the
+  tables of the decoder grammar (see decoding.grammar_tables), the last two
+  read from the first row. Every row keeps its grammar slot, bar count and
+  rest of the bar, and only samples the tokens the grammar allows. Returns
+  the sampled tokens, eos padded, and their lengths.
+  '''
+  BAR, CHORD, MELODY, DURATION, EOS = range(5)  # decoding.SLOTS
+
+  def __init__(self, decoder, eos_idx, max_length):
+    super(LSTMSampling, self).__init__()
+
+    self.decoder = decoder
+    self.eos_idx = eos_idx
+    self.max_length = max_length
+
+  def call(self, inputs):
+    sos, states, temperature, seed = inputs[0], list(inputs[1:-6]), inputs[-6], inputs[-5]
+    slot_masks = tf.cast(inputs[-4][0], tf.bool)
+    next_rest, finish, params = inputs[-3][0], inputs[-2][0], inputs[-1][0]
+    num_bars, full_bar, seq_length, bar_rest, zero_rest = [params[i] for i in range(5)]
+    constrained = tf.equal(params[5], 1)
+    n = tf.shape(sos)[0]
+    seed = tf.cast(seed[0], tf.int64)
+
+    def allowed(step, slot, bars, rest):
+      # a duration has to leave a fillable rest of the bar within the length budget
+      after = tf.gather(next_rest, rest)
+      budget = seq_length - step - 3 - (num_bars - bars) * full_bar
+      durations = tf.logical_and(after >= 0, tf.gather(finish, tf.maximum(after, 0)) <= budget[:, tf.newaxis])
+      mask = tf.where(tf.equal(slot, self.DURATION)[:, tf.newaxis], durations, tf.gather(slot_masks, slot))
+      return tf.logical_or(mask, tf.logical_not(constrained))
+
+    def advance(slot, bars, rest, sampled):
+      is_bar, is_duration = tf.equal(slot, self.BAR), tf.equal(slot, self.DURATION)
+      bars = bars + tf.cast(is_bar, tf.int32)
+      after = tf.gather_nd(next_rest, tf.stack([rest, sampled], axis=1))
+      rest = tf.where(is_bar, tf.fill([n], bar_rest), tf.where(is_duration, tf.maximum(after, 0), rest))
+      slot = tf.where(is_bar, tf.where(tf.equal(bars, num_bars + 1), self.EOS, self.CHORD),
+             tf.where(tf.equal(slot, self.CHORD), tf.fill([n], self.MELODY),
+             tf.where(tf.equal(slot, self.MELODY), tf.fill([n], self.DURATION),
+             tf.where(is_duration, tf.where(tf.equal(rest, zero_rest), self.BAR, self.CHORD), slot))))
+      return slot, bars, rest
+
+    def cond(step, token, states, done, tokens, lengths, slot, bars, rest):
+      return tf.logical_and(step < self.max_length, tf.logical_not(tf.reduce_all(done)))
+
+    def body(step, token, states, done, tokens, lengths, slot, bars, rest):
+      outputs = self.decoder([token] + states)
+      logits = tf.math.log(tf.reshape(outputs[0], [n, -1])) / temperature
+      mask = allowed(step, slot, bars, rest)
+      logits = tf.where(mask, logits, tf.fill(tf.shape(logits), -np.inf))
+      # a row whose allowed probabilities all underflowed samples them uniformly
+      underflow = tf.logical_not(tf.reduce_any(tf.math.is_finite(logits), axis=-1))
+      logits = tf.where(tf.logical_and(underflow[:, tf.newaxis], mask), tf.zeros_like(logits), logits)
+      sampled = tf.random.stateless_categorical(logits, 1, seed + tf.stack([0, tf.cast(step, tf.int64)]),
+                                                dtype=tf.int32)[:, 0]
+      sampled = tf.where(done, tf.fill([n], self.eos_idx), sampled)
+      lengths = lengths + tf.cast(tf.logical_not(done), tf.int32)
+      grammar = advance(slot, bars, rest, sampled)
+      slot, bars, rest = [tf.where(done, old, new) for old, new in zip((slot, bars, rest), grammar)]
+      done = tf.logical_or(done, tf.equal(sampled, self.eos_idx))
+      # the decoder input is shifted by 1
+      token = tf.cast(tf.reshape(sampled + 1, [n, 1]), token.dtype)
+      return step + 1, token, list(outputs[1:]), done, tokens.write(step, sampled), lengths, slot, bars, rest
+
+    zeros = tf.zeros([n], tf.int32)
+    loop = tf.while_loop(cond, body, [tf.constant(0), sos, states, tf.zeros([n], tf.bool),
+                                      tf.TensorArray(tf.int32, size=self.max_length, element_shape=[None]),
+                                      zeros, zeros + self.BAR, zeros, zeros + bar_rest])
+    tokens = tf.transpose(loop[4].stack())
+    return [tokens, loop[5]]
+
 
 def get_angles(pos, i, d_model):
   angle_rates = 1 / np.power(10000, (2 * (i // 2)) / np.float32(d_model))
@@ -0,0 +1,213 @@
+import io
+import json
+from math import gcd
+from functools import lru_cache, reduce
+from fractions import Fraction
+from xml.sax.saxutils import escape, quoteattr
+
+from app.backend.chords import chord_spans
+
+# music21's spelling of MIDI pitches (C# and E-, F# G# and B-)
+STEPS = ('C', 'C', 'D', 'E', 'E', 'F', 'F', 'G', 'G', 'A', 'B', 'B')
+ALTERS = (0, 1, 0, -1, 0, 0, 1, 0, 1, 0, -1, 0)
+
+NOTE_TYPES = (('breve', Fraction(8)), ('whole', Fraction(4)), ('half', Fraction(2)), ('quarter', Fraction(1)),
+              ('eighth', Fraction(1, 2)), ('16th', Fraction(1, 4)), ('32nd', Fraction(1, 8)),
+              ('64th', Fraction(1, 16)))
+TUPLETS = ((1, 1), (3, 2))  # (actual, normal) notes
+
+FLUTE = ('P1', 'Flute', 1, 74)
+PIANO = ('P2', 'Piano', 2, 1)
+
+HEADER = ('<?xml version="1.0" encoding="utf-8"?>\n'
+          '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.0 Partwise//EN" '
+          '"http://www.musicxml.org/dtds/partwise.dtd">\n'
+          '<score-partwise version="3.0">\n')
+
+
+@lru_cache(maxsize=None)
+def note_type(quarters):
+  '''
+  (type, dots, (actual, normal)) that spells the duration: plain, dotted or a
+  triplet when possible, otherwise the largest type that fits with the ratio
+  of the duration to it as tuplet (as music21 does for such durations)
+  '''
+  for actual, normal in TUPLETS:
+    written = quarters * actual / normal
+    for name, length in NOTE_TYPES:
+      for dots in range(3):
+        if length * (2 - Fraction(1, 2 ** dots)) == written:
+          return name, dots, (actual, normal)
+  name, length = next((t for t in NOTE_TYPES if t[1] <= quarters), NOTE_TYPES[-1])
+  ratio = quarters / length
+  return name, 0, (ratio.denominator, ratio.numerator)
+
+
+def midi_pitch(midi):
+  return STEPS[midi % 12], ALTERS[midi % 12], midi // 12 - 1
+
+
+def name_pitch(name):
+  '''(step, alter, octave) of a pitch name with octave such as 'E-3' or 'C#4' '''
+  digits = len(name) - len(name.rstrip('0123456789'))
+  accidental = name[1:len(name) - digits]
+  return name[0], accidental.count('#') - accidental.count('-'), int(name[len(name) - digits:])
+
+
+class LeadSheetWriter:
+  '''Writes the MusicXML elements one line at a time into a bytes buffer'''
+
+  def __init__(self, divisions):
+    self.divisions = divisions
+    self.out = io.BytesIO()
+    self.depth = 1
+
+  def line(self, text):
+    self.out.write(('  ' * self.depth + text + '\n').encode('utf-8'))
+
+  def open(self, tag, attrs=''):
+    self.line(f'<{tag}{attrs}>')
+    self.depth += 1
+
+  def close(self, tag):
+    self.depth -= 1
+    self.line(f'</{tag}>')
+
+  def leaf(self, tag, text):
+    self.line(f'<{tag}>{text}</{tag}>')
+
+  def note(self, quarters, pitch=None, chord=False):
+    self.open('note')
+    if chord:
+      self.line('<chord />')
+    if pitch is None:
+      self.line('<rest />')
+    else:
+      step, alter, octave = pitch
+      self.open('pitch')
+      self.leaf('step', step)
+      if alter:
+        self.leaf('alter', alter)
+      self.leaf('octave', octave)
+      self.close('pitch')
+    self.leaf('duration', int(quarters * self.divisions))
+    # readers take the duration from the type, dots and time modification
+    name, dots, (actual, normal) = note_type(quarters)
+    self.leaf('type', name)
+    for _ in range(dots):
+      self.line('<dot />')
+    if actual != normal:
+      self.open('time-modification')
+      self.leaf('actual-notes', actual)
+      self.leaf('normal-notes', normal)
+      self.close('time-modification')
+    self.close('note')
+
+  def harmony(self, entry):
+    self.open('harmony')
+    self.open('root')
+    self.leaf('root-step', entry.root[0])
+    if entry.root[1]:
+      self.leaf('root-alter', entry.root[1])
+    self.close('root')
+    text = '' if entry.kind_text is None else ' text=' + quoteattr(entry.kind_text)
+    self.line(f'<kind{text}>{entry.kind}</kind>')
+    if entry.bass is not None:
+      self.open('bass')
+      self.leaf('bass-step', entry.bass[0])
+      if entry.bass[1]:
+        self.leaf('bass-alter', entry.bass[1])
+      self.close('bass')
+    for value, alter, kind in entry.degrees:
+      self.open('degree')
+      self.leaf('degree-value', value)
+      self.leaf('degree-alter', alter or 0)
+      self.leaf('degree-type', kind)
+      self.close('degree')
+    self.close('harmony')
+
+  def attributes(self, timesig, clef):
+    self.open('attributes')
+    self.leaf('divisions', self.divisions)
+    self.open('time')
+    self.leaf('beats', timesig[0])
+    self.leaf('beat-type', timesig[1])
+    self.close('time')
+    self.open('clef')
+    self.leaf('sign', clef[0])
+    self.leaf('line', clef[1])
+    self.close('clef')
+    self.close('attributes')
+
+  def score_part(self, part):
+    part_id, name, channel, program = part
+    self.open('score-part', f' id="{part_id}"')
+    self.leaf('part-name', name)
+    self.open('score-instrument', f' id="{part_id}-I1"')
+    self.leaf('instrument-name', name)
+    self.close('score-instrument')
+    self.open('midi-instrument', f' id="{part_id}-I1"')
+    self.leaf('midi-channel', channel)
+    self.leaf('midi-program', program)
+    self.close('midi-instrument')
+    self.close('score-part')
+
+
+def leadsheet_xml(f_chords, f_durs, f_bars, f_melody, timesig, title, chords=None):
+  '''
+  Writes the lead sheet as partwise MusicXML, measure by measure: the melody
+  part with the chord symbols as harmony elements and the piano part with the
+  chords, bass clef, identical consecutive chords of a bar merged. The chord
+  symbols and pitches come from the ChordTable chords.
+  '''
+  timesig = json.loads(timesig)
+  durs = [Fraction(d) for d in f_durs]
+  divisions = reduce(lambda a, b: a * b // gcd(a, b), (d.denominator for d in durs), 1)
+  spans = chord_spans(f_chords, f_durs, f_bars, chords)
+  harmonies = {span[0]: span[4] for span in spans if span[4] is not None}
+  starts = [i for i, bar in enumerate(f_bars) if bar == 'bar'] + [len(f_bars)]
+
+  w = LeadSheetWriter(divisions)
+  w.out.write(HEADER.encode('utf-8'))
+  w.open('credit', ' page="1"')
+  w.line('<credit-words default-x="500" default-y="500" valign="top" halign="center">'
+         f'{escape(title)}</credit-words>')
+  w.close('credit')
+  w.open('part-list')
+  w.score_part(FLUTE)
+  w.score_part(PIANO)
+  w.close('part-list')
+
+  w.open('part', f' id="{FLUTE[0]}"')
+  for m in range(len(starts) - 1):
+    w.open('measure', f' number="{m + 1}"')
+    if m == 0:
+      w.attributes(timesig, ('G', 2))
+    for i in range(starts[m], starts[m + 1]):
+      if i in harmonies:
+        w.harmony(harmonies[i])
+      mel = f_melody[i]
+      w.note(durs[i], None if mel == 'Rest' or mel == 'eos' else midi_pitch(int(mel)))
+    w.close('measure')
+  w.close('part')
+
+  w.open('part', f' id="{PIANO[0]}"')
+  bar = -1
+  for _, span_bar, _, dur, entry in spans:
+    if span_bar != bar:
+      if bar >= 0:
+        w.close('measure')
+      bar = span_bar
+      w.open('measure', f' number="{bar + 1}"')
+      if bar == 0:
+        w.attributes(timesig, ('F', 4))
+    if entry is None:
+      w.note(dur)
+    for k, name in enumerate(entry.pitch_names if entry is not None else ()):
+      w.note(dur, name_pitch(name), chord=k > 0)
+  if bar >= 0:
+    w.close('measure')
+  w.close('part')
+
+  w.out.write(b'</score-partwise>\n')
+  return w.out.getvalue()
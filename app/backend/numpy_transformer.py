@@ -0,0 +1,315 @@
+import argparse
+
+import numpy as np
+
+# the order of the weights of each layer in the Keras model (and in its h5 file)
+DENSES = ('query', 'value', 'key', 'output')
+ENCODER_LAYER = [f'self_{d}/{w}' for d in DENSES for w in ('kernel', 'bias')] + \
+                ['self_norm/gamma', 'self_norm/beta', 'ffn1/kernel', 'ffn1/bias', 'ffn2/kernel', 'ffn2/bias',
+                 'ffn_norm/gamma', 'ffn_norm/beta']
+# the decoder layers have no weights for layer_norm_attention2, the cross attention reuses self_norm
+DECODER_LAYER = [f'self_{d}/{w}' for d in DENSES for w in ('kernel', 'bias')] + \
+                ['self_norm/gamma', 'self_norm/beta'] + \
+                [f'cross_{d}/{w}' for d in DENSES for w in ('kernel', 'bias')] + \
+                ['ffn1/kernel', 'ffn1/bias', 'ffn2/kernel', 'ffn2/bias', 'ffn_norm/gamma', 'ffn_norm/beta']
+
+MASKED = 1.e9  # subtracted from the scores of masked positions, as Keras does
+EPSILON = 1e-6  # of the LayerNormalization layers
+MAX_POSITIONS = 1024  # longer than the encoder (263) and decoder (359) sequences
+
+
+def weight_names(part, count):
+  '''The names of the count weights of the encoder, decoder or out_var1 in h5 order'''
+  if part == 'out_var1':
+    return ['out/kernel', 'out/bias']
+  layer = ENCODER_LAYER if part == 'encoder' else DECODER_LAYER
+  return [f'{part}/embedding'] + [f'{part}/{i}/{name}' for i in range((count - 1) // len(layer))
+                                  for name in layer]
+
+
+def load_h5_weights(path):
+  '''
+  The Transformer weights of a Keras h5 weights file (ChordDurMel_Trans_w.h5)
+  as {name: array}. Like Keras load_weights, the layers with weights are
+  matched by order: encoder, decoder, out_var1.
+  '''
+  import h5py
+
+  weights = {}
+  with h5py.File(path, 'r') as f:
+    groups = [f[name if isinstance(name, str) else name.decode('utf8')] for name in f.attrs['layer_names']]
+    groups = [g for g in groups if len(g.attrs['weight_names'])]
+    if len(groups) != 3:
+      raise ValueError(f'{path} has {len(groups)} layers with weights, expected encoder, decoder and out_var1')
+    for part, group in zip(('encoder', 'decoder', 'out_var1'), groups):
+      names = [n if isinstance(n, str) else n.decode('utf8') for n in group.attrs['weight_names']]
+      for name, h5_name in zip(weight_names(part, len(names)), names):
+        weights[name] = np.asarray(group[h5_name], dtype='float32')
+  return weights
+
+
+def load_weights(path):
+  '''{name: array} of an .npz export (save_npz) or of the Keras h5 weights file'''
+  if path.endswith('.npz'):
+    with np.load(path) as data:
+      return {name: data[name] for name in data.files}
+  return load_h5_weights(path)
+
+
+def save_npz(weights, path):
+  np.savez(path, **weights)
+
+
+def positional_encoding(position, d_model):
+  '''Same as models.positional_encoding, without TensorFlow'''
+  i = np.arange(d_model)[np.newaxis, :]
+  angle_rads = np.arange(position)[:, np.newaxis] / np.power(10000, (2 * (i // 2)) / np.float32(d_model))
+  angle_rads[:, 0::2] = np.sin(angle_rads[:, 0::2])
+  angle_rads[:, 1::2] = np.cos(angle_rads[:, 1::2])
+  return angle_rads.astype('float32')
+
+
+def softmax(x):
+  x = np.exp(x - x.max(axis=-1, keepdims=True))
+  return x / x.sum(axis=-1, keepdims=True)
+
+
+def layer_norm(x, gamma, beta):
+  mean = x.mean(axis=-1, keepdims=True)
+  var = np.square(x - mean).mean(axis=-1, keepdims=True)
+  return (x - mean) / np.sqrt(var + EPSILON) * gamma + beta
+
+
+class NumpyTransformer:
+  '''
+  Forward pass of the event based Transformer (Encoder, Decoder, their
+  MultiHeadAttention and the positional encoding of models.py) in NumPy,
+  for inference without TensorFlow. The weights are those of
+  ChordDurMel_Trans_w.h5 or of its .npz export; the query, key and value
+  projections of the self-attention are fused into one matrix.
+  '''
+
+  def __init__(self, weights, num_heads=8):
+    self.num_heads = num_heads
+    w = weights
+    self.enc_embedding = w['encoder/embedding']
+    self.dec_embedding = w['decoder/embedding']
+    self.enc_d_model = self.enc_embedding.shape[1]
+    self.d_model = self.dec_embedding.shape[1]
+    self.depth = self.d_model // num_heads
+    self.enc_pos = positional_encoding(MAX_POSITIONS, self.enc_d_model)
+    self.dec_pos = positional_encoding(MAX_POSITIONS, self.d_model)
+    self.out = (w['out/kernel'], w['out/bias'])
+
+    def fused(prefix, names):
+      return (np.concatenate([w[f'{prefix}{n}/kernel'] for n in names], axis=1),
+              np.concatenate([w[f'{prefix}{n}/bias'] for n in names]))
+
+    self.encoder_layers = []
+    for i in range(sum(1 for name in w if name.startswith('encoder/') and name.endswith('/self_query/kernel'))):
+      p = f'encoder/{i}/'
+      self.encoder_layers.append({
+        'qkv': fused(p + 'self_', ('query', 'key', 'value')),
+        'output': (w[p + 'self_output/kernel'], w[p + 'self_output/bias']),
+        'self_norm': (w[p + 'self_norm/gamma'], w[p + 'self_norm/beta']),
+        'ffn1': (w[p + 'ffn1/kernel'], w[p + 'ffn1/bias']),
+        'ffn2': (w[p + 'ffn2/kernel'], w[p + 'ffn2/bias']),
+        'ffn_norm': (w[p + 'ffn_norm/gamma'], w[p + 'ffn_norm/beta'])})
+    self.decoder_layers = []
+    for i in range(sum(1 for name in w if name.startswith('decoder/') and name.endswith('/self_query/kernel'))):
+      p = f'decoder/{i}/'
+      self.decoder_layers.append({
+        'qkv': fused(p + 'self_', ('query', 'key', 'value')),
+        'output': (w[p + 'self_output/kernel'], w[p + 'self_output/bias']),
+        'self_norm': (w[p + 'self_norm/gamma'], w[p + 'self_norm/beta']),
+        'cross_query': (w[p + 'cross_query/kernel'], w[p + 'cross_query/bias']),
+        'cross_kv': fused(p + 'cross_', ('key', 'value')),
+        'cross_output': (w[p + 'cross_output/kernel'], w[p + 'cross_output/bias']),
+        'ffn1': (w[p + 'ffn1/kernel'], w[p + 'ffn1/bias']),
+        'ffn2': (w[p + 'ffn2/kernel'], w[p + 'ffn2/bias']),
+        'ffn_norm': (w[p + 'ffn_norm/gamma'], w[p + 'ffn_norm/beta'])})
+
+  @classmethod
+  def from_file(cls, path, num_heads=8):
+    return cls(load_weights(path), num_heads)
+
+  def heads(self, x):
+    '''(batch, length, d_model) -> (batch, heads, length, depth)'''
+    return x.reshape(x.shape[0], x.shape[1], self.num_heads, -1).transpose(0, 2, 1, 3)
+
+  def join(self, x):
+    return x.transpose(0, 2, 1, 3).reshape(x.shape[0], x.shape[2], -1)
+
+  def encode(self, enc_inp):
+    '''
+    @param enc_inp: (batch, length) shifted encoder tokens, 0 is padding
+    @return: the encoder output and its mask, up to the last token of the batch
+    '''
+    mask = enc_inp != 0
+    length = int(np.flatnonzero(mask.any(axis=0)).max()) + 1 if mask.any() else 1
+    tokens, mask = enc_inp[:, :length].astype(int), mask[:, :length]
+    x = self.enc_embedding[tokens] * np.sqrt(np.float32(self.enc_d_model)) + self.enc_pos[:length]
+    padding = MASKED * (1. - mask.astype('float32'))[:, np.newaxis, np.newaxis, :]
+    for layer in self.encoder_layers:
+      q, k, v = np.split(x @ layer['qkv'][0] + layer['qkv'][1], 3, axis=-1)
+      scores = self.heads(q) @ self.heads(k).transpose(0, 1, 3, 2) - padding
+      attention = softmax(scores) @ self.heads(v)
+      attention *= mask[:, np.newaxis, :, np.newaxis]  # the query mask of keras Attention
+      attention = self.join(attention) @ layer['output'][0] + layer['output'][1]
+      x = layer_norm(x + attention, *layer['self_norm'])
+      dense = np.maximum(x @ layer['ffn1'][0] + layer['ffn1'][1], 0) @ layer['ffn2'][0] + layer['ffn2'][1]
+      x = layer_norm(x + dense, *layer['ffn_norm'])
+    return x, mask
+
+  def cross_cache(self, enc_output):
+    '''Per decoder layer (key, value) heads over the encoder output, (batch, heads, length, depth)'''
+    cross = []
+    for layer in self.decoder_layers:
+      k, v = np.split(enc_output @ layer['cross_kv'][0] + layer['cross_kv'][1], 2, axis=-1)
+      cross.append((self.heads(k), self.heads(v)))
+    return cross
+
+  def step(self, tokens, rows):
+    '''
+    Decodes the newest token of every row: its keys/values are written into
+    the cache of the rows at past_len, then past_len grows by one
+    @param tokens: (batch,) the newest shifted tokens
+    @return: (batch, vocab) the probabilities of the next token
+    '''
+    n = len(tokens)
+    positions = rows.past_len
+    rows.reserve(int(positions.max()) + 1)
+    length = int(positions.max()) + 1
+    x = self.dec_embedding[np.asarray(tokens, dtype=int)] * np.sqrt(np.float32(self.d_model)) + \
+      self.dec_pos[positions]
+    x = x[:, np.newaxis, :]  # (batch, 1, d_model)
+    self_padding = MASKED * (np.arange(length)[np.newaxis, :] > positions[:, np.newaxis]).astype('float32')
+    self_padding = self_padding[:, np.newaxis, np.newaxis, :]
+    cross_padding = MASKED * (1. - rows.enc_mask.astype('float32'))[:, np.newaxis, np.newaxis, :]
+    batch = np.arange(n)
+    for i, layer in enumerate(self.decoder_layers):
+      q, k, v = np.split(x @ layer['qkv'][0] + layer['qkv'][1], 3, axis=-1)
+      keys, values = rows.cache[i, 0], rows.cache[i, 1]
+      keys[batch, :, positions] = k.reshape(n, self.num_heads, self.depth)
+      values[batch, :, positions] = v.reshape(n, self.num_heads, self.depth)
+      scores = self.heads(q) @ keys[:, :, :length].transpose(0, 1, 3, 2) - self_padding
+      attention = self.join(softmax(scores) @ values[:, :, :length]) @ layer['output'][0] + layer['output'][1]
+      x = layer_norm(x + attention, *layer['self_norm'])
+
+      q = x @ layer['cross_query'][0] + layer['cross_query'][1]
+      cross_k, cross_v = rows.cross[i]
+      scores = self.heads(q) @ cross_k.transpose(0, 1, 3, 2) - cross_padding
+      attention = self.join(softmax(scores) @ cross_v) @ layer['cross_output'][0] + layer['cross_output'][1]
+      x = layer_norm(x + attention, *layer['self_norm'])
+
+      dense = np.maximum(x @ layer['ffn1'][0] + layer['ffn1'][1], 0) @ layer['ffn2'][0] + layer['ffn2'][1]
+      x = layer_norm(x + dense, *layer['ffn_norm'])
+    rows.past_len = positions + 1
+    return softmax(x[:, 0] @ self.out[0] + self.out[1])
+
+  def stepper(self, enc_inp, dec_sos_idx):
+    return NumpyTransformerStepper(self, enc_inp, dec_sos_idx)
+
+
+class KVRows:
+  '''
+  Per-row decoding state of the NumPy Transformer. The self-attention keys and
+  values live in one preallocated (layers, 2, rows, heads, capacity, depth)
+  buffer that a step writes into in place; it only grows (doubling) when a
+  row reaches its capacity. past_len is the number of cached tokens per row.
+  '''
+
+  def __init__(self, cache, past_len, cross, enc_mask):
+    self.cache = cache
+    self.past_len = past_len
+    self.cross = cross
+    self.enc_mask = enc_mask
+
+  def __len__(self):
+    return len(self.past_len)
+
+  def reserve(self, length):
+    capacity = self.cache.shape[4]
+    if length <= capacity:
+      return
+    while capacity < length:
+      capacity *= 2
+    cache = np.zeros(self.cache.shape[:4] + (capacity,) + self.cache.shape[5:], dtype=self.cache.dtype)
+    cache[:, :, :, :, :self.cache.shape[4]] = self.cache
+    self.cache = cache
+
+  def select(self, rows):
+    rows = np.asarray(rows, dtype=int)
+    if len(rows) == len(self) and (rows == np.arange(len(self))).all():
+      return self
+    return KVRows(self.cache[:, :, rows], self.past_len[rows], [(k[rows], v[rows]) for k, v in self.cross],
+                  self.enc_mask[rows])
+
+  def split(self, sizes):
+    if len(sizes) == 1:
+      return [self]
+    offsets = np.cumsum([0] + list(sizes))
+    return [self.select(np.arange(offsets[i], offsets[i + 1])) for i in range(len(sizes))]
+
+  @staticmethod
+  def merge(parts):
+    if len(parts) == 1:
+      return parts[0]
+    capacity = max(part.cache.shape[4] for part in parts)
+    enc_length = max(part.enc_mask.shape[1] for part in parts)
+
+    def pad(x, axis, length):
+      widths = [(0, 0)] * x.ndim
+      widths[axis] = (0, length - x.shape[axis])
+      return np.pad(x, widths) if length > x.shape[axis] else x
+
+    return KVRows(np.concatenate([pad(part.cache, 4, capacity) for part in parts], axis=2),
+                  np.concatenate([part.past_len for part in parts]),
+                  [tuple(np.concatenate([pad(part.cross[i][j], 2, enc_length) for part in parts])
+                         for j in range(2)) for i in range(len(parts[0].cross))],
+                  np.concatenate([pad(part.enc_mask, 1, enc_length) for part in parts]))
+
+
+class NumpyTransformerStepper:
+  '''TransformerStepper of the NumPy engine, the same start/step interface for generate_candidates'''
+
+  def __init__(self, engine, enc_inp, dec_sos_idx, capacity=64):
+    self.engine = engine
+    self.key = id(engine)  # rows of steppers with the same key can share a step
+    self.enc_inp = enc_inp
+    self.dec_sos_idx = dec_sos_idx
+    self.capacity = capacity
+    self.sos_pred = None
+
+  def prefill(self):
+    engine = self.engine
+    enc_output, enc_mask = engine.encode(self.enc_inp)
+    cache = np.zeros((len(engine.decoder_layers), 2, 1, engine.num_heads, self.capacity, engine.depth),
+                     dtype='float32')
+    self.sos_rows = KVRows(cache, np.zeros(1, dtype=int), engine.cross_cache(enc_output), enc_mask)
+    self.sos_pred = engine.step([self.dec_sos_idx], self.sos_rows)
+
+  def start(self, n):
+    if self.sos_pred is None:
+      self.prefill()
+    sos = self.sos_rows
+    rows = KVRows(np.repeat(sos.cache, n, axis=2), np.repeat(sos.past_len, n),
+                  [(np.repeat(k, n, axis=0), np.repeat(v, n, axis=0)) for k, v in sos.cross],
+                  np.repeat(sos.enc_mask, n, axis=0))
+    return np.repeat(self.sos_pred, n, axis=0), rows
+
+  def step(self, tokens, rows):
+    return self.engine.step(np.asarray(tokens) + 1, rows), rows
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Export the Transformer weights for the numpy backend')
+  parser.add_argument('--weights', default='app/aux_files/ChordDurMel_Trans_w.h5')
+  parser.add_argument('--out', default='app/aux_files/ChordDurMel_Trans_w.npz')
+  args = parser.parse_args()
+  save_npz(load_h5_weights(args.weights), args.out)
+  print(f'{args.weights} -> {args.out}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+
+class WarmPool:
+  '''
+  Lead sheets generated ahead of time for the popular parameter sets. Every
+  pooled key is kept filled up to depth ready items in the background, with
+  produce(params) -> (item, size in bytes), while the ready items of all keys
+  stay within max_bytes. take hands out an unused item (or None) and triggers
+  the refill. Keys are pooled when configured (add_key) or once they were
+  requested hot_after times, at most max_keys of them. A key whose
+  generation fails is refilled again after retry_delay seconds, doubled on
+  every further failure in a row, and dropped from the pool once it failed
+  max_failures times in a row (the last max_seen dropped keys are not pooled
+  again).
+  '''
+
+  def __init__(self, produce, depth=2, max_bytes=64 * 2 ** 20, hot_after=3, max_keys=16, workers=1,
+               max_seen=1024, max_failures=3, retry_delay=1.0):
+    self.produce = produce
+    self.depth = depth
+    self.max_bytes = max_bytes
+    self.hot_after = hot_after
+    self.max_keys = max_keys
+    self.max_seen = max_seen
+    self.max_failures = max_failures
+    self.retry_delay = retry_delay
+    self.params = {}  # pooled key: params it is generated with
+    self.ready = {}  # pooled key: deque of (item, size)
+    self.pending = {}  # pooled key: generations in flight
+    self.seen = OrderedDict()  # key: requests, most recent last
+    self.failing = {}  # pooled key: (failures in a row, time of the next attempt)
+    self.failed = OrderedDict()  # keys that are not pooled again, most recent last
+    self.bytes = 0
+    self.item_size = 0  # size of the last generated item, to budget the ones in flight
+    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='pregeneration')
+    self._futures = set()
+    self._lock = threading.Lock()
+    # stats
+    self.hits = 0
+    self.misses = 0
+    self.generated = 0
+    self.dropped = 0
+    self.failures = 0
+
+  def _pool(self, key, params):
+    if key not in self.params and key not in self.failed and len(self.params) < self.max_keys:
+      self.params[key] = params
+      self.ready.setdefault(key, deque())
+      self.pending.setdefault(key, 0)
+
+  def add_key(self, key, params):
+    '''Pool the key from the start (filled by start)'''
+    with self._lock:
+      self._pool(key, params)
+
+  def start(self):
+    for key in list(self.params):
+      self._refill(key)
+
+  def take(self, key, params):
+    with self._lock:
+      self.seen[key] = self.seen.pop(key, 0) + 1
+      if len(self.seen) > self.max_seen:
+        self.seen.popitem(last=False)
+      if self.seen[key] >= self.hot_after:
+        self._pool(key, params)
+      ready = self.ready.get(key)
+      item = None
+      if ready:
+        item, size = ready.popleft()
+        self.bytes -= size
+        self.hits += 1
+      else:
+        self.misses += 1
+    self._refill(key)
+    return item
+
+  def _refill(self, key):
+    with self._lock:
+      if key not in self.params:
+        return
+      if key in self.failing and time.monotonic() < self.failing[key][1]:
+        return  # backing off, the next take refills it
+      missing = self.depth - len(self.ready[key]) - self.pending[key]
+      for _ in range(missing):
+        if self.bytes + self.item_size * (sum(self.pending.values()) + 1) > self.max_bytes:
+          break
+        self.pending[key] += 1
+        future = self._executor.submit(self._fill, key, self.params[key])
+        self._futures.add(future)
+        future.add_done_callback(self._futures.discard)
+
+  def _fill(self, key, params):
+    try:
+      item, size = self.produce(params)
+    except Exception:
+      with self._lock:
+        self.failures += 1
+        self.pending[key] -= 1
+        if key not in self.params:
+          return
+        failures = self.failing.get(key, (0, 0))[0] + 1
+        self.failing[key] = (failures, time.monotonic() + self.retry_delay * 2 ** (failures - 1))
+        if failures >= self.max_failures:
+          self._drop(key)
+      return
+    with self._lock:
+      self.pending[key] -= 1
+      self.failing.pop(key, None)
+      self.item_size = size
+      if key not in self.params or self.bytes + size > self.max_bytes:
+        self.dropped += 1
+        return
+      self.ready[key].append((item, size))
+      self.bytes += size
+      self.generated += 1
+    self._refill(key)
+
+  def _drop(self, key):
+    # with the lock held: a key that keeps failing is not pooled again
+    self.failed[key] = True
+    if len(self.failed) > self.max_seen:
+      self.failed.popitem(last=False)
+    self.params.pop(key, None)
+    self.failing.pop(key, None)
+    while self.ready[key]:
+      self.bytes -= self.ready[key].popleft()[1]
+
+  def join(self, timeout=None):
+    '''Wait for the generations in flight (and the refills they trigger)'''
+    while self._futures:
+      done, _ = wait(list(self._futures), timeout)
+      if not done:
+        break
+
+  def status(self):
+    with self._lock:
+      requests = self.hits + self.misses
+      return {'keys': len(self.params), 'depth': self.depth,
+              'ready': sum(len(ready) for ready in self.ready.values()),
+              'pending': sum(self.pending.values()),
+              'bytes': self.bytes, 'max_bytes': self.max_bytes,
+              'hits': self.hits, 'misses': self.misses,
+              'hit_rate': round(self.hits / requests, 4) if requests else None,
+              'generated': self.generated, 'dropped': self.dropped, 'failures': self.failures,
+              'retrying': len(self.failing), 'blacklisted': list(self.failed)}
+
+
+def pool_from_env(produce):
+  '''
+  The warm pool, unless SITHSYNTH_POOL_DEPTH is 0 (the default). The keys of
+  SITHSYNTH_POOL_KEYS (a JSON list of /generate bodies) are pooled from the start.
+  @return: (pool, [params of the configured keys]) or (None, [])
+  '''
+  depth = int(os.environ.get('SITHSYNTH_POOL_DEPTH', 0))
+  if depth <= 0:
+    return None, []
+  pool = WarmPool(produce, depth=depth,
+                  max_bytes=int(float(os.environ.get('SITHSYNTH_POOL_MAX_MB', 64)) * 2 ** 20),
+                  hot_after=int(os.environ.get('SITHSYNTH_POOL_HOT_AFTER', 3)),
+                  max_keys=int(os.environ.get('SITHSYNTH_POOL_MAX_KEYS', 16)),
+                  workers=int(os.environ.get('SITHSYNTH_POOL_WORKERS', 1)),
+                  max_failures=int(os.environ.get('SITHSYNTH_POOL_MAX_FAILURES', 3)))
+  return pool, json.loads(os.environ.get('SITHSYNTH_POOL_KEYS', '[]'))
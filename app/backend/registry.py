@@ -0,0 +1,247 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from types import MappingProxyType
+from contextlib import contextmanager
+
+import numpy as np
+from app.backend.chords import ChordTable
+from app.backend.vocab import as_vocabularies
+from app.backend.templates import TemplateIndex
+from app.backend.tables import load_tables, load_vocabularies, load_templates
+from app.backend.numpy_transformer import NumpyTransformer
+from app.backend.decoding import DEC_BUCKETS, DEC_SEQ_LENGTH, ShapeBuckets, TransformerStepper
+from app.backend.utils import chord_trans_ev_model, chord_trans_ev_inf_model, chords_inf_model_ev, \
+  chords_sampler_ev
+
+ENCODERS_PATH = 'app/aux_files/chords_encoders_all.pickle'
+VAL_TEMPLATES_PATH = 'app/aux_files/Valence_Templates.pickle'
+DENSE_TEMPLATES_PATH = 'app/aux_files/Density_Templates.pickle'
+LSTM_PATH = 'app/aux_files/ChordDurMel_LSTM.h5'
+TRANSFORMER_PATH = 'app/aux_files/ChordDurMel_Trans_w.h5'
+TRANSFORMER_NPZ_PATH = 'app/aux_files/ChordDurMel_Trans_w.npz'  # see numpy_transformer.py
+TFLITE_DIR = 'app/aux_files'  # the exported models, see lite.py
+TABLES_PATH = 'app/aux_files/encoder_tables.bin'  # the encoders and templates, see tables.py
+
+# what the inference models run on. The numpy backend only has the Transformer,
+# the LSTM stays in Keras
+BACKENDS = ('keras', 'tflite', 'tflite_int8', 'numpy')
+MODELS = ('transformer', 'lstm')
+
+LSTM_dim = 768  # the size of units of the implemented LSTM layers
+LSTM_MAX_LENGTH = DEC_SEQ_LENGTH + 1  # the LSTM loop stops once more than dec_seq_length tokens were decoded
+
+
+def load_pickle(path):
+  with open(path, 'rb') as handle:
+    return pickle.load(handle)
+
+
+def file_sha256(path):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as handle:
+    for block in iter(lambda: handle.read(2 ** 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+
+def freeze_templates(templates):
+  '''Read-only view of the nested {length: {value: [template, ...]}} dicts'''
+  return MappingProxyType({lgt: MappingProxyType({val: tuple(tuple(t) for t in temps)
+                                                  for val, temps in per_val.items()})
+                           for lgt, per_val in templates.items()})
+
+
+def configure_threads(tf):
+  '''
+  The thread pools of the TensorFlow session, SITHSYNTH_INTRA_OP_THREADS and
+  SITHSYNTH_INTER_OP_THREADS (unset or 0: TensorFlow picks them)
+  '''
+  intra_op = int(os.environ.get('SITHSYNTH_INTRA_OP_THREADS', 0))
+  inter_op = int(os.environ.get('SITHSYNTH_INTER_OP_THREADS', 0))
+  if intra_op:
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+  if inter_op:
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+
+class ModelRegistry:
+  '''
+  Process-wide holder of the encoders, the conditioning templates and the
+  inference models. Everything is loaded once (at app startup) and then handed
+  to the requests read-only, so a request only pays for decoding and rendering.
+  The models run on the backend: Keras, their TFLite export (tflite, and
+  tflite_int8 with int8 weights) or NumPy (numpy, the Transformer only).
+  TensorFlow is only imported when a Keras model is loaded. The encoders and
+  templates are mapped from TABLES_PATH when it exists (without scikit-learn),
+  else unpickled.
+  '''
+
+  def __init__(self, backend='keras', buckets=DEC_BUCKETS):
+    if backend not in BACKENDS:
+      raise ValueError(f"unknown backend '{backend}', expected one of {', '.join(BACKENDS)}")
+    self.backend = backend
+    self.bucket_lengths = tuple(sorted(buckets))
+    if self.bucket_lengths and self.bucket_lengths[-1] < DEC_SEQ_LENGTH:
+      # the longest cache of a generation has a bucket, with no overflow past the last one
+      # (the TFLite steps only exist for the buckets)
+      self.bucket_lengths += (DEC_SEQ_LENGTH,)
+    self.TransEncoders = None
+    self.tables = None
+    self.vocabularies = None
+    self.val_templates = None
+    self.dense_templates = None
+    self.chord_table = None
+    self.models = {}
+    self.versions = {}
+    self.load_times = {}
+    self.buckets = None  # the cache lengths of the Transformer steps
+    self.graph = None
+    self.session = None
+    self._lock = threading.Lock()
+
+  def _timed(self, name, loader):
+    start = time.perf_counter()
+    value = loader()
+    self.load_times[name] = time.perf_counter() - start
+    return value
+
+  def load(self, models=MODELS, resident=True):
+    '''
+    Loads the encoders, the templates and the models. Without resident only
+    the versions of the models are computed, for a front end whose worker
+    processes hold the models (see workers.py).
+    '''
+    with self._lock:
+      if self.vocabularies is None and os.path.exists(TABLES_PATH):
+        # the tables stay memory-mapped, their pages are shared by the worker processes
+        self.tables = self._timed('tables', lambda: load_tables(TABLES_PATH))
+        self.vocabularies = self._timed('vocabularies', lambda: load_vocabularies(self.tables))
+        self.TransEncoders = self.vocabularies
+        self.val_templates = self._timed('val_templates', lambda: load_templates(self.tables, 'valence'))
+        self.dense_templates = self._timed('dense_templates', lambda: load_templates(self.tables, 'density'))
+      if self.vocabularies is None:
+        self.TransEncoders = self._timed('encoders', lambda: tuple(load_pickle(ENCODERS_PATH)))
+        # token <-> id maps of the encoder and decoder vocabularies
+        self.vocabularies = self._timed('vocabularies', lambda: as_vocabularies(self.TransEncoders))
+        # indexed by (value, minimum length) for the template selection
+        self.val_templates = self._timed('val_templates', lambda: TemplateIndex(
+          freeze_templates(load_pickle(VAL_TEMPLATES_PATH)), 'valence'))
+        self.dense_templates = self._timed('dense_templates', lambda: TemplateIndex(
+          freeze_templates(load_pickle(DENSE_TEMPLATES_PATH)), 'density'))
+      if self.chord_table is None:
+        # the chord symbols of the decoder vocabulary, parsed once for the renderers
+        self.chord_table = self._timed('chord_table',
+                                       lambda: ChordTable(self.vocabularies[1].tokens))
+
+      enc_vocab = len(self.vocabularies[0])
+      dec_vocab = len(self.vocabularies[1])
+      data = (TABLES_PATH,) if self.tables is not None else (ENCODERS_PATH, VAL_TEMPLATES_PATH, DENSE_TEMPLATES_PATH)
+      for name in models:
+        if name in self.models:
+          continue
+        weights = TRANSFORMER_PATH if name == 'transformer' else LSTM_PATH
+        if name == 'transformer' and self.backend == 'numpy' and os.path.exists(TRANSFORMER_NPZ_PATH):
+          weights = TRANSFORMER_NPZ_PATH  # the export loads faster than the h5 file
+        # the weights, encoders and templates a generation of the model depends on
+        if name not in self.versions:
+          self.versions[name] = self._timed(name + '_version', lambda: hashlib.sha256(''.join(
+            file_sha256(path) for path in (weights,) + data
+          ).encode('ascii')).hexdigest())
+        if not resident:
+          continue
+        if name == 'transformer' and self.backend == 'numpy':
+          self.models[name] = self._timed(name, lambda: (NumpyTransformer.from_file(weights), None))
+        else:
+          self._load_keras(name, enc_vocab, dec_vocab)
+        if self.backend.startswith('tflite'):
+          from app.backend.lite import lite_inference_models
+          self.models[name] = self._timed(name + '_' + self.backend, lambda: lite_inference_models(
+            name, self.models[name], self.backend == 'tflite_int8', TFLITE_DIR, self.versions[name], self.session))
+        if name == 'transformer' and self.buckets is not None:
+          self._timed(name + '_warm', self._warm_buckets)
+    return self
+
+  def _load_keras(self, name, enc_vocab, dec_vocab):
+    from app.backend.models import tf
+    if self.graph is None:
+      configure_threads(tf)
+      # all the Keras models live in the same graph/session, keep a handle so
+      # that requests served from other threads run against it
+      self.graph = tf.compat.v1.get_default_graph()
+      self.session = tf.compat.v1.keras.backend.get_session()
+    if name == 'transformer':
+      self.models[name] = self._timed(name, lambda: chord_trans_ev_inf_model(
+        chord_trans_ev_model(enc_vocab, dec_vocab, TRANSFORMER_PATH)))  # 2 Models
+      if self.bucket_lengths:
+        # the steps run with a few cache lengths, warmed (and exported) up front
+        self.buckets = ShapeBuckets(self.bucket_lengths)
+        self.models[name] += (self.buckets,)
+    else:  # Lstm
+      self.models[name] = self._timed(name, lambda: chords_inf_model_ev(
+        tf.keras.models.load_model(LSTM_PATH), LSTM_dim))  # 2 Models
+      # and the in-graph sampling loop of the unconstrained generations
+      self.models[name] += self._timed(name + '_sampler', lambda: (chords_sampler_ev(
+        self.models[name][1], self.vocabularies[1].id('eos'), LSTM_MAX_LENGTH),))
+
+  def _warm_buckets(self):
+    '''One Transformer step per bucket, on a minimal encoder input'''
+    enc_vocab = self.vocabularies[0]
+    enc_inp = np.zeros((1, 263))
+    enc_inp[0, :3] = [enc_vocab.shifted('sos'), enc_vocab.shifted('bar'), enc_vocab.shifted('eos')]
+    prefill, step, buckets = self.models['transformer']
+    with self.session_scope():
+      TransformerStepper(prefill, step, enc_inp, self.vocabularies[1].shifted('sos'), buckets).warm()
+
+  def get_model(self, model):
+    name = 'transformer' if model == 'transformer' else 'lstm'
+    if name not in self.models:
+      raise KeyError(f"model '{name}' is not resident")
+    return self.models[name]
+
+  def version(self, model):
+    '''Hash of the files the resident model generates from, and its backend'''
+    version = self.versions['transformer' if model == 'transformer' else 'lstm']
+    return version if self.backend == 'keras' else f'{version}-{self.backend}'
+
+  @contextmanager
+  def session_scope(self):
+    '''Run Keras predict calls against the graph/session the models were loaded in'''
+    if self.graph is None:  # no Keras model
+      yield
+      return
+    from app.backend.models import tf
+    with self.graph.as_default():
+      tf.compat.v1.keras.backend.set_session(self.session)
+      yield
+
+  def status(self):
+    return {
+      'resident': sorted(self.models),
+      'backend': self.backend,
+      'versions': dict(self.versions),
+      'load_seconds': {name: round(sec, 4) for name, sec in self.load_times.items()},
+    }
+
+
+def models_from_env():
+  '''The models to keep resident, SITHSYNTH_MODELS (comma separated, both by default)'''
+  models = tuple(name.strip() for name in os.environ.get('SITHSYNTH_MODELS', ','.join(MODELS)).split(','))
+  unknown = [name for name in models if name not in MODELS]
+  if unknown:
+    raise ValueError(f"unknown models {', '.join(unknown)}, expected some of {', '.join(MODELS)}")
+  return models
+
+
+def buckets_from_env():
+  '''
+  The cache lengths of SITHSYNTH_BUCKETS (comma separated, empty or 0 to grow
+  the caches by one). The registry adds DEC_SEQ_LENGTH when it is not the last.
+  '''
+  lengths = os.environ.get('SITHSYNTH_BUCKETS', ','.join(str(length) for length in DEC_BUCKETS))
+  return tuple(int(length) for length in lengths.split(',') if length.strip() and int(length) > 0)
+
+
+registry = ModelRegistry(backend=os.environ.get('SITHSYNTH_BACKEND', 'keras'), buckets=buckets_from_env())
@@ -0,0 +1,54 @@
+import numpy as np
+
+
+def scaled_logits(preds=None, temperature=1.0, logits=None):
+  '''log(preds) / temperature in float64, zero probabilities are -inf'''
+  if logits is None:
+    with np.errstate(divide='ignore'):
+      logits = np.log(np.asarray(preds, dtype='float64'))
+  return np.asarray(logits, dtype='float64') / temperature
+
+
+def truncate(logits, top_k=None, top_p=None):
+  '''
+  The logits outside of the top_k most likely tokens, or of the smallest set
+  (nucleus) whose probability reaches top_p, set to -inf. In place.
+  '''
+  if top_k is not None and top_k < logits.shape[-1]:
+    kth = np.partition(logits, -top_k, axis=-1)[:, -top_k]
+    logits[logits < kth[:, np.newaxis]] = -np.inf
+  if top_p is not None and top_p < 1.0:
+    order = np.argsort(-logits, axis=-1)
+    ordered = np.take_along_axis(logits, order, axis=-1)
+    probs = np.exp(ordered - ordered[:, :1])
+    probs /= probs.sum(axis=-1, keepdims=True)
+    # a token is kept while the more likely ones have not reached top_p yet
+    drop = np.cumsum(probs, axis=-1) - probs >= top_p
+    np.put_along_axis(logits, order, np.where(drop, -np.inf, ordered), axis=-1)
+  return logits
+
+
+def sample_batch(preds=None, temperature=1.0, mask=None, top_k=None, top_p=None, rng=None, logits=None):
+  '''
+  One token per row, drawn with the Gumbel-max trick: the argmax of the
+  scaled logits plus Gumbel noise is a sample of their softmax.
+  @param preds: (batch, vocab) probabilities, or logits instead
+  @param temperature: below 1.0 the network makes more "safe" predictions
+  @param mask: optional (batch, vocab) booleans, only the allowed tokens are
+               sampled. A row whose allowed probabilities all underflowed
+               samples them uniformly
+  @param top_k, top_p: optional truncation to the top_k tokens / the top_p nucleus
+  @param rng: optional np.random.Generator to draw from instead of np.random
+  @return: (batch,) the sampled indices
+  '''
+  logits = scaled_logits(preds, temperature, logits)
+  if mask is not None:
+    mask = np.asarray(mask, dtype=bool)
+    logits = np.where(mask, logits, -np.inf)
+    underflow = ~np.isfinite(logits).any(axis=-1)
+    if underflow.any():
+      logits[underflow] = np.where(mask[underflow], 0.0, -np.inf)
+  logits = truncate(logits, top_k, top_p)
+  uniform = (np.random if rng is None else rng).random(logits.shape)
+  with np.errstate(divide='ignore'):
+    return np.argmax(logits - np.log(-np.log(uniform)), axis=-1)
@@ -0,0 +1,173 @@
+import os
+import time
+import queue
+import threading
+from contextlib import nullcontext
+
+
+class _Entry:
+  '''A CandidateGroup waiting for, or taking part in, the shared decoder steps'''
+
+  def __init__(self, stepper, group):
+    self.stepper = stepper
+    self.group = group
+    self.rows = None
+    self.done = threading.Event()
+    self.error = None
+
+
+class DecodeScheduler:
+  '''
+  Continuous micro-batching of the decode work of all in-flight requests. A
+  single thread owns the decoder calls: the rows of every request that use the
+  same model are merged into one batched step, new requests join before the
+  next token and finished ones leave after it. Only a new batch waits, up to
+  max_wait_ms, for more rows; requests join a running batch without delaying
+  its steps. A failed step fails the requests of its batch.
+  '''
+
+  def __init__(self, max_batch_size=32, max_wait_ms=2.0, session_scope=None):
+    self.max_batch_size = max_batch_size
+    self.max_wait = max_wait_ms / 1000.0
+    self.session_scope = session_scope or nullcontext
+    self._pending = queue.Queue()
+    self._entries = []
+    self._thread = None
+    self._lock = threading.Lock()
+    # stats
+    self.steps = 0
+    self.tokens = 0
+    self.busy_seconds = 0.0
+
+  def run(self, stepper, group):
+    '''Decode the group with the shared steps, blocks until it is finished'''
+    entry = _Entry(stepper, group)
+    self._ensure_thread()
+    self._pending.put(entry)
+    entry.done.wait()
+    if entry.error is not None:
+      raise entry.error
+
+  def _ensure_thread(self):
+    with self._lock:
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._loop, name='decode-scheduler', daemon=True)
+        self._thread.start()
+
+  def _rows(self):
+    return sum(len(entry.group.active) for entry in self._entries)
+
+  def _admit(self):
+    # block while idle and wait up to max_wait for a new batch to fill, a running
+    # batch only takes the requests that are already pending
+    forming = not self._entries
+    deadline = time.perf_counter() + self.max_wait
+    while self._rows() < self.max_batch_size:
+      try:
+        if not forming:
+          entry = self._pending.get_nowait()
+        elif not self._entries:
+          entry = self._pending.get()
+        else:
+          timeout = deadline - time.perf_counter()
+          if timeout <= 0:
+            break
+          entry = self._pending.get(timeout=timeout)
+      except queue.Empty:
+        break
+      self._join(entry)
+
+  def _join(self, entry):
+    try:
+      preds, rows = entry.stepper.start(entry.group.num_candidates)
+      keep = entry.group.push(preds)
+      if not entry.group.finished:
+        entry.rows = rows.select(keep)
+    except Exception as e:
+      self._finish(entry, e)
+      return
+    if entry.group.finished:
+      self._finish(entry)
+    else:
+      self._entries.append(entry)
+
+  def _finish(self, entry, error=None):
+    entry.error = error
+    entry.done.set()
+
+  def _fail(self, entries, error):
+    for entry in entries:
+      if entry in self._entries:
+        self._entries.remove(entry)
+      self._finish(entry, error)
+
+  def _loop(self):
+    with self.session_scope():
+      while True:
+        try:
+          self._admit()
+          if not self._entries:
+            continue
+          # oldest request first, then every other request of the same model
+          key = self._entries[0].stepper.key
+          batch, rows = [], 0
+          for entry in self._entries:
+            if entry.stepper.key == key and (not batch or rows + len(entry.group.active) <= self.max_batch_size):
+              batch.append(entry)
+              rows += len(entry.group.active)
+          self._step(batch)
+        except Exception as e:
+          # never leave a request waiting on a loop that failed
+          self._fail(list(self._entries), e)
+
+  def _step(self, batch):
+    start = time.perf_counter()
+    try:
+      tokens = [token for entry in batch for token in entry.group.last_tokens()]
+      merged = type(batch[0].rows).merge([entry.rows for entry in batch])
+      preds, merged = batch[0].stepper.step(tokens, merged)
+      sizes = [len(entry.group.active) for entry in batch]
+      parts = merged.split(sizes)
+    except Exception as e:
+      self._fail(batch, e)
+      return
+
+    offset = 0
+    for entry, part in zip(batch, parts):
+      entry_preds = preds[offset:offset + len(part)]
+      offset += len(part)
+      try:
+        keep = entry.group.push(entry_preds)
+        if entry.group.finished:
+          self._entries.remove(entry)
+          self._finish(entry)
+        else:
+          entry.rows = part.select(keep)
+      except Exception as e:
+        self._fail([entry], e)
+
+    with self._lock:
+      self.steps += 1
+      self.tokens += len(tokens)
+      self.busy_seconds += time.perf_counter() - start
+
+  def status(self):
+    with self._lock:
+      return {
+        'max_batch_size': self.max_batch_size,
+        'max_wait_ms': self.max_wait * 1000.0,
+        'in_flight': len(self._entries),
+        'steps': self.steps,
+        'tokens': self.tokens,
+        'avg_batch_size': round(self.tokens / self.steps, 2) if self.steps else 0.0,
+        'tokens_per_sec': round(self.tokens / self.busy_seconds, 1) if self.busy_seconds else 0.0,
+      }
+
+
+def scheduler_from_env(session_scope=None):
+  '''The shared scheduler, unless SITHSYNTH_MICROBATCH=0'''
+  if os.environ.get('SITHSYNTH_MICROBATCH', '1') == '0':
+    return None
+  return DecodeScheduler(max_batch_size=int(os.environ.get('SITHSYNTH_MAX_BATCH', 32)),
+                         max_wait_ms=float(os.environ.get('SITHSYNTH_MAX_WAIT_MS', 2.0)),
+                         session_scope=session_scope)
@@ -0,0 +1,100 @@
+import json
+import argparse
+
+import numpy as np
+from app.backend.vocab import Vocabulary, as_vocabularies
+from app.backend.templates import MappedTemplates, template_arrays
+
+MAGIC = b'SSTABLE1'
+ALIGN = 64  # every array starts on a multiple of ALIGN bytes
+TEMPLATE_KINDS = ('valence', 'density')
+TEMPLATE_ARRAYS = ('keys', 'groups', 'offsets', 'values')
+
+
+def save_tables(arrays, path):
+  '''
+  The arrays in one file: MAGIC, the length of a JSON header (8 bytes, little
+  endian), the header ({name: [dtype, shape, offset]}), then the raw arrays,
+  each aligned so that load_tables maps them in place
+  '''
+  header, offset, blobs = {}, 0, []
+  for name, array in arrays.items():
+    array = np.ascontiguousarray(array)
+    header[name] = [array.dtype.str, list(array.shape), offset]
+    blobs.append((offset, array.tobytes()))
+    offset += -(-array.nbytes // ALIGN) * ALIGN
+  header = json.dumps(header).encode('utf-8')
+  start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+  with open(path, 'wb') as handle:
+    handle.write(MAGIC + len(header).to_bytes(8, 'little') + header)
+    for blob_offset, blob in blobs:
+      handle.seek(start + blob_offset)
+      handle.write(blob)
+    handle.truncate(start + offset)
+
+
+def load_tables(path):
+  '''
+  {name: array} of a save_tables file, read-only views of one memory map:
+  the pages are read on use and shared by every process that maps the file
+  '''
+  with open(path, 'rb') as handle:
+    if handle.read(len(MAGIC)) != MAGIC:
+      raise ValueError(f'{path} is not a tables file')
+    length = int.from_bytes(handle.read(8), 'little')
+    header = json.loads(handle.read(length).decode('utf-8'))
+  start = -(-(len(MAGIC) + 8 + length) // ALIGN) * ALIGN
+  data = np.memmap(path, dtype='uint8', mode='r')
+  arrays = {}
+  for name, (dtype, shape, offset) in header.items():
+    dtype = np.dtype(dtype)
+    count = int(np.prod(shape, dtype='int64'))
+    begin = start + offset
+    arrays[name] = data[begin:begin + count * dtype.itemsize].view(dtype).reshape(shape)
+  return arrays
+
+
+def encoder_tables(TransEncoders, templates):
+  '''
+  The arrays of the tables file: the token strings of the (encoder, decoder)
+  vocabularies, then template_arrays of the valence and density templates
+  '''
+  vocabularies = as_vocabularies(TransEncoders)
+  arrays = {'enc_tokens': np.array(vocabularies[0].tokens, dtype=str),
+            'dec_tokens': np.array(vocabularies[1].tokens, dtype=str)}
+  for kind, kind_templates in zip(TEMPLATE_KINDS, templates):
+    arrays.update({f'{kind}_{name}': array for name, array in
+                   zip(TEMPLATE_ARRAYS, template_arrays(kind_templates, kind))})
+  return arrays
+
+
+def load_vocabularies(tables):
+  '''(encoder, decoder) Vocabulary of the tables, as create_encoder_ev and the decoders take them'''
+  return (Vocabulary(tables['enc_tokens'], 'encoder vocabulary'),
+          Vocabulary(tables['dec_tokens'], 'decoder vocabulary'))
+
+
+def load_templates(tables, kind):
+  '''MappedTemplates of the valence or density templates of the tables'''
+  return MappedTemplates(*(tables[f'{kind}_{name}'] for name in TEMPLATE_ARRAYS), name=kind)
+
+
+def main():
+  # unpickling the encoders needs scikit-learn, loading the tables does not
+  from app.backend.registry import ENCODERS_PATH, VAL_TEMPLATES_PATH, DENSE_TEMPLATES_PATH, TABLES_PATH, \
+    load_pickle
+  parser = argparse.ArgumentParser(description='Convert the pickled encoders and templates to a tables file')
+  parser.add_argument('--encoders', default=ENCODERS_PATH)
+  parser.add_argument('--valence', default=VAL_TEMPLATES_PATH)
+  parser.add_argument('--density', default=DENSE_TEMPLATES_PATH)
+  parser.add_argument('--out', default=TABLES_PATH)
+  args = parser.parse_args()
+  arrays = encoder_tables(load_pickle(args.encoders), (load_pickle(args.valence), load_pickle(args.density)))
+  save_tables(arrays, args.out)
+  tables = load_tables(args.out)
+  print(f"{args.out}: {len(tables['enc_tokens'])} encoder and {len(tables['dec_tokens'])} decoder tokens, "
+        f"{len(tables['valence_offsets']) - 1} valence and {len(tables['density_offsets']) - 1} density templates")
+
+
+if __name__ == '__main__':
+  main()
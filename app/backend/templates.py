@@ -0,0 +1,110 @@
+import random
+
+import numpy as np
+
+MAX_TEMPLATE_LENGTH = 40  # the longest templates, in bars
+
+
+class TemplateIndex:
+  '''
+  The valence or density templates ({length: {value: [template, ...]}})
+  indexed by (value, minimum length): the template lists of every length
+  between the minimum and MAX_TEMPLATE_LENGTH that has templates of that
+  value. Sampling picks one of these lengths uniformly, then one of its
+  templates, which is the distribution of drawing randint(numOfBars, 40)
+  until the length has a template of the value.
+  '''
+
+  def __init__(self, templates, name='template', max_length=MAX_TEMPLATE_LENGTH):
+    self.name = name
+    self.max_length = max_length
+    per_value = {}
+    for lgt, per_val in templates.items():
+      for value, temps in per_val.items():
+        if len(temps):
+          per_value.setdefault(value, {})[int(lgt)] = tuple(tuple(t) for t in temps)
+    self.eligible = eligible_lists(per_value, max_length)
+
+  def sample(self, value, numOfBars, rng=random):
+    '''A template of at least numOfBars bars with the value, cut to numOfBars'''
+    lists = self.eligible.get((value, numOfBars))
+    if lists is None:
+      raise ValueError(f"no {self.name} template '{value}' of {numOfBars} to {self.max_length} bars")
+    return self.cut(rng.choice(rng.choice(lists)), numOfBars)
+
+  def cut(self, template, numOfBars):
+    return template[:numOfBars]
+
+
+class MappedTemplates(TemplateIndex):
+  '''
+  A TemplateIndex over the flat arrays of template_arrays (memory-mapped, see
+  tables.py): the template lists are ranges of template ids, and a sampled
+  template is read from values when it is cut. Draws the same templates as
+  the TemplateIndex of the same templates with the same rng.
+  '''
+
+  def __init__(self, keys, groups, offsets, values, name='template', max_length=MAX_TEMPLATE_LENGTH):
+    self.name = name
+    self.max_length = max_length
+    self.offsets = offsets
+    self.values = values
+    per_value = {}
+    for key, lgt, first, end in groups.tolist():
+      per_value.setdefault(str(keys[key]), {})[lgt] = range(first, end)
+    self.eligible = eligible_lists(per_value, max_length)
+
+  def cut(self, template, numOfBars):
+    start, end = int(self.offsets[template]), int(self.offsets[template + 1])
+    return tuple(self.values[start:min(end, start + numOfBars)].tolist())
+
+
+def eligible_lists(per_value, max_length):
+  '''{(value, minimum length): the template lists of the lengths it allows}'''
+  eligible = {}
+  for value, per_length in per_value.items():
+    for min_length in range(1, max_length + 1):
+      lists = tuple(temps for lgt, temps in sorted(per_length.items()) if min_length <= lgt <= max_length)
+      if lists:
+        eligible[value, min_length] = lists
+  return eligible
+
+
+def integer_entry(entry, name):
+  try:
+    if str(entry) == str(int(entry)):
+      return int(entry)
+  except (TypeError, ValueError):
+    pass
+  raise ValueError(f"{name} template entry {entry!r} is not an integer")
+
+
+def template_arrays(templates, name='template'):
+  '''
+  The {length: {value: [template, ...]}} templates as flat arrays: keys the
+  values (strings), groups a (key, length, first, end) row per template list,
+  offsets the start of each template in values (plus the end), values all
+  the templates one after the other, in the smallest integer type that holds
+  them. An entry whose str changes as an integer is a ValueError.
+  '''
+  keys, groups, offsets, values = {}, [], [0], []
+  for lgt, per_val in templates.items():
+    for value, temps in per_val.items():
+      if not len(temps):
+        continue
+      first = len(offsets) - 1
+      for template in temps:
+        values.extend(integer_entry(entry, name) for entry in template)
+        offsets.append(len(values))
+      groups.append((keys.setdefault(str(value), len(keys)), int(lgt), first, len(offsets) - 1))
+  return (np.array(list(keys), dtype=str), np.array(groups, dtype='int32').reshape(-1, 4),
+          np.array(offsets, dtype='int64'), np.array(values, dtype=smallest_int(values)))
+
+
+def smallest_int(values):
+  return next(dtype for dtype in ('int8', 'int16', 'int32', 'int64')
+              if not values or np.iinfo(dtype).min <= min(values) and max(values) <= np.iinfo(dtype).max)
+
+
+def as_template_index(templates, name='template'):
+  return templates if isinstance(templates, TemplateIndex) else TemplateIndex(templates, name)
@@ -1,22 +1,27 @@
+import time
 import requests
 import json
 
 BASE_URL = "http://localhost:8000"
 
-def test_generate_endpoint():
-    url = f"{BASE_URL}/generate"
-    payload = {
-        "temp": 0.7,
-        "timsig_n": 4,
-        "timsig_d": 4,
-        "num_bars": 8,
-        "val": "0",
-        "den": "med",
-        "modl": "transformer"
-    }
-    response = requests.post(url, json=payload)
+PAYLOAD = {
+    "temp": 0.7,
+    "timsig_n": 4,
+    "timsig_d": 4,
+    "num_bars": 8,
+    "val": "0",
+    "den": "med",
+    "modl": "transformer"
+}
+
+def generate(payload=PAYLOAD):
+    response = requests.post(f"{BASE_URL}/generate", json=payload)
     assert response.status_code == 200
-    data = response.json()
+    return response.json()
+
+def test_generate_endpoint():
+    data = generate()
+    assert "generation_id" in data
     assert "midi_file" in data
     assert "xml_file" in data
     print("Generate endpoint test passed!")
@@ -39,8 +44,81 @@ def test_xml_endpoint():
         f.write(response.content)
     print("XML endpoint test passed!")
 
+def test_generation_files():
+    data = generate()
+    generation_id = data["generation_id"]
+    assert data["midi_file"] == f"/midi/{generation_id}"
+    assert data["xml_file"] == f"/xml/{generation_id}"
+    midi = requests.get(f"{BASE_URL}/midi/{generation_id}")
+    assert midi.status_code == 200
+    assert midi.headers["content-type"] == "audio/midi"
+    assert midi.content.startswith(b"MThd")
+    xml = requests.get(f"{BASE_URL}/xml/{generation_id}")
+    assert xml.status_code == 200
+    assert xml.headers["content-type"] == "application/xml"
+    assert b"<score-partwise" in xml.content
+    # a later generation does not replace the files of this one
+    generate()
+    assert requests.get(f"{BASE_URL}/midi/{generation_id}").content == midi.content
+    print("Generation files test passed!")
+
+def test_unknown_generation():
+    assert requests.get(f"{BASE_URL}/midi/unknown").status_code == 404
+    assert requests.get(f"{BASE_URL}/xml/unknown").status_code == 404
+    print("Unknown generation test passed!")
+
+def test_job_endpoints():
+    payload = {
+        "temp": 0.7,
+        "timsig_n": 3,
+        "timsig_d": 4,
+        "num_bars": 8,
+        "val": "0",
+        "den": "med",
+        "modl": "lstm"
+    }
+    response = requests.post(f"{BASE_URL}/jobs", json=payload)
+    assert response.status_code == 202
+    job_id = response.json()["job_id"]
+    # the server stays responsive while the job runs
+    assert requests.get(f"{BASE_URL}/").status_code == 200
+    for _ in range(300):
+        status = requests.get(f"{BASE_URL}/jobs/{job_id}").json()["status"]
+        if status in ("done", "failed"):
+            break
+        time.sleep(1)
+    assert status == "done"
+    response = requests.get(f"{BASE_URL}/jobs/{job_id}/result")
+    assert response.status_code == 200
+    assert "midi_file" in response.json()
+    print("Job endpoints test passed!")
+
+def test_generate_all_candidates():
+    payload = {
+        "temp": 0.7,
+        "timsig_n": 4,
+        "timsig_d": 4,
+        "num_bars": 4,
+        "val": "0",
+        "den": "med",
+        "modl": "transformer",
+        "num_candidates": 4,
+        "return_all": True,
+        "formats": "tokens"
+    }
+    response = requests.post(f"{BASE_URL}/generate", json=payload)
+    assert response.status_code == 200
+    data = response.json()
+    assert 1 <= len(data["candidates"]) <= 4
+    assert data["candidates"][0] == data["tokens"]
+    print("All candidates test passed!")
+
 
 if __name__ == "__main__":
     test_generate_endpoint()
     test_midi_endpoint()
-    test_xml_endpoint()
\ No newline at end of file
+    test_xml_endpoint()
+    test_generation_files()
+    test_unknown_generation()
+    test_job_endpoints()
+    test_generate_all_candidates()
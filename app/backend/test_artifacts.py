@@ -0,0 +1,41 @@
+import time
+import threading
+
+from app.backend.artifacts import ArtifactStore
+
+
+def test_concurrent_fetches_render_once():
+    store = ArtifactStore()
+    store.put('gen', source='tokens')
+    calls = []
+
+    def render(source):
+        calls.append(source)
+        time.sleep(0.1)
+        return b'MThd'
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get_or_render('gen', 'music.mid', render)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == ['tokens']
+    assert [artifact.data for artifact in results] == [b'MThd'] * 4
+    assert store.get_or_render('gen', 'music.mid', render) is results[0]
+    assert store.get_or_render('unknown', 'music.mid', render) is None
+
+
+def test_failed_render_is_retried():
+    store = ArtifactStore()
+    store.put('gen', source='tokens')
+
+    def fail(source):
+        raise RuntimeError('render failed')
+
+    try:
+        store.get_or_render('gen', 'sheet.xml', fail)
+    except RuntimeError:
+        pass
+    assert store.get_or_render('gen', 'sheet.xml', lambda source: b'<score-partwise/>').size == 17
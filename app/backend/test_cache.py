@@ -0,0 +1,37 @@
+from app.backend.cache import ResultCache, cache_key
+
+SOURCE = (['bar', 'C', 'bar'], ['bar', '4.0', 'bar'], ['bar', '60', 'bar'], '[4, 4]', 'lstm')
+
+
+def test_key_covers_params_seed_and_version():
+    params = (1.0, 4, 4, 8, '0', '0', 'lstm', True, 1)
+    key = cache_key(params, 3, 'v1')
+    assert key == cache_key(list(params), 3, 'v1')
+    assert len({key, cache_key(params, 4, 'v1'), cache_key(params, 3, 'v2')}) == 3
+
+
+def test_entries_survive_a_restart(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get('k') is None
+    cache.put('k', SOURCE, {'music.mid': b'MThd', 'sheet.xml': b'<score/>'})
+    source, files = ResultCache(str(tmp_path)).get('k')
+    assert source == SOURCE
+    assert files == {'music.mid': b'MThd', 'sheet.xml': b'<score/>'}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=450)
+    for key in ('a', 'b', 'c'):
+        cache.put(key, SOURCE, {'music.mid': b'x' * 100})
+        cache.get('a')
+    assert sorted(cache.entries) == ['a', 'c']
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['a', 'c']
+
+
+def test_the_directory_is_created_on_first_put(tmp_path):
+    root = tmp_path / "cache"
+    cache = ResultCache(str(root))
+    assert cache.get('k') is None and cache.status()['entries'] == 0
+    assert not root.exists()
+    cache.put('k', SOURCE, {})
+    assert cache.get('k')[0] == SOURCE
@@ -0,0 +1,37 @@
+import pytest
+
+m21 = pytest.importorskip("music21")
+
+from app.backend.chords import ChordTable
+
+VOCABULARY = ['C', 'Am', 'G7', 'Dm7', 'E-7', 'C#m', 'F#dim', 'Gsus4', 'Cmaj7', 'C/E', 'A7b9', 'Cm7b5',
+              'F#m7/C#', 'Rest', '60', '1/3', '1.0', 'bar', 'eos', 'sos']
+
+
+def test_table_covers_only_chord_tokens():
+    table = ChordTable(VOCABULARY)
+    assert sorted(table.entries) == sorted(VOCABULARY[:13])
+
+
+@pytest.mark.parametrize("token", VOCABULARY[:13])
+def test_entries_match_music21(token):
+    entry = ChordTable(VOCABULARY)[token]
+    symbol = m21.harmony.ChordSymbol(token)
+    chord = m21.chord.Chord([p for p in symbol.pitches])
+    assert entry.name == chord.pitchedCommonName
+    assert entry.root == (symbol.root().step, int(symbol.root().alter))
+    bass = symbol.bass()
+    assert entry.bass == (None if bass.name == symbol.root().name else (bass.step, int(bass.alter)))
+    assert m21.harmony.CHORD_ALIASES.get(entry.kind, entry.kind) == symbol.chordKind
+    assert len(entry.degrees) == len(symbol.getChordStepModifications())
+    # the pitches of the chord once its symbol is in a measure, as in the lead sheet streams
+    symbol.writeAsChord = False
+    m21.stream.Measure().append(symbol)
+    assert entry.pitches == tuple(p.midi for p in chord.pitches)
+    assert [m21.pitch.Pitch(name).midi for name in entry.pitch_names] == list(entry.pitches)
+
+
+def test_unknown_tokens_are_parsed_on_first_use():
+    table = ChordTable(['C'])
+    assert table['B-m7'].name == m21.chord.Chord(m21.harmony.ChordSymbol('B-m7').pitches).pitchedCommonName
+    assert 'B-m7' in table.entries
@@ -0,0 +1,91 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("tensorflow")
+pytest.importorskip("music21")
+
+from app.backend.decoding import DecoderGrammar, IncrementalValidator
+from app.backend.utils import convert_to_ChordDurMels, generate_candidates, validation_check
+
+CATEGORIES = np.array(['C', 'Am', 'G7', 'Rest', '60', '62', '67', '0.5', '1.0', '1.5', '1/3', '2.0',
+                       'bar', 'eos', 'sos'])
+
+
+@pytest.mark.parametrize("timesig,numOfBars", [("[4, 4]", 4), ("[7, 8]", 6), ("[3, 4]", 16)])
+def test_grammar_samples_are_valid(timesig, numOfBars):
+    encoders = [None, SimpleNamespace(categories_=[CATEGORIES])]
+    grammar = DecoderGrammar(CATEGORIES, timesig, numOfBars, 359)
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        state = grammar.start()
+        dec_out = []
+        while not dec_out or dec_out[-1] != grammar.eos_idx:
+            allowed = np.flatnonzero(state.mask())
+            token = int(rng.choice(allowed))
+            state.advance(token)
+            dec_out.append(token)
+        assert len(dec_out) <= 359
+        allChords, allDurs, allMels = convert_to_ChordDurMels(dec_out, encoders)
+        assert validation_check(allChords, allDurs, allMels, timesig, numOfBars)
+
+
+def test_validator_only_aborts_invalid_attempts():
+    encoders = [None, SimpleNamespace(categories_=[CATEGORIES])]
+    timesig, numOfBars = "[4, 4]", 2
+    validator = IncrementalValidator(CATEGORIES, timesig, numOfBars)
+    grammar = DecoderGrammar(CATEGORIES, timesig, numOfBars, 359)
+    rng = np.random.default_rng(2)
+    for _ in range(200):
+        # mostly grammatical sequences with a few random tokens mixed in
+        state, checker = grammar.start(), validator.start()
+        dec_out, alive = [], True
+        while (not dec_out or dec_out[-1] != grammar.eos_idx) and len(dec_out) < 60:
+            allowed = np.flatnonzero(state.mask())
+            token = int(rng.choice(allowed if rng.random() > 0.05 else np.arange(len(CATEGORIES))))
+            if state.mask()[token]:
+                state.advance(token)
+            dec_out.append(token)
+            alive = alive and checker.push(token)
+        if not alive:
+            allChords, allDurs, allMels = convert_to_ChordDurMels(dec_out, encoders)
+            assert not validation_check(allChords, allDurs, allMels, timesig, numOfBars)
+
+
+def test_non_duration_tokens_fail_validation():
+    allChords = ['bar', 'C', 'bar']
+    allMels = ['bar', '60', 'bar']
+    assert validation_check(allChords, ['bar', '4.0', 'bar'], allMels, "[4, 4]", 1)
+    assert not validation_check(allChords, ['bar', 'C', 'bar'], allMels, "[4, 4]", 1)
+    assert not validation_check(allChords, ['bar', 'Rest', 'bar'], allMels, "[4, 4]", 1)
+
+
+class UniformRows:
+    def __init__(self, n):
+        self.n = n
+
+    def select(self, keep):
+        return UniformRows(len(keep))
+
+
+class UniformStepper:
+    '''Equal predictions for every token, the sampling alone decides'''
+
+    def start(self, num_candidates):
+        return np.full((num_candidates, len(CATEGORIES)), 1.0 / len(CATEGORIES)), UniformRows(num_candidates)
+
+    def step(self, tokens, rows):
+        return np.full((rows.n, len(CATEGORIES)), 1.0 / len(CATEGORIES)), rows
+
+
+def test_seeded_sampling_is_reproducible():
+    encoders = [None, SimpleNamespace(categories_=[CATEGORIES])]
+    timesig, numOfBars = "[4, 4]", 4
+    grammar = DecoderGrammar(CATEGORIES, timesig, numOfBars, 359)
+
+    def generate(seed):
+        return generate_candidates(UniformStepper(), 1.0, 3, grammar.eos_idx, 359, timesig, numOfBars, encoders,
+                                   359, grammar, return_all=True, rng=np.random.default_rng(seed))
+    assert generate(7) == generate(7)
+    assert generate(7) != generate(8)
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from app.backend.jobs import JobManager, QueueFull
+
+
+class GatedWork:
+    '''Blocks every job until released, fails the jobs whose params are "fail"'''
+
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Semaphore(0)
+
+    def __call__(self, params):
+        self.started.release()
+        assert self.release.wait(timeout=10)
+        if params == "fail":
+            raise ValueError("bad params")
+        return params * 2
+
+
+def test_jobs_go_through_queued_running_and_done():
+    work = GatedWork()
+    jobs = JobManager(work, workers=1)
+    first, second = jobs.submit(1), jobs.submit(2)
+    assert work.started.acquire(timeout=10)
+    assert (first.status, second.status) == ('running', 'queued')
+    assert jobs.status()['running'] == 1 and jobs.status()['queued'] == 1
+    assert first.info()['started'] is not None and second.info()['started'] is None
+    work.release.set()
+    assert [first.future.result(timeout=10), second.future.result(timeout=10)] == [2, 4]
+    assert (first.status, second.status, first.result) == ('done', 'done', 2)
+    assert jobs.get(first.id) is first and jobs.get('missing') is None
+
+
+def test_errors_are_stored_on_the_job():
+    work = GatedWork()
+    work.release.set()
+    job = JobManager(work, workers=1).submit("fail")
+    with pytest.raises(ValueError):
+        job.future.result(timeout=10)
+    assert job.status == 'failed' and isinstance(job.error, ValueError)
+    assert job.info()['error'] == 'bad params' and job.finished is not None
+
+
+def test_a_full_queue_rejects_jobs():
+    work = GatedWork()
+    jobs = JobManager(work, workers=1, max_queue=2)
+    jobs.submit(1)
+    assert work.started.acquire(timeout=10)
+    queued = [jobs.submit(2), jobs.submit(3)]
+    with pytest.raises(QueueFull):
+        jobs.submit(4)
+    work.release.set()
+    for job in queued:
+        job.future.result(timeout=10)
+    # room again once the queue drained
+    assert jobs.submit(5).future.result(timeout=10) == 10
+
+
+def test_only_the_last_finished_jobs_are_kept():
+    work = GatedWork()
+    work.release.set()
+    jobs = JobManager(work, workers=1, max_history=2)
+    finished = [jobs.submit(n) for n in range(4)]
+    for job in finished:
+        job.future.result(timeout=10)
+    latest = jobs.submit(4)
+    latest.future.result(timeout=10)
+    # pruned when the last job was submitted, before it finished
+    assert list(jobs.jobs) == [job.id for job in finished[2:]] + [latest.id]
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from app.backend.decoding import LSTMStepper, ShapeBuckets, TransformerStepper
+from app.backend.lite import ENC_SEQ_LENGTH, compare_steppers, lite_inference_models
+from app.backend.utils import chord_trans_ev_model, chord_trans_ev_inf_model, chords_inf_model_ev
+
+
+def lstm_model(enc_vocab, dec_vocab, dim):
+    '''The layers of ChordDurMel_LSTM.h5 that chords_inf_model_ev uses, untrained and small'''
+    layers = tf.keras.layers
+    enc_input = layers.Input(shape=(None,), name='input_var1')
+    dec_input = layers.Input(shape=(None,), name='input_var2')
+    x = layers.Embedding(enc_vocab + 1, 8, mask_zero=True, name='encoder_embedding')(enc_input)
+    states = []
+    for i in range(1, 4):
+        x, fh, fc, bh, bc = layers.Bidirectional(layers.LSTM(dim, return_sequences=True, return_state=True),
+                                                 name=f'encoder_blstm_{i}')(x)
+        states.append([layers.Concatenate()([fh, bh]), layers.Concatenate()([fc, bc])])
+    y = layers.Embedding(dec_vocab + 1, 8, mask_zero=True, name='decoder_embedding')(dec_input)
+    for i in range(1, 4):
+        y, _, _ = layers.LSTM(2 * dim, return_sequences=True, return_state=True,
+                              name=f'decoder_lstm_{i}')(y, initial_state=states[i - 1])
+    out = layers.Dense(dec_vocab, activation='softmax', name='out_var1')(y)
+    return tf.keras.models.Model([enc_input, dec_input], out)
+
+
+def encoder_input(enc_vocab):
+    enc_inp = np.zeros((1, ENC_SEQ_LENGTH))
+    enc_inp[0, :20] = np.random.default_rng(0).integers(1, enc_vocab + 1, 20)
+    return enc_inp
+
+
+def test_transformer_distributions_match_keras():
+    nnModel = chord_trans_ev_inf_model(chord_trans_ev_model(20, 30, weights=None))
+    lite = lite_inference_models('transformer', nnModel)
+    enc_inp = encoder_input(20)
+    report = compare_steppers(TransformerStepper(*nnModel, enc_inp, 1), TransformerStepper(*lite, enc_inp, 1),
+                              steps=12, batch=3)
+    assert report['max_tv'] < 1e-4
+
+
+@pytest.mark.parametrize("quantize,tolerance", [(False, 1e-4), (True, 0.05)])
+def test_lstm_distributions_match_keras(quantize, tolerance):
+    nnModel = chords_inf_model_ev(lstm_model(20, 30, 16), 16)
+    lite = lite_inference_models('lstm', nnModel, quantize)
+    enc_inp = encoder_input(20)
+    report = compare_steppers(LSTMStepper(*nnModel, enc_inp, 1), LSTMStepper(*lite, enc_inp, 1),
+                              steps=12, batch=3)
+    assert report['max_tv'] < tolerance
+
+
+def test_bucketed_transformer_steps_match_keras():
+    nnModel = chord_trans_ev_inf_model(chord_trans_ev_model(20, 30, weights=None))
+    lite = lite_inference_models('transformer', nnModel + (ShapeBuckets((8, 16)),), max_length=32)
+    assert sorted(lite[1].lites) == [8, 16, 32]
+    enc_inp = encoder_input(20)
+    # past the last bucket the caches are padded to 32
+    report = compare_steppers(TransformerStepper(*nnModel, enc_inp, 1),
+                              TransformerStepper(*lite[:2], enc_inp, 1, lite[2]), steps=20, batch=3)
+    assert report['max_tv'] < 1e-4
+
+
+def test_caches_longer_than_the_step_models_are_not_request_errors():
+    nnModel = chord_trans_ev_inf_model(chord_trans_ev_model(20, 30, weights=None))
+    lite = lite_inference_models('transformer', nnModel + (ShapeBuckets((8, 16)),), max_length=16)
+    assert sorted(lite[1].lites) == [8, 16]
+    with pytest.raises(RuntimeError, match='exceed'):
+        compare_steppers(TransformerStepper(*nnModel, encoder_input(20), 1),
+                         TransformerStepper(*lite[:2], encoder_input(20), 1, lite[2]), steps=20, batch=1)
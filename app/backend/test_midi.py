@@ -0,0 +1,211 @@
+import os
+import json
+
+import pytest
+
+m21 = pytest.importorskip("music21")
+
+from app.backend.midi import leadsheet_midi
+from app.backend.utils import chords_mel_mid, randomString, string_durs_to_float
+
+# (timesig, [(chord, duration, melody), ...] with None starting a new bar)
+PIECES = [
+    ("[4, 4]", [None, ('C', '1.0', '60'), ('C', '1.0', 'Rest'), ('Am', '1.0', '64'), ('G7', '1.0', '67'),
+                None, ('Dm7', '2.0', '62'), ('Dm7', '1/3', '62'), ('Rest', '5/3', 'Rest'),
+                None, ('E-7', '1.5', '63'), ('F#dim', '0.5', '66'), ('Gsus4', '2.0', 'eos')]),
+    ("[7, 8]", [None, ('Rest', '1.0', '72'), ('Rest', '0.5', '71'), ('F', '2.0', '69'),
+                None, ('F', '1/3', '60'), ('C#m', '2/3', '61'), ('Cmaj7', '2.5', 'Rest')]),
+]
+
+
+def static_conditions(events):
+    f_chords, f_durs, f_melody, f_bars = [], [], [], []
+    bar = False
+    for event in events:
+        if event is None:
+            bar = True
+            continue
+        f_chords.append(event[0])
+        f_durs.append(event[1])
+        f_melody.append(event[2])
+        f_bars.append('bar' if bar else 'no_bar')
+        bar = False
+    return f_chords, f_durs, f_bars, f_melody
+
+
+# chords_mel_mid as it was before the direct encoders, unchanged. It writes
+# app/generations/mid/music.mid and app/generations/xml/sheet.xml
+def baseline_chords_mel_mid(f_chords, f_durs, f_bars, allMelody, timesig, prefix):
+    # path for generations
+    midi_out = 'app/generations/mid/'
+    xml_out = 'app/generations/xml/'
+
+    # create the m21 instance for MIDI
+    rc = m21.stream.Stream()
+    # set tonality and tempo (default 120 tempo or set it to tempo21)
+    kf = m21.key.Key('C', 'major')
+    tempo21 = m21.tempo.MetronomeMark(number=100)
+    rc.append(kf)
+    rc.append(tempo21)
+    # create m21 instance for XML
+    rx = m21.stream.Stream()
+    rx.append(m21.text.TextBox(prefix + ' generation'))
+    # calculate all bars according to f_bars
+    all_bars = [index for index, value in enumerate(f_bars) if value == 'bar']
+    # add the last idx which is the len of the events
+    all_bars.append(len(f_bars))
+    melody = m21.stream.Part()
+    fl = m21.instrument.Flute()
+    melody.insert(0, fl)
+    chords = m21.stream.Part()
+    pp = m21.instrument.Piano()
+    chords.insert(0, pp)
+    melodyxml = m21.stream.Part()
+    melodyxml.insert(0, fl)
+    # get TimeSig nominator denominator
+    timesig = json.loads(timesig)
+    ts = m21.meter.TimeSignature(str(timesig[0]) + '/' + str(timesig[1]))
+
+    for m in range(0, len(all_bars) - 1):
+        # create measure
+        cho_m = m21.stream.Measure()
+        mel_m = m21.stream.Measure()
+        melxml_m = m21.stream.Measure()
+        if m == 0:
+            clef_s = m21.clef.TrebleClef()
+            clef_b = m21.clef.BassClef()
+            cho_m.insert(0, clef_b)
+            cho_m.insert(0, ts)
+            mel_m.insert(0, clef_s)
+            mel_m.insert(0, ts)
+            melxml_m.insert(0, clef_s)
+            melxml_m.insert(0, ts)
+
+        # for lead sheet only melody track will be given with chord symbols
+        bar_prev = all_bars[m]
+        bar_new = all_bars[m + 1]
+        # get the sum of durations
+        bar_durs = f_durs[bar_prev:bar_new]
+        bar_durs = string_durs_to_float(bar_durs)
+        # get the chord list for this bar
+        bar_chords = f_chords[bar_prev:bar_new]
+        bar_melody = allMelody[bar_prev:bar_new]
+        offset = 0.0
+        prevChord = ''
+        for b in range(0, len(bar_chords)):
+            cho = bar_chords[b]
+            dur = bar_durs[b]
+            mel = bar_melody[b]
+            if cho == 'Rest':
+                aChord_t = m21.note.Rest()
+                aChord_name = 'Rest'
+            else:
+                aChord_s = m21.harmony.ChordSymbol(cho)
+                pitchNames = [p for p in aChord_s.pitches]
+                aChord_t = m21.chord.Chord(pitchNames)
+                aChord_name = aChord_t.pitchedCommonName
+            if prevChord == aChord_name:
+                apC = cho_m.pop(-1)
+                apC.quarterLength += float(dur)
+                cho_m.append(apC)
+            else:
+                aChord_t.offset = offset
+                aChord_t.quarterLength = float(dur)
+                cho_m.append(aChord_t)
+                # append Chord Symbol if it is not rest
+                if aChord_name != 'Rest':
+                    aChord_s.offset = offset
+                    aChord_s.writeAsChord = False
+                    melxml_m.append(aChord_s)  # add the chord symbol to mel track
+                prevChord = aChord_name
+            if mel == 'Rest' or mel == 'eos':  # check if to create a Note or Rest and set offset
+                aNote = m21.note.Rest()
+            else:  # set pitch also
+                pitch = m21.pitch.Pitch()
+                pitch.midi = int(mel)
+                aNote = m21.note.Note()
+                aNote.pitch = pitch
+            # set onset and duration and append it
+            aNote.offset = offset
+            aNote.quarterLength = float(dur)
+            mel_m.append(aNote)
+            melxml_m.append(aNote)
+            offset = dur
+        ############################
+        # append the measures to the parts
+        chords.append(cho_m)
+        melody.append(mel_m)
+        melodyxml.append(melxml_m)
+    # append the parts to the MIDI and XML streams
+    # create end bar lines
+    # chords[-1].append(m21.bar.Barline(type='final'))
+    # melody[-1].append(m21.bar.Barline(type='final'))
+    # MIDI
+    rc.append(melody)
+    rc.append(chords)
+    # XML
+    rx.append(melodyxml)
+    rx.append(chords)
+    # get random string seed
+    rstr = randomString(5)
+    # first MIDI
+    mf = m21.midi.translate.streamToMidiFile(rc)
+    midiOut = midi_out + 'music.mid'
+    mf.open(midiOut, 'wb')
+    mf.write()
+    mf.close()
+    print(midiOut, ' has been generated!')
+    # then musicXML
+    mx = m21.musicxml.m21ToXml.GeneralObjectExporter(rx)
+    xmlOut = xml_out + 'sheet.xml'
+    mxText = mx.parse().decode('utf-8')
+    f = open(xmlOut, 'w')
+    f.write(mxText.strip())
+    f.close()
+    print(xmlOut, ' has been generated!')
+
+
+def midi_events(data):
+    mf = m21.midi.MidiFile()
+    mf.readstr(data)
+    notes, meta = [], set()
+    for track in mf.tracks:
+        tick, track_notes = 0, []
+        for event in track.events:
+            if isinstance(event, m21.midi.DeltaTime):
+                tick += event.time
+            elif event.type in ('NOTE_ON', 'NOTE_OFF'):
+                on = event.type == 'NOTE_ON' and event.velocity > 0
+                track_notes.append((tick, on, event.channel, event.pitch))
+            elif event.type in ('SET_TEMPO', 'TIME_SIGNATURE'):
+                meta.add((event.type, bytes(event.data)))
+        if track_notes:
+            notes.append(track_notes)
+    return mf.ticksPerQuarterNote, notes, meta
+
+
+def baseline_midi(f_chords, f_durs, f_bars, f_melody, timesig):
+    os.makedirs('app/generations/mid')
+    os.makedirs('app/generations/xml')
+    baseline_chords_mel_mid(f_chords, f_durs, f_bars, f_melody, timesig, 'transformer')
+    with open('app/generations/mid/music.mid', 'rb') as handle:
+        return handle.read()
+
+
+@pytest.mark.parametrize("timesig,events", PIECES)
+def test_midi_matches_the_baseline(timesig, events, tmp_path, monkeypatch):
+    f_chords, f_durs, f_bars, f_melody = static_conditions(events)
+    direct = leadsheet_midi(f_chords, f_durs, f_bars, f_melody, timesig)
+    monkeypatch.chdir(tmp_path)
+    reference = baseline_midi(f_chords, f_durs, f_bars, f_melody, timesig)
+    assert midi_events(direct) == midi_events(reference)
+    assert direct == reference
+
+
+@pytest.mark.parametrize("timesig,events", PIECES)
+def test_midi_does_not_depend_on_the_other_formats(timesig, events):
+    f_chords, f_durs, f_bars, f_melody = static_conditions(events)
+    alone = chords_mel_mid(f_chords, f_durs, f_bars, f_melody, timesig, 'transformer', formats=('midi',))
+    both = chords_mel_mid(f_chords, f_durs, f_bars, f_melody, timesig, 'transformer', formats=('midi', 'xml'))
+    assert alone.xml is None and both.xml is not None
+    assert alone.midi == both.midi
@@ -0,0 +1,130 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from app.backend.utils import chord_trans_ev_model, chord_trans_ev_inf_model
+
+
+def test_incremental_decoding_matches_full_decoder():
+    enc_vocab, dec_vocab = 20, 30
+    model = chord_trans_ev_model(enc_vocab, dec_vocab, weights=None)
+    prefill_model, step_model = chord_trans_ev_inf_model(model)
+
+    rng = np.random.default_rng(0)
+    enc_inp = np.concatenate([rng.integers(1, enc_vocab + 1, 12), np.zeros(6)]).reshape(1, -1)
+    dec_inp = rng.integers(1, dec_vocab + 1, 6)
+
+    prefill = prefill_model.predict([enc_inp, dec_inp[:1].reshape(1, 1)])
+    num_cache = (len(prefill) - 1) // 2
+    pred, past, cross = prefill[0], prefill[1:1 + num_cache], prefill[1 + num_cache:]
+    full = model.predict([enc_inp, dec_inp[:1].reshape(1, -1)])
+    np.testing.assert_allclose(pred[0, -1], full[0, -1], atol=1e-5)
+
+    for step in range(1, len(dec_inp)):
+        out = step_model.predict([dec_inp[step].reshape(1, 1), np.array(step).reshape(1, 1), enc_inp,
+                                  np.ones((1, step))] + past + cross)
+        pred, past = out[0], out[1:]
+        full = model.predict([enc_inp, dec_inp[:step + 1].reshape(1, -1)])
+        np.testing.assert_allclose(pred[0, -1], full[0, -1], atol=1e-5)
+
+
+def test_merged_rows_of_different_lengths_match_separate_steps():
+    from app.backend.decoding import TransformerRows, TransformerStepper
+
+    enc_vocab, dec_vocab = 20, 30
+    model = chord_trans_ev_model(enc_vocab, dec_vocab, weights=None)
+    prefill_model, step_model = chord_trans_ev_inf_model(model)
+
+    rng = np.random.default_rng(1)
+    steppers, rows = [], []
+    for length in (4, 1):
+        enc_inp = np.concatenate([rng.integers(1, enc_vocab + 1, 10), np.zeros(5)]).reshape(1, -1)
+        stepper = TransformerStepper(prefill_model, step_model, enc_inp, 1)
+        _, part = stepper.start(1)
+        for _ in range(length - 1):
+            _, part = stepper.step([int(rng.integers(0, dec_vocab))], part)
+        steppers.append(stepper)
+        rows.append(part)
+
+    tokens = [3, 7]
+    separate = [steppers[i].step([tokens[i]], rows[i])[0] for i in range(2)]
+    merged_preds, merged = steppers[0].step(tokens, TransformerRows.merge(rows))
+    np.testing.assert_allclose(merged_preds[0], separate[0][0], atol=1e-5)
+    np.testing.assert_allclose(merged_preds[1], separate[1][0], atol=1e-5)
+    assert list(merged.past_len) == [5, 2]
+
+
+def test_lstm_sampling_loop_matches_stepwise_decoding():
+    from app.backend.decoding import LSTMStepper
+    from app.backend.test_lite import encoder_input, lstm_model
+    from app.backend.utils import chords_inf_model_ev, chords_sampler_ev
+
+    eos, max_length = 28, 12
+    encoder, decoder = chords_inf_model_ev(lstm_model(20, 30, 16), 16)
+    stepper = LSTMStepper(encoder, decoder, encoder_input(20), 1, chords_sampler_ev(decoder, eos, max_length))
+
+    # a tiny temperature samples the most likely token, like the greedy steps
+    sampled = stepper.sample(2, 1e-8, np.array([0, 1]))
+    preds, rows = stepper.start(2)
+    greedy = []
+    while len(greedy) < max_length:
+        greedy.append(int(np.argmax(preds[0])))
+        if greedy[-1] == eos:
+            break
+        preds, rows = stepper.step([greedy[-1]] * 2, rows)
+    assert [list(row) for row in sampled] == [greedy, greedy]
+
+    seeded = [stepper.sample(3, 1.0, np.array([5, 6])) for _ in range(2)]
+    assert all(np.array_equal(a, b) for a, b in zip(*seeded))
+
+
+def test_lstm_sampling_loop_applies_the_grammar():
+    from app.backend.decoding import DecoderGrammar, LSTMStepper
+    from app.backend.test_lite import encoder_input, lstm_model
+    from app.backend.utils import chords_inf_model_ev, chords_sampler_ev
+
+    tokens = ['sos', 'eos', 'bar', 'C', 'G7', 'Am', 'F', 'Dm7', 'E7', '60', '62', '64', '65', '67', 'Rest',
+              '1.0', '2.0', '0.5', '1/3', '1.5', '3.0', '4.0', '0.25', '2/3', '0.75', 'Bb', 'Eb', 'A7', '69', '71']
+    grammar = DecoderGrammar(tokens, '[4, 4]', 2, 30)
+    eos = tokens.index('eos')
+    encoder, decoder = chords_inf_model_ev(lstm_model(20, 30, 16), 16)
+    stepper = LSTMStepper(encoder, decoder, encoder_input(20), 1, chords_sampler_ev(decoder, eos, 31))
+
+    # a tiny temperature samples the most likely allowed token, like the greedy masked steps
+    sampled = stepper.sample(2, 1e-8, np.array([0, 1]), grammar)
+    state, greedy = grammar.start(), []
+    preds, rows = stepper.start(2)
+    while not greedy or greedy[-1] != eos:
+        greedy.append(int(np.argmax(np.where(state.mask(), preds[0], -1))))
+        state.advance(greedy[-1])
+        preds, rows = stepper.step([greedy[-1]] * 2, rows)
+    assert [list(row) for row in sampled] == [greedy, greedy]
+
+    # every sampled sequence stays within the grammar, up to its eos
+    for row in stepper.sample(8, 1.0, np.array([2, 3]), grammar):
+        state = grammar.start()
+        for token in row:
+            assert state.mask()[token]
+            state.advance(token)
+        assert row[-1] == eos and len(row) <= 30
+
+
+def test_bucketed_steps_match_growing_caches():
+    from app.backend.decoding import ShapeBuckets, TransformerStepper
+    from app.backend.lite import compare_steppers
+    from app.backend.test_lite import encoder_input
+
+    prefill_model, step_model = chord_trans_ev_inf_model(chord_trans_ev_model(20, 30, weights=None))
+    enc_inp = encoder_input(20)
+    buckets = ShapeBuckets((4, 8, 16))
+    TransformerStepper(prefill_model, step_model, enc_inp, 1, buckets).warm()
+    report = compare_steppers(TransformerStepper(prefill_model, step_model, enc_inp, 1),
+                              TransformerStepper(prefill_model, step_model, enc_inp, 1, buckets), steps=20, batch=2)
+    assert report['max_tv'] < 1e-5
+    # the cache holds 1 to 20 tokens: 4 steps in bucket 4, 4 in 8, 8 in 16 and 4 past the last
+    # bucket, all of them padded to 32
+    assert buckets.status() == {'4': {'hits': 4, 'misses': 0}, '8': {'hits': 4, 'misses': 0},
+                                '16': {'hits': 8, 'misses': 0}, '>16': {'hits': 3, 'misses': 1}}
+    assert buckets.seen == {4, 8, 16, 32}
+    assert buckets.fit(33) == 48 and len(buckets.status()) == 4
@@ -0,0 +1,62 @@
+from fractions import Fraction
+
+import pytest
+
+m21 = pytest.importorskip("music21")
+
+from app.backend.chords import ChordTable, chord_spans
+from app.backend.musicxml import leadsheet_xml, note_type
+
+# (timesig, f_chords, f_durs, f_bars, f_melody)
+PIECES = [
+    ("[4, 4]", ['C', 'C', 'Am', 'G7', 'Dm7', 'Dm7', 'Rest', 'E-7', 'F#dim', 'Gsus4'],
+     ['1.0', '1.0', '1.0', '1.0', '2.0', '1/3', '5/3', '1.5', '0.5', '2.0'],
+     ['bar', 'no_bar', 'no_bar', 'no_bar', 'bar', 'no_bar', 'no_bar', 'bar', 'no_bar', 'no_bar'],
+     ['60', 'Rest', '64', '67', '62', '63', 'Rest', '70', '66', 'eos']),
+    ("[7, 8]", ['Rest', 'Rest', 'C/E', 'C/E', 'A7b9', 'F#m7/C#'],
+     ['1.0', '0.5', '2.0', '1/3', '2/3', '2.5'],
+     ['bar', 'no_bar', 'no_bar', 'bar', 'no_bar', 'no_bar'],
+     ['72', '71', '69', '61', 'Rest', '68']),
+]
+
+
+def offset(element, part):
+    return Fraction(element.getOffsetInHierarchy(part))
+
+
+@pytest.mark.parametrize("timesig,f_chords,f_durs,f_bars,f_melody", PIECES)
+def test_music21_reads_back_the_lead_sheet(timesig, f_chords, f_durs, f_bars, f_melody):
+    table = ChordTable(f_chords)
+    data = leadsheet_xml(f_chords, f_durs, f_bars, f_melody, timesig, 'transformer generation', table)
+    melody, piano = m21.converter.parse(data, format='musicxml').parts
+
+    notes = [(offset(n, melody), Fraction(n.quarterLength), n.pitch.midi if n.isNote else None)
+             for n in melody.recurse().notesAndRests if not isinstance(n, m21.harmony.ChordSymbol)]
+    expected, start = [], Fraction(0)
+    for dur, mel in zip(f_durs, f_melody):
+        expected.append((start, Fraction(dur), None if mel in ('Rest', 'eos') else int(mel)))
+        start += Fraction(dur)
+    assert notes == expected
+
+    spans = chord_spans(f_chords, f_durs, f_bars, table)
+    harmonies = [(offset(h, melody), h.root().name, h.bass().name, len(h.getChordStepModifications()))
+                 for h in melody.recurse().getElementsByClass('ChordSymbol')]
+    expected = []
+    for _, _, start, _, entry in spans:
+        if entry is not None:
+            symbol = m21.harmony.ChordSymbol(entry.token)
+            expected.append((start, symbol.root().name, symbol.bass().name, len(entry.degrees)))
+    assert harmonies == expected
+
+    chords = [(offset(c, piano), Fraction(c.quarterLength), () if c.isRest else tuple(p.midi for p in c.pitches))
+              for c in piano.recurse().notesAndRests]
+    assert chords == [(start, dur, () if entry is None else entry.pitches) for _, _, start, dur, entry in spans]
+
+
+@pytest.mark.parametrize("quarters", ['1.0', '1.5', '1.75', '1/3', '2/3', '5/3', '7/3', '19/12', '1/24'])
+def test_note_types_spell_the_duration(quarters):
+    name, dots, (actual, normal) = note_type(Fraction(quarters))
+    d = m21.duration.Duration(name, dots=dots)
+    if actual != normal:
+        d.appendTuplet(m21.duration.Tuplet(actual, normal))
+    assert Fraction(d.quarterLength) == Fraction(quarters)
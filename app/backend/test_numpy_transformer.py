@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("h5py")
+
+from app.backend.decoding import TransformerStepper
+from app.backend.lite import ENC_SEQ_LENGTH, compare_steppers
+from app.backend.numpy_transformer import KVRows, NumpyTransformer, load_weights, save_npz
+from app.backend.utils import chord_trans_ev_model, chord_trans_ev_inf_model
+
+
+def encoder_input(enc_vocab, length, seed=0):
+    enc_inp = np.zeros((1, ENC_SEQ_LENGTH))
+    enc_inp[0, :length] = np.random.default_rng(seed).integers(1, enc_vocab + 1, length)
+    return enc_inp
+
+
+@pytest.fixture(scope="module")
+def transformer(tmp_path_factory):
+    model = chord_trans_ev_model(20, 30, weights=None)
+    path = str(tmp_path_factory.mktemp("weights") / "transformer.h5")
+    model.save_weights(path)
+    return chord_trans_ev_inf_model(model), path
+
+
+def test_distributions_match_keras(transformer):
+    nnModel, path = transformer
+    engine = NumpyTransformer.from_file(path)
+    enc_inp = encoder_input(20, 20)
+    # past the 64 preallocated cache positions, so the buffer grows once
+    report = compare_steppers(TransformerStepper(*nnModel, enc_inp, 1), engine.stepper(enc_inp, 1),
+                              steps=70, batch=3)
+    assert report['max_tv'] < 1e-4
+
+
+def test_npz_export_has_the_h5_weights(transformer, tmp_path):
+    _, path = transformer
+    weights = load_weights(path)
+    save_npz(weights, str(tmp_path / "transformer.npz"))
+    exported = load_weights(str(tmp_path / "transformer.npz"))
+    assert sorted(exported) == sorted(weights)
+    assert all(np.array_equal(exported[name], weights[name]) for name in weights)
+
+
+def test_merged_rows_decode_like_separate_rows(transformer):
+    _, path = transformer
+    engine = NumpyTransformer.from_file(path)
+    steppers = [engine.stepper(encoder_input(20, 20, seed=0), 1), engine.stepper(encoder_input(20, 7, seed=1), 1)]
+    rows = [stepper.start(2)[1] for stepper in steppers]
+    for tokens in ([3, 4], [5, 6]):
+        rows[0] = steppers[0].step(tokens, rows[0])[1]
+    # the second request joins two tokens later, with a shorter encoder input
+    merged = KVRows.merge(rows)
+    preds, merged = steppers[0].step([7, 8, 9, 10], merged)
+    for stepper, part, tokens, expected in zip(steppers, rows, ([7, 8], [9, 10]), np.split(preds, 2)):
+        alone, _ = stepper.step(tokens, part)
+        np.testing.assert_allclose(alone, expected, atol=1e-6)
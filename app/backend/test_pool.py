@@ -0,0 +1,99 @@
+import threading
+
+from app.backend.pool import WarmPool
+
+
+def counting(size=10):
+    calls = []
+    lock = threading.Lock()
+
+    def produce(params):
+        with lock:
+            calls.append(params)
+            return f'{params}-{len(calls)}', size
+    return produce, calls
+
+
+def test_configured_keys_are_filled_and_served_once():
+    produce, calls = counting()
+    pool = WarmPool(produce, depth=2)
+    pool.add_key('a', 'A')
+    pool.start()
+    pool.join()
+    assert len(calls) == 2
+    first, second = pool.take('a', 'A'), pool.take('a', 'A')
+    assert first != second
+    pool.join()
+    # both were refilled in the background
+    assert pool.status()['ready'] == 2
+    assert pool.status()['hits'] == 2 and pool.status()['hit_rate'] == 1.0
+
+
+def test_keys_become_hot_after_repeated_requests():
+    produce, calls = counting()
+    pool = WarmPool(produce, depth=1, hot_after=2)
+    assert pool.take('b', 'B') is None
+    pool.join()
+    assert calls == []
+    assert pool.take('b', 'B') is None
+    pool.join()
+    assert pool.take('b', 'B') == 'B-1'
+    assert pool.status()['misses'] == 2
+
+
+def test_ready_items_stay_within_max_bytes():
+    produce, calls = counting(size=40)
+    pool = WarmPool(produce, depth=5, max_bytes=100)
+    pool.add_key('a', 'A')
+    pool.add_key('c', 'C')
+    pool.start()
+    pool.join()
+    status = pool.status()
+    assert status['bytes'] <= 100
+    assert status['ready'] == 2
+
+
+def test_failing_keys_are_dropped():
+    def produce(params):
+        raise ValueError('no template')
+    pool = WarmPool(produce, depth=2, hot_after=1, max_failures=2)
+    assert pool.take('d', 'D') is None
+    pool.join()
+    assert pool.take('d', 'D') is None
+    pool.join()
+    status = pool.status()
+    assert status['keys'] == 0 and status['failures'] == 2 and status['blacklisted'] == ['d']
+
+
+def test_a_transient_failure_keeps_the_key_pooled():
+    calls = []
+
+    def produce(params):
+        calls.append(params)
+        if len(calls) == 1:
+            raise TimeoutError('no worker result')
+        return f'{params}-{len(calls)}', 10
+    pool = WarmPool(produce, depth=1, retry_delay=0)
+    pool.add_key('e', 'E')
+    pool.start()
+    pool.join()
+    assert pool.status()['keys'] == 1 and pool.status()['retrying'] == 1
+    # the miss refills it, and the success clears the failure
+    assert pool.take('e', 'E') is None
+    pool.join()
+    assert pool.take('e', 'E') == 'E-2'
+    pool.join()
+    status = pool.status()
+    assert status['retrying'] == 0 and status['blacklisted'] == [] and status['ready'] == 1
+
+
+def test_failing_keys_back_off():
+    def produce(params):
+        raise TimeoutError('no worker result')
+    pool = WarmPool(produce, depth=1, hot_after=1, retry_delay=60)
+    pool.take('f', 'F')
+    pool.join()
+    pool.take('f', 'F')
+    pool.join()
+    # the second take is within the delay of the first failure
+    assert pool.status()['failures'] == 1 and pool.status()['keys'] == 1
@@ -0,0 +1,119 @@
+import pickle
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("music21")  # the registry parses the chord table of the renderers
+
+from app.backend import registry as registry_module
+from app.backend.decoding import DEC_SEQ_LENGTH, ShapeBuckets
+from app.backend.registry import ModelRegistry, buckets_from_env, models_from_env
+
+ENC_CATEGORIES = ['sos', 'eos', 'bar', '[4, 4]', 'start1', 'end1', '-', 0, 1, 2, 'low', 'med', 'high'] + \
+                 [f'e{i}' for i in range(7)]
+DEC_CATEGORIES = ['sos', 'eos', 'bar', 'C', 'G7', 'Am', 'F', 'Dm7', 'E7', '60', '62', '64', '65', '67', 'Rest',
+                  '1.0', '2.0', '0.5', '1/3', '1.5', '3.0', '4.0', '0.25', '2/3', '0.75', 'B-', 'E-', 'A7', '69',
+                  '71']
+TEMPLATES = {'4': {'1': [[1, 1, 1, 1]], 'med': [[1, 2, 0, 1]]}}
+
+
+@pytest.fixture
+def aux(tmp_path, monkeypatch):
+    '''Small encoders, templates and weights files in place of app/aux_files'''
+    def write(name, data):
+        path = tmp_path / name
+        path.write_bytes(data)
+        return str(path)
+    encoders = tuple(SimpleNamespace(categories_=[np.array(categories, dtype=object)])
+                     for categories in (ENC_CATEGORIES, DEC_CATEGORIES))
+    monkeypatch.setattr(registry_module, 'ENCODERS_PATH', write('encoders.pickle', pickle.dumps(encoders)))
+    monkeypatch.setattr(registry_module, 'VAL_TEMPLATES_PATH', write('val.pickle', pickle.dumps(TEMPLATES)))
+    monkeypatch.setattr(registry_module, 'DENSE_TEMPLATES_PATH', write('dense.pickle', pickle.dumps(TEMPLATES)))
+    monkeypatch.setattr(registry_module, 'TRANSFORMER_PATH', write('transformer.h5', b'transformer weights'))
+    monkeypatch.setattr(registry_module, 'LSTM_PATH', write('lstm.h5', b'lstm weights'))
+    monkeypatch.setattr(registry_module, 'TABLES_PATH', str(tmp_path / 'no_tables.bin'))
+    return tmp_path
+
+
+def test_encoders_and_templates_are_loaded_once(aux, monkeypatch):
+    loads = []
+
+    def load_pickle(path):
+        loads.append(path)
+        with open(path, 'rb') as handle:
+            return pickle.load(handle)
+    monkeypatch.setattr(registry_module, 'load_pickle', load_pickle)
+    registry = ModelRegistry().load((), resident=False)
+    vocabularies, templates = registry.vocabularies, registry.val_templates
+    registry.load((), resident=False)
+    assert len(loads) == 3
+    assert registry.vocabularies is vocabularies and registry.val_templates is templates
+    assert registry.vocabularies[1].id('eos') == 1
+    assert len(registry.chord_table) == 9  # the chord tokens but Rest
+
+
+def test_versions_follow_the_weights_files(aux):
+    registry = ModelRegistry().load(resident=False)
+    assert registry.status()['resident'] == []
+    versions = dict(registry.versions)
+    assert versions['transformer'] != versions['lstm']
+    assert ModelRegistry().load(resident=False).versions == versions
+    (aux / 'lstm.h5').write_bytes(b'retrained lstm weights')
+    changed = ModelRegistry().load(resident=False).versions
+    assert changed['lstm'] != versions['lstm'] and changed['transformer'] == versions['transformer']
+    # the backend is part of the version of a generation
+    assert ModelRegistry('tflite').load(resident=False).version('lstm') == changed['lstm'] + '-tflite'
+
+
+def test_models_that_are_not_resident_are_key_errors(aux):
+    registry = ModelRegistry().load(('lstm',), resident=False)
+    with pytest.raises(KeyError, match="'transformer' is not resident"):
+        registry.get_model('transformer')
+    with pytest.raises(KeyError, match="'lstm' is not resident"):
+        registry.get_model('lstm')
+
+
+def test_resident_models_are_loaded_once(aux, monkeypatch):
+    pytest.importorskip("tensorflow")
+    from app.backend.test_lite import lstm_model
+
+    lstm_model(len(ENC_CATEGORIES), len(DEC_CATEGORIES), 8).save(str(aux / 'lstm.h5'))
+    monkeypatch.setattr(registry_module, 'LSTM_dim', 8)
+    registry = ModelRegistry().load(('lstm',))
+    models, seconds = registry.get_model('lstm'), dict(registry.load_times)
+    assert len(models) == 3  # the encoder, the decoder and the sampling loop
+    registry.load(('lstm',))
+    assert registry.get_model('lstm') is models and registry.load_times == seconds
+    assert registry.get_model('lstm') is registry.get_model('anything but transformer')
+    assert registry.status()['resident'] == ['lstm']
+
+
+def test_models_from_env(monkeypatch):
+    monkeypatch.delenv("SITHSYNTH_MODELS", raising=False)
+    assert models_from_env() == ('transformer', 'lstm')
+    monkeypatch.setenv("SITHSYNTH_MODELS", " lstm ")
+    assert models_from_env() == ('lstm',)
+    monkeypatch.setenv("SITHSYNTH_MODELS", "transformer,gpt")
+    with pytest.raises(ValueError, match='unknown models gpt'):
+        models_from_env()
+
+
+def test_buckets_from_env(monkeypatch):
+    monkeypatch.delenv("SITHSYNTH_BUCKETS", raising=False)
+    assert buckets_from_env() == (16, 32, 64, 128, 256, DEC_SEQ_LENGTH)
+    monkeypatch.setenv("SITHSYNTH_BUCKETS", "32, 64,,0")
+    assert buckets_from_env() == (32, 64)
+    monkeypatch.setenv("SITHSYNTH_BUCKETS", "")
+    assert buckets_from_env() == ()
+
+
+def test_buckets_always_end_at_the_longest_cache(monkeypatch):
+    monkeypatch.setenv("SITHSYNTH_BUCKETS", "8,4")
+    registry = ModelRegistry(buckets=buckets_from_env())
+    assert registry.bucket_lengths == (4, 8, DEC_SEQ_LENGTH)
+    # the longest generation stays in a bucket, which the TFLite steps are exported for
+    assert ShapeBuckets(registry.bucket_lengths).fit(DEC_SEQ_LENGTH) == DEC_SEQ_LENGTH
+    assert ModelRegistry(buckets=(16, DEC_SEQ_LENGTH)).bucket_lengths == (16, DEC_SEQ_LENGTH)
+    monkeypatch.setenv("SITHSYNTH_BUCKETS", "0")
+    assert ModelRegistry(buckets=buckets_from_env()).bucket_lengths == ()
@@ -0,0 +1,45 @@
+import numpy as np
+
+from app.backend.sampling import sample_batch
+
+
+def frequencies(samples, vocab):
+    return np.bincount(samples.ravel(), minlength=vocab) / samples.size
+
+
+def test_samples_follow_the_tempered_distribution():
+    preds = np.array([0.5, 0.3, 0.15, 0.05, 0.0])
+    rng = np.random.default_rng(0)
+    for temperature in (1.0, 0.5, 2.0):
+        expected = preds ** (1 / temperature)
+        expected /= expected.sum()
+        samples = sample_batch(np.tile(preds, (20000, 1)), temperature, rng=rng)
+        np.testing.assert_allclose(frequencies(samples, 5), expected, atol=0.01)
+
+
+def test_mask_and_underflow():
+    rng = np.random.default_rng(1)
+    preds = np.array([[0.7, 0.3, 0.0, 0.0], [1.0, 0.0, 0.0, 0.0]])
+    mask = np.array([[False, True, True, False], [False, False, True, True]])
+    samples = np.stack([sample_batch(preds, 1.0, mask, rng=rng) for _ in range(2000)])
+    # the only allowed token with a probability, then the allowed ones uniformly
+    assert set(samples[:, 0]) == {1}
+    assert set(samples[:, 1]) == {2, 3}
+    assert abs((samples[:, 1] == 2).mean() - 0.5) < 0.05
+
+
+def test_top_k_and_top_p_truncate():
+    rng = np.random.default_rng(2)
+    preds = np.tile([0.4, 0.3, 0.2, 0.1], (5000, 1))
+    assert set(sample_batch(preds, top_k=2, rng=rng)) == {0, 1}
+    # 0.4 + 0.3 < 0.75, the nucleus needs the third token
+    assert set(sample_batch(preds, top_p=0.75, rng=rng)) == {0, 1, 2}
+    assert set(sample_batch(preds, top_p=0.7, rng=rng)) == {0, 1}
+    assert set(sample_batch(preds, top_k=3, top_p=0.1, rng=rng)) == {0}
+
+
+def test_logits_and_seeded_draws():
+    logits = np.log(np.array([[0.2, 0.8], [0.9, 0.1]]))
+    draws = [sample_batch(logits=logits, rng=np.random.default_rng(3)) for _ in range(2)]
+    np.testing.assert_array_equal(draws[0], draws[1])
+    assert draws[0].shape == (2,)
@@ -0,0 +1,166 @@
+import time
+import threading
+
+import numpy as np
+import pytest
+
+from app.backend.scheduler import DecodeScheduler
+
+
+class FakeRows:
+    '''The number of tokens each row has seen'''
+
+    def __init__(self, lengths):
+        self.lengths = list(lengths)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def select(self, rows):
+        return FakeRows(self.lengths[i] for i in rows)
+
+    def split(self, sizes):
+        parts, start = [], 0
+        for size in sizes:
+            parts.append(FakeRows(self.lengths[start:start + size]))
+            start += size
+        return parts
+
+    @staticmethod
+    def merge(parts):
+        return FakeRows(length for part in parts for length in part.lengths)
+
+
+class FakeStepper:
+    '''Predicts the length of each row, so a group can tell that it got its own rows back'''
+
+    def __init__(self, key='model', delay=0.0, fail_at=None):
+        self.key = key
+        self.delay = delay
+        self.fail_at = fail_at
+        self.batch_sizes = []
+
+    def start(self, n):
+        return np.zeros((n, 1)), FakeRows([0] * n)
+
+    def step(self, tokens, rows):
+        time.sleep(self.delay)
+        assert len(tokens) == len(rows)
+        self.batch_sizes.append(len(tokens))
+        if len(self.batch_sizes) == self.fail_at:
+            raise RuntimeError('step failed')
+        lengths = [length + 1 for length in rows.lengths]
+        return np.array(lengths, dtype=float)[:, np.newaxis], FakeRows(lengths)
+
+
+class FakeGroup:
+    '''num_candidates rows decoding length tokens each'''
+
+    def __init__(self, num_candidates, length, fail_at=None):
+        self.num_candidates = num_candidates
+        self.length = length
+        self.fail_at = fail_at
+        self.active = list(range(num_candidates))
+        self.finished = False
+        self.pushes = 0
+
+    def push(self, preds):
+        assert len(preds) == len(self.active)
+        np.testing.assert_array_equal(preds[:, 0], self.pushes)
+        if self.pushes == self.fail_at:
+            raise ValueError('push failed')
+        self.pushes += 1
+        self.finished = self.pushes > self.length
+        return list(range(len(self.active)))
+
+    def last_tokens(self):
+        return [self.pushes] * len(self.active)
+
+
+def run_in_thread(scheduler, stepper, group):
+    result = {}
+
+    def target():
+        try:
+            scheduler.run(stepper, group)
+        except Exception as e:
+            result['error'] = e
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread, result
+
+
+def wait(thread):
+    thread.join(timeout=10)
+    assert not thread.is_alive(), 'the request is still waiting'
+
+
+def test_requests_join_and_leave_a_running_batch():
+    scheduler, stepper = DecodeScheduler(max_wait_ms=0.0), FakeStepper(delay=0.001)
+    long, short = FakeGroup(3, 60), FakeGroup(2, 10)
+    first, first_result = run_in_thread(scheduler, stepper, long)
+    while len(stepper.batch_sizes) < 5:
+        time.sleep(0.001)
+    # joins with rows 5+ tokens shorter than the running ones
+    second, second_result = run_in_thread(scheduler, stepper, short)
+    wait(first)
+    wait(second)
+    assert first_result == {} and second_result == {}
+    assert long.pushes == 61 and short.pushes == 11
+    sizes = stepper.batch_sizes
+    assert sizes[:5] == [3] * 5 and sizes.count(5) == 10 and sizes[-1] == 3
+    assert scheduler.status()['in_flight'] == 0
+
+
+def test_a_lone_request_does_not_wait_between_steps():
+    scheduler, stepper = DecodeScheduler(max_wait_ms=50.0), FakeStepper()
+    start = time.perf_counter()
+    thread, result = run_in_thread(scheduler, stepper, FakeGroup(1, 40))
+    wait(thread)
+    # only the new batch waited for more rows, not each of the 40 steps
+    assert result == {} and time.perf_counter() - start < 0.5
+
+
+def test_a_failed_step_fails_its_batch_only():
+    scheduler = DecodeScheduler(max_wait_ms=20.0)
+    failing, other = FakeStepper(fail_at=3), FakeStepper(key='other')
+    threads = [run_in_thread(scheduler, failing, FakeGroup(2, 10)), run_in_thread(scheduler, failing, FakeGroup(1, 10)),
+               run_in_thread(scheduler, other, FakeGroup(1, 10))]
+    for thread, _ in threads:
+        wait(thread)
+    errors = [result.get('error') for _, result in threads]
+    assert all(isinstance(error, RuntimeError) for error in errors[:2]) and errors[2] is None
+    # the scheduler keeps serving
+    thread, result = run_in_thread(scheduler, failing, FakeGroup(1, 5))
+    wait(thread)
+    assert result == {}
+
+
+def test_a_failed_push_fails_its_request_only():
+    scheduler, stepper = DecodeScheduler(max_wait_ms=20.0), FakeStepper()
+    failing, ok = run_in_thread(scheduler, stepper, FakeGroup(1, 10, fail_at=4)), \
+        run_in_thread(scheduler, stepper, FakeGroup(2, 10))
+    wait(failing[0])
+    wait(ok[0])
+    assert isinstance(failing[1]['error'], ValueError) and ok[1] == {}
+
+
+def test_unexpected_errors_reach_the_waiting_requests():
+    class BrokenRows(FakeRows):
+        def split(self, sizes):
+            raise IndexError('split failed')
+
+    class BrokenStepper(FakeStepper):
+        def start(self, n):
+            return np.zeros((n, 1)), BrokenRows([0] * n)
+
+        def step(self, tokens, rows):
+            preds, rows = super().step(tokens, rows)
+            return preds, BrokenRows(rows.lengths)
+
+    scheduler = DecodeScheduler()
+    thread, result = run_in_thread(scheduler, BrokenStepper(), FakeGroup(2, 10))
+    wait(thread)
+    assert isinstance(result['error'], IndexError)
+    with pytest.raises(ValueError):
+        scheduler.run(FakeStepper(), FakeGroup(1, 3, fail_at=0))
@@ -0,0 +1,71 @@
+import random
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.backend.tables import encoder_tables, load_tables, load_templates, load_vocabularies, save_tables
+from app.backend.templates import TemplateIndex
+
+ENC_CATEGORIES = np.array(['sos', 'eos', 'bar', '[4, 4]', 'start1', 'start2', 'end1', 'end2', '-', 0, 1, 2,
+                           'low', 'med', 'high'], dtype=object)
+DEC_CATEGORIES = np.array(['sos', 'eos', 'bar', 'C', 'G7', 'Dur_4'], dtype=object)
+VALENCE = {
+    '4': {'1': [[1, 1, 1, 1]], '2': [[2, 2, 2, 2]]},
+    '8': {'1': [[1] * 8, [0] * 8], '2': []},
+    '39': {'2': [[2] * 39]},
+    '41': {'1': [[1] * 41]},
+}
+DENSITY = {'4': {'med': [[1, 2, 0, 1]], 'low': [[0, 0, 0, 0]]}, '12': {'med': [[2] * 12, [1] * 12]}}
+
+
+def encoders():
+    return (SimpleNamespace(categories_=[ENC_CATEGORIES]), SimpleNamespace(categories_=[DEC_CATEGORIES]))
+
+
+@pytest.fixture
+def tables(tmp_path):
+    path = str(tmp_path / "tables.bin")
+    save_tables(encoder_tables(encoders(), (VALENCE, DENSITY)), path)
+    return load_tables(path)
+
+
+def test_arrays_are_mapped_read_only(tmp_path):
+    arrays = {"a": np.arange(5, dtype="int32"), "b": np.array(["x", "yz"]), "c": np.zeros((0, 4), dtype="int32")}
+    save_tables(arrays, str(tmp_path / "arrays.bin"))
+    loaded = load_tables(str(tmp_path / "arrays.bin"))
+    for name, array in arrays.items():
+        np.testing.assert_array_equal(loaded[name], array)
+        assert loaded[name].dtype == array.dtype and not loaded[name].flags.writeable
+    assert isinstance(loaded["a"], np.memmap)
+
+
+def test_encoder_input_matches_the_pickles(tables):
+    # utils imports music21 through the renderers
+    pytest.importorskip("music21")
+    from app.backend.utils import create_encoder_ev
+
+    vocabularies = load_vocabularies(tables)
+    assert vocabularies[1].tokens == tuple(str(t) for t in DEC_CATEGORIES)
+    templates = (load_templates(tables, 'valence'), load_templates(tables, 'density'))
+    for seed in range(20):
+        for valence, density, bars in (('1', 'med', 3), ('2', 'low', 4), ('2', 'med', 10)):
+            expected = create_encoder_ev(encoders(), '[4, 4]', bars, VALENCE, DENSITY, valence, density,
+                                         random.Random(seed))
+            assert create_encoder_ev(vocabularies, '[4, 4]', bars, *templates, valence, density,
+                                     random.Random(seed)) == expected
+
+
+def test_mapped_templates_draw_like_the_template_index(tables):
+    index, mapped = TemplateIndex(VALENCE, 'valence'), load_templates(tables, 'valence')
+    assert mapped.eligible.keys() == index.eligible.keys()
+    rng, mapped_rng = random.Random(4), random.Random(4)
+    for value, numOfBars in [('1', 3), ('1', 8), ('2', 30), ('2', 1)] * 50:
+        assert mapped.sample(value, numOfBars, mapped_rng) == index.sample(value, numOfBars, rng)
+    with pytest.raises(ValueError, match='no valence template'):
+        mapped.sample('1', 9)
+
+
+def test_non_integer_entries_are_rejected():
+    with pytest.raises(ValueError, match="'0.5' is not an integer"):
+        encoder_tables(encoders(), ({'4': {'1': [['0.5'] * 4]}}, DENSITY))
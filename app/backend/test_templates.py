@@ -0,0 +1,36 @@
+import random
+from collections import Counter
+
+import pytest
+
+from app.backend.templates import TemplateIndex
+
+TEMPLATES = {
+    '4': {'1': [[1, 1, 1, 1]], '2': [[2, 2, 2, 2]]},
+    '8': {'1': [[1] * 8, [0] * 8], '2': []},
+    '39': {'2': [[2] * 39]},
+    '41': {'1': [[1] * 41]},
+}
+
+
+def test_samples_are_cut_to_the_number_of_bars():
+    index = TemplateIndex(TEMPLATES)
+    rng = random.Random(0)
+    for _ in range(20):
+        assert len(index.sample('1', 4, rng)) == 4
+    assert index.sample('2', 30, rng) == (2,) * 30
+
+
+def test_lengths_then_templates_are_uniform():
+    index = TemplateIndex(TEMPLATES)
+    rng = random.Random(1)
+    counts = Counter(index.sample('1', 3, rng) for _ in range(4000))
+    # length 4 and 8 are equally likely, then both templates of length 8
+    assert counts[(1, 1, 1)] == pytest.approx(2000 + 1000, rel=0.1)
+    assert counts[(0, 0, 0)] == pytest.approx(1000, rel=0.15)
+
+
+@pytest.mark.parametrize("value,numOfBars", [('1', 9), ('2', 40), ('3', 4)])
+def test_missing_templates_fail_fast(value, numOfBars):
+    with pytest.raises(ValueError, match='no valence template'):
+        TemplateIndex(TEMPLATES, 'valence').sample(value, numOfBars)
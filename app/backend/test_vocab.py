@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from app.backend.vocab import Vocabulary, as_vocabularies
+
+ENC_CATEGORIES = np.array(['-', '0.25', '0.5', '[3, 4]', '[4, 4]', 'bar', 'end1', 'end2', 'eos', 'sos',
+                           'start1', 'start2'])
+DEC_CATEGORIES = np.array(['C', 'Am', '60', '1.0', '1/3', 'bar', 'eos', 'sos'])
+
+
+def encoders():
+    return (SimpleNamespace(categories_=[ENC_CATEGORIES]), SimpleNamespace(categories_=[DEC_CATEGORIES]))
+
+
+def test_ids_match_the_category_positions():
+    enc, dec = as_vocabularies(encoders())
+    for vocab, categories in ((enc, ENC_CATEGORIES), (dec, DEC_CATEGORIES)):
+        assert len(vocab) == len(categories)
+        for token in categories:
+            idx = int(np.where(categories == token)[0])
+            assert vocab.id(token) == idx
+            assert vocab.shifted(token) == idx + 1
+            assert vocab.token(idx) == token
+    assert (dec.sos, dec.eos, dec.bar) == (7, 6, 5)
+
+
+def test_vocabularies_are_passed_through():
+    vocabs = as_vocabularies(encoders())
+    assert as_vocabularies(vocabs) == vocabs
+    assert as_vocabularies((None, vocabs[1]))[0] is None
+
+
+def test_unknown_tokens_fail_clearly():
+    vocab = Vocabulary(ENC_CATEGORIES, 'encoder vocabulary')
+    assert '[7, 8]' not in vocab
+    with pytest.raises(ValueError, match=r"'\[7, 8\]' is not a token of the encoder vocabulary"):
+        vocab.shifted('[7, 8]')
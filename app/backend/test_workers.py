@@ -0,0 +1,106 @@
+import os
+import time
+
+import pytest
+
+from app.backend.workers import WorkerError, WorkerPool, parse_cpus, split_cpus
+
+
+# the work of the test workers, imported by name in the worker processes
+def square(x):
+    return x * x
+
+
+def fail(message):
+    raise ValueError(message)
+
+
+def environment():
+    return sorted(os.sched_getaffinity(0)), os.environ["SITHSYNTH_INTRA_OP_THREADS"], os.environ["SITHSYNTH_WORKERS"]
+
+
+def crash_or_echo(x):
+    if x == "crash":
+        os._exit(3)
+    return x
+
+
+def sleep(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def dispatch(name, *args):
+    return globals()[name](*args)
+
+
+@pytest.fixture
+def pool():
+    pool = WorkerPool("app.backend.test_workers:dispatch", workers=2, cpu_sets=[[0], [0]], intra_op=1,
+                      restart_delay=0.1).start()
+    # the spawned workers import the test module before they take tasks
+    deadline = time.monotonic() + 60
+    while pool.status()["ready"] < 2 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert pool.status()["ready"] == 2
+    yield pool
+    pool.close()
+
+
+def test_results_and_exceptions(pool):
+    futures = [pool.submit("square", x) for x in range(6)]
+    assert [future.result(timeout=60) for future in futures] == [x * x for x in range(6)]
+    with pytest.raises(ValueError, match="bad input"):
+        pool.submit("fail", "bad input").result(timeout=60)
+    assert pool.status()["done"] == 6 and pool.status()["failed"] == 1
+
+
+def test_workers_are_pinned_and_configured(pool):
+    assert pool.submit("environment").result(timeout=60) == ([0], "1", "0")
+
+
+def test_exited_worker_is_restarted(pool):
+    with pytest.raises(WorkerError):
+        pool.submit("crash_or_echo", "crash").result(timeout=60)
+    assert [pool.submit("crash_or_echo", x).result(timeout=60) for x in range(4)] == list(range(4))
+    assert pool.status()["restarts"] == 1
+
+
+def test_a_killed_worker_fails_the_task_it_holds(pool):
+    futures = [pool.submit("sleep", 2), pool.submit("sleep", 2), pool.submit("square", 3)]
+    while pool.status()["running"] < 2:
+        time.sleep(0.01)
+    holding = pool.holding[0]
+    pool.processes[0].kill()
+    with pytest.raises(WorkerError):
+        futures[holding].result(timeout=60)
+    # the queued task goes to the restarted worker
+    assert futures[2].result(timeout=60) == 9
+    assert pool.status()["restarts"] == 1
+
+
+def test_other_workers_serve_while_one_restarts(pool):
+    pool.restart_delay = 5
+    with pytest.raises(WorkerError):
+        pool.submit("crash_or_echo", "crash").result(timeout=60)
+    start = time.monotonic()
+    assert [pool.submit("square", x).result(timeout=60) for x in range(4)] == [0, 1, 4, 9]
+    assert time.monotonic() - start < 2 and pool.status()["ready"] == 1
+
+
+def test_run_times_out_and_drops_queued_tasks(pool):
+    pool.timeout = 0.2
+    busy = [pool.submit("sleep", 1) for _ in range(2)]
+    with pytest.raises(TimeoutError):
+        pool.run("square", 4)
+    assert pool.status()["queued"] == 1
+    assert [future.result(timeout=60) for future in busy] == [1, 1]
+    # the cancelled task is never sent to a worker
+    assert pool.run("square", 5) == 25
+    assert pool.status()["done"] == 3 and pool.status()["queued"] == 0
+
+
+def test_cpu_sets():
+    assert parse_cpus("0-3,6") == [0, 1, 2, 3, 6]
+    assert split_cpus([5, 0, 1, 2, 3, 4, 6], 3) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert split_cpus([0], 2) == [None, None]
@@ -1,183 +1,252 @@
 import json
+import random
 import string
 import numpy as np
-import music21 as m21
-import tensorflow as tf
-from copy import deepcopy
 from fractions import Fraction
-from random import choice,randint
-from app.backend.models import Encoder, Decoder
-
-#tf.compat.v1.disable_eager_execution()
+from random import Random, choice
+from app.backend.artifacts import atomic_write
+from app.backend.midi import leadsheet_midi
+from app.backend.musicxml import leadsheet_xml
+from app.backend.chords import default_chord_table
+from app.backend.vocab import as_vocabularies
+from app.backend.templates import as_template_index
+from app.backend.sampling import sample_batch
+from app.backend.numpy_transformer import NumpyTransformer
+from app.backend.decoding import DEC_SEQ_LENGTH, SLOTS, DecoderGrammar, IncrementalValidator, Candidate, \
+  TransformerStepper, LSTMStepper, run_group, run_group_sampled, abort_stats, token_value
+
+# TensorFlow (in the graph mode of models.py) is only imported where Keras
+# models are built, so that the NumPy Transformer generates without it
 
 def generate_leadsheet(temperature, timesig, numOfBars, valence, density, model,
-                       TransEncoders, val_templates, dense_templates):
+                       TransEncoders, val_templates, dense_templates, nnModel=None, constrained=True,
+                       num_candidates=1, return_all=False, scheduler=None, seed=None, backend='keras',
+                       top_k=None, top_p=None):
   '''0. Set Global Variables for the Generation'''
+  # with a seed every random choice comes from generators of this request, so the
+  # lead sheet only depends on the parameters, the seed and the model
+  rng, template_rng = None, random
+  if seed is not None:
+    rng, template_rng = np.random.default_rng(seed), Random(seed)
+    scheduler = None  # the rows of other requests would change the batch shapes
   # for event based representation get Encoder-Decoder vocab
-  enc_vocab = len(TransEncoders[0].categories_[0])
-  dec_vocab = len(TransEncoders[1].categories_[0])
+  TransEncoders = as_vocabularies(TransEncoders)
+  enc_vocab = len(TransEncoders[0])
+  dec_vocab = len(TransEncoders[1])
 
   LSTM_dim = 768  # the size of units of the implemented LSTM layers
   '''1. Create the Encoder Sequence'''
 
   enc_list = create_encoder_ev(TransEncoders, timesig, numOfBars, val_templates, dense_templates,
-                               valence, density)
-
-  '''2. Load the Inference Model'''
-  if model == 'transformer':
-    nnModel = chord_trans_ev_model(enc_vocab, dec_vocab)
-  else:  # Lstm
-    # load model weights and create inference
-    model_seq = tf.keras.models.load_model('app/aux_files/ChordDurMel_LSTM.h5')
-    nnModel = chords_inf_model_ev(model_seq, LSTM_dim)  # 2 Models
+                               valence, density, template_rng)
+
+  '''2. Load the Inference Model (unless a resident one is given, already on its backend)'''
+  if nnModel is None:
+    if model == 'transformer' and backend == 'numpy':
+      nnModel = (NumpyTransformer.from_file('app/aux_files/ChordDurMel_Trans_w.h5'), None)
+    elif model == 'transformer':
+      nnModel = chord_trans_ev_inf_model(chord_trans_ev_model(enc_vocab, dec_vocab))  # 2 Models
+    else:  # Lstm
+      # load model weights and create inference
+      from app.backend.models import tf
+      model_seq = tf.keras.models.load_model('app/aux_files/ChordDurMel_LSTM.h5')
+      nnModel = chords_inf_model_ev(model_seq, LSTM_dim)  # 2 Models
+      if backend == 'keras':
+        # and the in-graph sampling loop for the unconstrained generations
+        nnModel += (chords_sampler_ev(nnModel[1], TransEncoders[1].id('eos'), DEC_SEQ_LENGTH + 1),)
+    if backend.startswith('tflite'):
+      # run the inference models on TFLite (XNNPACK), with int8 weights for tflite_int8
+      from app.backend.lite import lite_inference_models
+      nnModel = lite_inference_models(model, nnModel, quantize=backend == 'tflite_int8')
 
   '''3. Generate the Lead Sheet'''
-  allChords, allDurs, allMels = call_generation(temperature, timesig, numOfBars,
-                                                TransEncoders, model, nnModel, enc_list)
+  generated = call_generation(temperature, timesig, numOfBars, TransEncoders, model, nnModel, enc_list,
+                              constrained, num_candidates, return_all, scheduler, rng, top_k, top_p)
 
-  '''4. Generate the MIDI and musicXML files'''
-  # create static conditions
-  f_chords, f_durs, f_melody, f_bars = create_static_conditions(allChords, allDurs, allMels)
-  # save midi file
-  chords_mel_mid(f_chords, f_durs, f_bars, f_melody, timesig, model)
-  return allChords, allDurs, allMels
+  # the MIDI and musicXML files are rendered once by the caller, see render_leadsheet
+  return generated
 
 
-def call_generation(temperature, timesig, numOfBars, TransEncoders, model, nnModel, enc_list):
+def call_generation(temperature, timesig, numOfBars, TransEncoders, model, nnModel, enc_list,
+                    constrained=True, num_candidates=1, return_all=False, scheduler=None, rng=None,
+                    top_k=None, top_p=None):
   # preparation of data
-  dec_seq_length = 359
+  dec_seq_length = DEC_SEQ_LENGTH
   enc_seq_length = 263
+  TransEncoders = as_vocabularies(TransEncoders)
+  # constrain the sampling so that every sequence is valid on the first attempt
+  grammar = None
+  if constrained:
+    grammar = DecoderGrammar(TransEncoders[1].tokens, timesig, numOfBars, dec_seq_length)
+  # stop an attempt as soon as it cannot pass validation_check anymore
+  validator = IncrementalValidator(TransEncoders[1].tokens, timesig, numOfBars)
 
   # start generation
   if model == 'transformer':
-    allChords, allDurs, allMels = generate_chord_durs_ev_trans(nnModel, enc_list,
-                                                               timesig, temperature, numOfBars, TransEncoders,
-                                                               enc_seq_length,
-                                                               dec_seq_length)
+    generated = generate_chord_durs_ev_trans(nnModel[0], nnModel[1], enc_list,
+                                             timesig, temperature, numOfBars, TransEncoders,
+                                             enc_seq_length, dec_seq_length, grammar, validator,
+                                             num_candidates, return_all, scheduler, rng,
+                                             nnModel[2] if len(nnModel) > 2 else None, top_k, top_p)
   else:  # LSTM
-    allChords, allDurs, allMels = generate_chordur_ev_seq(nnModel[0], nnModel[1],
-                                                          enc_list, timesig, temperature, numOfBars, TransEncoders,
-                                                          enc_seq_length, dec_seq_length)
+    generated = generate_chordur_ev_seq(nnModel[0], nnModel[1],
+                                        enc_list, timesig, temperature, numOfBars, TransEncoders,
+                                        enc_seq_length, dec_seq_length, grammar, validator,
+                                        num_candidates, return_all, scheduler, rng,
+                                        nnModel[2] if len(nnModel) > 2 else None, top_k, top_p)
 
-  return allChords, allDurs, allMels
+  return generated
 
 
 def generate_chordur_ev_seq(nnEncoder, nnDecoder, enc_list, timesig, temperature,
-                            numOfBars, TransEncoders, enc_seq_length, dec_seq_length):
+                            numOfBars, TransEncoders, enc_seq_length, dec_seq_length, grammar=None,
+                            validator=None, num_candidates=1, return_all=False, scheduler=None,
+                            rng=None, nnSampler=None, top_k=None, top_p=None):
   # Encode the input as state vectors.
-
-  dec_sos_idx = int(np.where(TransEncoders[1].categories_[0] == 'sos')[0]) + 1  # shifted by 1
-  dec_eos_idx = int(np.where(TransEncoders[1].categories_[0] == 'eos')[0])
+  dec_vocab = as_vocabularies(TransEncoders)[1]
+  dec_sos_idx = dec_vocab.shifted('sos')  # shifted by 1
+  dec_eos_idx = dec_vocab.id('eos')
 
   pad_length = enc_seq_length - len(enc_list)
   enc_inp = np.array(enc_list + pad_length * [0]).reshape(1, -1)
 
-  isValid = False  # variable to check if the decoded out is indeed a) numOfBars bars
-  # and b) the durations of each bar is timesig duration
-  cnt_valid = 1  # counter for the attempts
-  while not isValid:
-    print('Generating...Attempt no:', cnt_valid)
-    # call Encoder first
-    enc1_h, enc1_c, enc2_h, enc2_c, enc3_h, enc3_c = nnEncoder.predict([enc_inp])
-    s1_values = [enc1_h, enc1_c]
-    s2_values = [enc2_h, enc2_c]
-    s3_values = [enc3_h, enc3_c]
-
-    # Prepare empty target sequences of length 1 for the decoder and
-    # put to the target seqs the last item from the encoder/seed
-    cnt = 0
-    dec_inp = np.array(dec_sos_idx).reshape(1, 1)
-
-    decoded_out = []
-
-    # start generating and call Decoder
-    stop_condition = False
-    while not stop_condition:
-      # call the decoder
-      dec_out, dec1_h, dec1_c, dec2_h, dec2_c, dec3_h, dec3_c = nnDecoder.predict(
-        [dec_inp] + s1_values + s2_values + s3_values)
-
-      # sample the predictions with temperature(diversity)
-      dec_pred = sample(dec_out.reshape(dec_out.shape[-1], ), temperature)
-
-      if dec_pred == dec_eos_idx or len(decoded_out) >= dec_seq_length:
-        stop_condition = True
-        # Success
-        cnt = 0
-
-      # add it to the sequences
-      decoded_out.append(dec_pred)
-
-      # prepare for the next cycle
-      cnt += 1
-      dec_inp = np.array(decoded_out[-1] + 1).reshape(1, 1)
-
-      # Update states
-      s1_values = [dec1_h, dec1_c]
-      s2_values = [dec2_h, dec2_c]
-      s3_values = [dec3_h, dec3_c]
-
-    # convert them to tokens
-    allChords, allDurs, allMels = convert_to_ChordDurMels(decoded_out, TransEncoders)
-    # check if it is valid out
-    is_ok = validation_check(allChords, allDurs, allMels, timesig, numOfBars)
-    if is_ok:
-      print('Success!')
-      isValid = True
-    else:
-      print('Failure.')
-      cnt_valid += 1
-
-  return allChords, allDurs, allMels
+  stepper = LSTMStepper(nnEncoder, nnDecoder, enc_inp, dec_sos_idx, nnSampler)
+  # the LSTM loop stops once more than dec_seq_length tokens were decoded
+  return generate_candidates(stepper, temperature, num_candidates, dec_eos_idx, dec_seq_length + 1,
+                             timesig, numOfBars, TransEncoders, dec_seq_length, grammar, validator,
+                             return_all, scheduler, rng, top_k, top_p)
 
 
-def generate_chord_durs_ev_trans(nnModel, enc_list, timesig, temperature, numOfBars,
-                                 TransEncoders, enc_seq_length, dec_seq_length):
-  dec_sos_idx = int(np.where(TransEncoders[1].categories_[0] == 'sos')[0]) + 1  # shifted by 1
-  dec_eos_idx = int(np.where(TransEncoders[1].categories_[0] == 'eos')[0])
+def generate_chord_durs_ev_trans(nnPrefill, nnStep, enc_list, timesig, temperature, numOfBars,
+                                 TransEncoders, enc_seq_length, dec_seq_length, grammar=None,
+                                 validator=None, num_candidates=1, return_all=False, scheduler=None,
+                                 rng=None, buckets=None, top_k=None, top_p=None):
+  dec_vocab = as_vocabularies(TransEncoders)[1]
+  dec_sos_idx = dec_vocab.shifted('sos')  # shifted by 1
+  dec_eos_idx = dec_vocab.id('eos')
 
   pad_length = enc_seq_length - len(enc_list)
   enc_inp = np.array(enc_list + pad_length * [0]).reshape(1, -1)
 
-  dec_inp = [dec_sos_idx]
-  dec_out = []
+  # call the Encoder once. Its cross-attention keys/values and the prediction
+  # after sos are the same for every candidate and attempt
+  if nnStep is None:  # the NumPy engine does both the prefill and the steps
+    stepper = nnPrefill.stepper(enc_inp, dec_sos_idx)
+  else:
+    stepper = TransformerStepper(nnPrefill, nnStep, enc_inp, dec_sos_idx, buckets)
+  return generate_candidates(stepper, temperature, num_candidates, dec_eos_idx, dec_seq_length,
+                             timesig, numOfBars, TransEncoders, dec_seq_length, grammar, validator,
+                             return_all, scheduler, rng, top_k, top_p)
 
-  isValid = False  # variable to check if the decoded out is indeed a) numOfBars bars
-  # and b) the durations of each bar is timesig duration
+
+def generate_candidates(stepper, temperature, num_candidates, dec_eos_idx, max_length, timesig, numOfBars,
+                        TransEncoders, dec_seq_length, grammar=None, validator=None, return_all=False,
+                        scheduler=None, rng=None, top_k=None, top_p=None):
+  '''
+  Best-of-N generation. num_candidates sequences advance together, one batched
+  decoder call per token, each with its own sampling, grammar and validator
+  state, and each finishes on its own (eos, length or early abort). With a
+  scheduler the rows are batched together with the ones of other requests.
+  rng (a np.random.Generator) replaces the global random state for sampling,
+  top_k/top_p truncate the distributions that are sampled.
+  @return: the first valid (allChords, allDurs, allMels) to finish or, with
+           return_all, all the valid ones of the attempt
+  '''
+  valid = []
   cnt_valid = 1  # counter for the attempts
-  while not isValid:
-    print('Generating...Attempt no:', cnt_valid)
-    # start generating
-    for _ in range(dec_seq_length):
-      allPreds = nnModel.predict([enc_inp, np.array(dec_inp).reshape(1, -1)])
-      aPred = allPreds[-1]
-      # apply diversity
-      token_pred = sample(aPred[-1, :].reshape(aPred.shape[-1], ), temperature)
-      dec_out.append(token_pred)
-      if token_pred == dec_eos_idx:
-        # EOS
-        break
-      else:
-        # prepare for the next cycle
-        dec_inp.append(token_pred + 1)
-    # convert them to tokens
-    allChords, allDurs, allMels = convert_to_ChordDurMels(dec_out, TransEncoders)
-    # check if it is valid out
-    is_ok = validation_check(allChords, allDurs, allMels, timesig, numOfBars)
-    if is_ok:
+  while not valid:
+    print('Generating...Attempt no:', cnt_valid, '(' + str(num_candidates) + ' candidates)')
+    group = CandidateGroup(temperature, num_candidates, dec_eos_idx, max_length, timesig, numOfBars,
+                           TransEncoders, dec_seq_length, grammar, validator, return_all, rng, top_k, top_p)
+    if top_k is None and top_p is None and getattr(stepper, 'nnSampler', None) is not None:
+      # not truncated, all the tokens are sampled (and masked by the grammar) in the graph
+      run_group_sampled(stepper, group)
+    elif scheduler is not None:
+      scheduler.run(stepper, group)
+    else:
+      run_group(stepper, group)
+    valid = group.valid
+    if valid:
       print('Success!')
-      isValid = True
     else:
       print('Failure.')
       cnt_valid += 1
-      dec_inp = [dec_sos_idx]
-      dec_out = []
-
-    x = allChords
-    y = allDurs
-    z = allMels
 
-  return allChords, allDurs, allMels
+  return valid if return_all else valid[0]
+
+
+class CandidateGroup:
+  '''The candidates of one attempt, sampled row by row from the batched predictions'''
+
+  def __init__(self, temperature, num_candidates, dec_eos_idx, max_length, timesig, numOfBars,
+               TransEncoders, dec_seq_length, grammar=None, validator=None, return_all=False, rng=None,
+               top_k=None, top_p=None):
+    self.temperature = temperature
+    self.top_k = top_k
+    self.top_p = top_p
+    self.grammar = grammar
+    self.num_candidates = num_candidates
+    self.timesig = timesig
+    self.numOfBars = numOfBars
+    self.TransEncoders = TransEncoders
+    self.dec_seq_length = dec_seq_length
+    self.return_all = return_all
+    self.rng = rng
+    self.candidates = [Candidate(dec_eos_idx, max_length, grammar, validator) for _ in range(num_candidates)]
+    self.active = list(range(num_candidates))
+    self.valid = []
+    self.finished = False
+
+  def push(self, preds):
+    '''
+    @param preds: (len(self.active), vocab) the predictions of the active rows
+    @return: the rows that continue
+    '''
+    # sample the predictions with temperature(diversity), all the rows at once
+    mask = None
+    if self.grammar is not None:
+      mask = np.stack([self.candidates[c].mask() for c in self.active])
+    tokens = sample_batch(preds, self.temperature, mask, self.top_k, self.top_p, self.rng)
+    for c, token in zip(self.active, tokens):
+      self.candidates[c].push(int(token))
+    return self._collect()
+
+  def push_sequences(self, sequences):
+    '''
+    @param sequences: all the sampled tokens of each active row
+    @return: the rows that continue (none, every row is done)
+    '''
+    for c, tokens in zip(self.active, sequences):
+      cand = self.candidates[c]
+      for token in tokens:
+        cand.push(int(token))
+        if cand.done:
+          break
+      cand.done = True  # cut at the max_length of the sampling loop
+    return self._collect()
+
+  def _collect(self):
+    keep = []
+    for row, c in enumerate(self.active):
+      cand = self.candidates[c]
+      if not cand.done:
+        keep.append(row)
+        continue
+      abort_stats.record(len(cand.tokens), self.dec_seq_length, cand.aborted)
+      if cand.aborted:
+        continue
+      # convert them to tokens and check if it is valid out
+      allChords, allDurs, allMels = convert_to_ChordDurMels(cand.tokens, self.TransEncoders)
+      if validation_check(allChords, allDurs, allMels, self.timesig, self.numOfBars):
+        self.valid.append((allChords, allDurs, allMels))
+
+    # prepare for the next cycle with the unfinished candidates only
+    self.active = [self.active[row] for row in keep]
+    self.finished = bool(self.valid and not self.return_all) or not self.active
+    return keep
+
+  def last_tokens(self):
+    return [self.candidates[c].tokens[-1] for c in self.active]
 
 
 def validation_check(allChords, allDurs, allMels, timesig, numOfBars):
@@ -197,13 +266,14 @@ def validation_check(allChords, allDurs, allMels, timesig, numOfBars):
 
   # 3. Check of there is problem with duration of each bar according to the timesig
   timesig = json.loads(timesig)
-  bar_lgt = 4 * int(timesig[0]) / int(timesig[1])
+  bar_lgt = Fraction(4 * int(timesig[0]), int(timesig[1]))
   total_dur = numOfBars * bar_lgt
   bar_idxs_d = {i for i, x in enumerate(allDurs) if x == "bar"}
   f_durs = [v for i, v in enumerate(allDurs) if i not in bar_idxs_d]
-  f_durs_float = string_durs_to_float(f_durs)
-  f_durs_cnt = sum(f_durs_float)
-  if total_dur != f_durs_cnt:
+  # summed exactly, a float sum of triplet durations ('1/3') misses the bar length
+  # a token that is not a duration (in a duration slot) fails the check
+  f_durs = [token_value(str(d)) for d in f_durs]
+  if None in f_durs or total_dur != sum(f_durs):
     return isValid
   # check completed
   isValid = True
@@ -213,6 +283,7 @@ def validation_check(allChords, allDurs, allMels, timesig, numOfBars):
 
 def chords_inf_model_ev(model_tr, LSTM_dim):
   '''Inference Model for event_based Enc-Dec'''
+  from app.backend.models import tf
   # Encoder
   enc_inputs = model_tr.get_layer('input_var1').input
 
@@ -277,7 +348,26 @@ def chords_inf_model_ev(model_tr, LSTM_dim):
   return encoder_model, decoder_model
 
 
-def chord_trans_ev_model(enc_vocab, dec_vocab):
+def chords_sampler_ev(decoder_model, dec_eos_idx, max_length):
+  '''The decoding loop of the LSTM decoder model in one Model, see LSTMSampling'''
+  from app.backend.models import tf, LSTMSampling
+  vocab_size = int(decoder_model.outputs[0].shape[-1])
+  sos_input = tf.keras.layers.Input(shape=(1,))
+  state_inputs = [tf.keras.layers.Input(shape=tuple(state.shape[1:])) for state in decoder_model.inputs[1:]]
+  temperature_input = tf.keras.layers.Input(shape=(1,))
+  seed_input = tf.keras.layers.Input(shape=(2,), dtype='int32')
+  # the grammar tables, see grammar_tables
+  grammar_inputs = [tf.keras.layers.Input(shape=(len(SLOTS), vocab_size)),
+                    tf.keras.layers.Input(shape=(None, vocab_size), dtype='int32'),
+                    tf.keras.layers.Input(shape=(None,), dtype='int32'),
+                    tf.keras.layers.Input(shape=(6,), dtype='int32')]
+  inputs = [sos_input] + state_inputs + [temperature_input, seed_input] + grammar_inputs
+  return tf.keras.models.Model(inputs, LSTMSampling(decoder_model, dec_eos_idx, max_length)(inputs))
+
+
+def chord_trans_ev_model(enc_vocab, dec_vocab, weights='app/aux_files/ChordDurMel_Trans_w.h5'):
+  from app.backend.models import tf, Encoder, Decoder
+
   # create the architecture first
 
   num_layers = 4  # 4
@@ -303,82 +393,89 @@ def chord_trans_ev_model(enc_vocab, dec_vocab):
   model = tf.keras.models.Model(inputs=[enc_input, dec_input], outputs=out)
 
   # load the weights
-  model.load_weights('app/aux_files/ChordDurMel_Trans_w.h5')
+  if weights is not None:
+    model.load_weights(weights)
 
   return model
 
 
-def sample(preds, temperature=1.0):
+def chord_trans_ev_inf_model(model_tr):
+  '''Incremental inference models for the event based Transformer'''
+  from app.backend.models import tf, Encoder, Decoder, TransformerPrefill, TransformerStep
+
+  encoder = [layer for layer in model_tr.layers if isinstance(layer, Encoder)][0]
+  decoder = [layer for layer in model_tr.layers if isinstance(layer, Decoder)][0]
+  dec_output = model_tr.get_layer('out_var1')
+
+  enc_inputs = model_tr.get_layer('input_var1').input
+  dec_inputs = model_tr.get_layer('input_var2').input
+
+  # Prefill: Encoder and the first (sos) token
+  prefill_outputs = TransformerPrefill(encoder, decoder, dec_output)([enc_inputs, dec_inputs])
+  prefill_model = tf.keras.models.Model([enc_inputs, dec_inputs], prefill_outputs)
+
+  # Step: the newest token against the self-attention cache and the cross-attention keys/values
+  heads = decoder.decoder_layers[0].multi_head_attention1
+  token_input = tf.keras.layers.Input(shape=(1,))
+  position_input = tf.keras.layers.Input(shape=(1,), dtype='int32')
+  past_input = tf.keras.layers.Input(shape=(None,))  # zero where the cache is padded
+  cache_inputs = [tf.keras.layers.Input(shape=(heads.num_heads, None, heads.depth))
+                  for _ in range(4 * len(decoder.decoder_layers))]  # (key, value) x (self, cross) per layer
+  step_inputs = [token_input, position_input, enc_inputs, past_input] + cache_inputs
+  step_outputs = TransformerStep(encoder, decoder, dec_output)(step_inputs)
+  step_model = tf.keras.models.Model(step_inputs, step_outputs)
+
+  return prefill_model, step_model
+
+
+def sample(preds, temperature=1.0, mask=None, rng=None):
   '''
   @param preds: a np.array with the probabilities to all categories
   @param temperature: the temperature. Below 1.0 the network makes more "safe"
                       predictions
+  @param mask: optional boolean np.array, only the allowed categories are sampled
+  @param rng: optional np.random.Generator to draw from instead of np.random
   @return: the index after the sampling
   '''
-  # helper function to sample an index from a probability array
-  preds = np.asarray(preds).astype('float64')
-  preds = np.log(preds) / temperature
-  exp_preds = np.exp(preds)
-  preds = exp_preds / np.sum(exp_preds)
-  probas = np.random.multinomial(1, preds, 1)
-
-  return np.argmax(probas)
+  # a batch of one row, see sampling.sample_batch
+  return int(sample_batch(np.asarray(preds)[np.newaxis], temperature,
+                          None if mask is None else np.asarray(mask)[np.newaxis], rng=rng)[0])
 
 
-def create_encoder_ev(TransEncoders, timesig, numOfBars, val_templates, dense_templates, valence, density):
+def create_encoder_ev(TransEncoders, timesig, numOfBars, val_templates, dense_templates, valence, density,
+                      rng=random):
   # create the encoder part. First define idxs
-  enc_sos_idx = int(np.where(TransEncoders[0].categories_[0] == 'sos')[0]) + 1  # all shifted
-  enc_eos_idx = int(np.where(TransEncoders[0].categories_[0] == 'eos')[0]) + 1
-  enc_bar_idx = int(np.where(TransEncoders[0].categories_[0] == 'bar')[0]) + 1
-  enc_timesig_idx = int(np.where(TransEncoders[0].categories_[0] == timesig)[0]) + 1
+  enc_vocab = as_vocabularies(TransEncoders)[0]
+  enc_sos_idx = enc_vocab.shifted('sos')  # all shifted
+  enc_eos_idx = enc_vocab.shifted('eos')
+  enc_bar_idx = enc_vocab.shifted('bar')
+  enc_timesig_idx = enc_vocab.shifted(timesig)
 
   # select a random valence and density template
   # select a template from >= numOfbars with the suggested average from the user
-  stop_condition = False
-  while not stop_condition:
-    try:
-      # set a random length to get a template
-      lgt_r = str(randint(numOfBars, 40))
-      # check if the valence avg exists as an option
-      enc_val = deepcopy(choice(list(val_templates[lgt_r][valence])))
-      enc_val = enc_val[:numOfBars]
-
-    except:
-      continue
-    stop_condition = True
+  enc_val = as_template_index(val_templates, 'valence').sample(valence, numOfBars, rng)
   # do the same for density
-  stop_condition = False
-  while not stop_condition:
-    try:
-      # set a random length to get a template
-      lgt_r = str(randint(numOfBars, 40))
-      # check if the valence avg exists as an option
-      enc_den = deepcopy(choice(list(dense_templates[lgt_r][density])))
-      enc_den = enc_den[:numOfBars]
-
-    except:
-      continue
-    stop_condition = True
+  enc_den = as_template_index(dense_templates, 'density').sample(density, numOfBars, rng)
 
   enc_list = [enc_sos_idx, enc_bar_idx]
   for i in range(0, numOfBars):
     # check for Grouing
     if i == 0:
-      curr_group_idx = int(np.where(TransEncoders[0].categories_[0] == 'start1')[0]) + 1
+      curr_group_idx = enc_vocab.shifted('start1')
     elif i == 1:
-      curr_group_idx = int(np.where(TransEncoders[0].categories_[0] == 'start2')[0]) + 1
+      curr_group_idx = enc_vocab.shifted('start2')
     elif i == numOfBars - 2:
-      curr_group_idx = int(np.where(TransEncoders[0].categories_[0] == 'end1')[0]) + 1
+      curr_group_idx = enc_vocab.shifted('end1')
     elif i == numOfBars - 1:
-      curr_group_idx = int(np.where(TransEncoders[0].categories_[0] == 'end2')[0]) + 1
+      curr_group_idx = enc_vocab.shifted('end2')
     else:
-      curr_group_idx = int(np.where(TransEncoders[0].categories_[0] == '-')[0]) + 1
+      curr_group_idx = enc_vocab.shifted('-')
     # get the Valence Idx for this current bar
     aVal = str(enc_val[i])
-    curr_val_idx = int(np.where(TransEncoders[0].categories_[0] == aVal)[0]) + 1
+    curr_val_idx = enc_vocab.shifted(aVal)
     # get the Density Idx for this current bar
     aDen = str(enc_den[i])
-    curr_den_idx = int(np.where(TransEncoders[0].categories_[0] == aDen)[0]) + 1
+    curr_den_idx = enc_vocab.shifted(aDen)
     # apply with that order TimeSig,Grouping,Valence and bar
     enc_list.extend([enc_timesig_idx, curr_group_idx, curr_val_idx, curr_den_idx, enc_bar_idx])
 
@@ -388,7 +485,8 @@ def create_encoder_ev(TransEncoders, timesig, numOfBars, val_templates, dense_te
 
 
 def convert_to_ChordDurMels(dec_out, TransEncoders):
-  dec_bar_idx = int(np.where(TransEncoders[1].categories_[0] == 'bar')[0])
+  dec_vocab = as_vocabularies(TransEncoders)[1]
+  dec_bar_idx = dec_vocab.id('bar')
 
   bar_idxs = [i for i, x in enumerate(dec_out) if x == dec_bar_idx]
 
@@ -404,18 +502,18 @@ def convert_to_ChordDurMels(dec_out, TransEncoders):
     # first for chords
     for c in range(leftR, rigtR, 3):
       aChord_idx = dec_out[c]
-      aChord = str(TransEncoders[1].categories_[0][aChord_idx])
+      aChord = dec_vocab.tokens[aChord_idx]
       allChords.append(aChord)
 
     for m in range(leftR + 1, rigtR, 3):
       aMel_idx = dec_out[m]
-      aMel = str(TransEncoders[1].categories_[0][aMel_idx])
+      aMel = dec_vocab.tokens[aMel_idx]
       allMels.append(aMel)
 
     # then for durs
     for d in range(leftR + 2, rigtR, 3):
       aDur_idx = dec_out[d]
-      aDur = str(TransEncoders[1].categories_[0][aDur_idx])
+      aDur = dec_vocab.tokens[aDur_idx]
       allDurs.append(aDur)
 
     # add bar events
@@ -463,134 +561,50 @@ def string_durs_to_float(bar_durs):
   return float_durs
 
 
-def chords_mel_mid(f_chords, f_durs, f_bars, allMelody, timesig, prefix):
-  # path for generations
-  midi_out = 'app/generations/mid/'
-  xml_out = 'app/generations/xml/'
-
-  # create the m21 instance for MIDI
-  rc = m21.stream.Stream()
-  # set tonality and tempo (default 120 tempo or set it to tempo21)
-  kf = m21.key.Key('C', 'major')
-  tempo21 = m21.tempo.MetronomeMark(number=100)
-  rc.append(kf)
-  rc.append(tempo21)
-  # create m21 instance for XML
-  rx = m21.stream.Stream()
-  rx.append(m21.text.TextBox(prefix + ' generation'))
-  # calculate all bars according to f_bars
-  all_bars = [index for index, value in enumerate(f_bars) if value == 'bar']
-  # add the last idx which is the len of the events
-  all_bars.append(len(f_bars))
-  melody = m21.stream.Part()
-  fl = m21.instrument.Flute()
-  melody.insert(0, fl)
-  chords = m21.stream.Part()
-  pp = m21.instrument.Piano()
-  chords.insert(0, pp)
-  melodyxml = m21.stream.Part()
-  melodyxml.insert(0, fl)
-  # get TimeSig nominator denominator
-  timesig = json.loads(timesig)
-  ts = m21.meter.TimeSignature(str(timesig[0]) + '/' + str(timesig[1]))
-
-  for m in range(0, len(all_bars) - 1):
-    # create measure
-    cho_m = m21.stream.Measure()
-    mel_m = m21.stream.Measure()
-    melxml_m = m21.stream.Measure()
-    if m == 0:
-      clef_s = m21.clef.TrebleClef()
-      clef_b = m21.clef.BassClef()
-      cho_m.insert(0, clef_b)
-      cho_m.insert(0, ts)
-      mel_m.insert(0, clef_s)
-      mel_m.insert(0, ts)
-      melxml_m.insert(0, clef_s)
-      melxml_m.insert(0, ts)
-
-    # for lead sheet only melody track will be given with chord symbols
-    bar_prev = all_bars[m]
-    bar_new = all_bars[m + 1]
-    # get the sum of durations
-    bar_durs = f_durs[bar_prev:bar_new]
-    bar_durs = string_durs_to_float(bar_durs)
-    # get the chord list for this bar
-    bar_chords = f_chords[bar_prev:bar_new]
-    bar_melody = allMelody[bar_prev:bar_new]
-    offset = 0.0
-    prevChord = ''
-    for b in range(0, len(bar_chords)):
-      cho = bar_chords[b]
-      dur = bar_durs[b]
-      mel = bar_melody[b]
-      if cho == 'Rest':
-        aChord_t = m21.note.Rest()
-        aChord_name = 'Rest'
-      else:
-        aChord_s = m21.harmony.ChordSymbol(cho)
-        pitchNames = [p for p in aChord_s.pitches]
-        aChord_t = m21.chord.Chord(pitchNames)
-        aChord_name = aChord_t.pitchedCommonName
-      if prevChord == aChord_name:
-        apC = cho_m.pop(-1)
-        apC.quarterLength += float(dur)
-        cho_m.append(apC)
-      else:
-        aChord_t.offset = offset
-        aChord_t.quarterLength = float(dur)
-        cho_m.append(aChord_t)
-        # append Chord Symbol if it is not rest
-        if aChord_name != 'Rest':
-          aChord_s.offset = offset
-          aChord_s.writeAsChord = False
-          melxml_m.append(aChord_s)  # add the chord symbol to mel track
-        prevChord = aChord_name
-      if mel == 'Rest' or mel == 'eos':  # check if to create a Note or Rest and set offset
-        aNote = m21.note.Rest()
-      else:  # set pitch also
-        pitch = m21.pitch.Pitch()
-        pitch.midi = int(mel)
-        aNote = m21.note.Note()
-        aNote.pitch = pitch
-      # set onset and duration and append it
-      aNote.offset = offset
-      aNote.quarterLength = float(dur)
-      mel_m.append(aNote)
-      melxml_m.append(aNote)
-      offset = dur
-    ############################
-    # append the measures to the parts
-    chords.append(cho_m)
-    melody.append(mel_m)
-    melodyxml.append(melxml_m)
-  # append the parts to the MIDI and XML streams
-  # create end bar lines
-  # chords[-1].append(m21.bar.Barline(type='final'))
-  # melody[-1].append(m21.bar.Barline(type='final'))
-  # MIDI
-  rc.append(melody)
-  rc.append(chords)
-  # XML
-  rx.append(melodyxml)
-  rx.append(chords)
-  # get random string seed
-  rstr = randomString(5)
+class RenderResult:
+  '''The rendered MIDI and musicXML bytes of a generation'''
+
+  def __init__(self, midi=None, xml=None):
+    self.midi = midi
+    self.xml = xml
+
+
+def chords_mel_mid(f_chords, f_durs, f_bars, allMelody, timesig, prefix, midiOut=None, xmlOut=None,
+                   formats=('midi', 'xml'), chords=None):
+  '''
+  Renders the requested formats ('midi', 'xml') of the lead sheet in memory and
+  returns a RenderResult. The files are also written to midiOut/xmlOut when
+  they are given. Both are written directly (leadsheet_midi, leadsheet_xml),
+  without music21 streams. chords is the ChordTable of the vocabulary, the
+  chord tokens are not parsed again.
+  '''
+  chord_table = default_chord_table if chords is None else chords
+  result = RenderResult()
   # first MIDI
-  mf = m21.midi.translate.streamToMidiFile(rc)
-  midiOut = midi_out + 'music.mid'
-  mf.open(midiOut, 'wb')
-  mf.write()
-  mf.close()
-  print(midiOut, ' has been generated!')
+  if 'midi' in formats:
+    result.midi = leadsheet_midi(f_chords, f_durs, f_bars, allMelody, timesig, chord_table)
+    if midiOut is not None:
+      # written atomically so that readers never see a partial file
+      atomic_write(midiOut, result.midi)
+      print(midiOut, ' has been generated!')
+  if 'xml' not in formats:
+    return result
+
   # then musicXML
-  mx = m21.musicxml.m21ToXml.GeneralObjectExporter(rx)
-  xmlOut = xml_out + 'sheet.xml'
-  mxText = mx.parse().decode('utf-8')
-  f = open(xmlOut, 'w')
-  f.write(mxText.strip())
-  f.close()
-  print(xmlOut, ' has been generated!')
+  result.xml = leadsheet_xml(f_chords, f_durs, f_bars, allMelody, timesig, prefix + ' generation', chord_table)
+  if xmlOut is not None:
+    atomic_write(xmlOut, result.xml)
+    print(xmlOut, ' has been generated!')
+
+  return result
+
+
+def render_leadsheet(allChords, allDurs, allMels, timesig, prefix, formats=('midi', 'xml'), chords=None):
+  '''The single rendering stage of a generation, only the requested formats are rendered'''
+  if not formats:
+    return RenderResult()
+  f_chords, f_durs, f_melody, f_bars = create_static_conditions(allChords, allDurs, allMels)
+  return chords_mel_mid(f_chords, f_durs, f_bars, f_melody, timesig, prefix, formats=formats, chords=chords)
 
 
 def randomString(stringLength=10):
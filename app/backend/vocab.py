@@ -0,0 +1,49 @@
+SPECIAL_TOKENS = ('sos', 'eos', 'bar')
+
+
+class Vocabulary:
+  '''
+  Token <-> id maps of one fitted OneHotEncoder (its categories_[0]), built
+  once instead of scanning the categories for every lookup. Ids are the
+  category positions; the model inputs use them shifted by 1 (0 is padding),
+  see shifted. The ids of sos, eos and bar are kept as attributes (None when
+  the vocabulary has no such token).
+  '''
+
+  def __init__(self, categories, name='vocabulary'):
+    self.name = name
+    self.tokens = tuple(str(t) for t in categories)
+    self.index = {}
+    for i, token in enumerate(self.tokens):
+      self.index.setdefault(token, i)
+    for token in SPECIAL_TOKENS:
+      setattr(self, token, self.index.get(token))
+
+  def __len__(self):
+    return len(self.tokens)
+
+  def __contains__(self, token):
+    return str(token) in self.index
+
+  def id(self, token):
+    try:
+      return self.index[str(token)]
+    except KeyError:
+      raise ValueError(f"'{token}' is not a token of the {self.name}") from None
+
+  def shifted(self, token):
+    '''The model input id of a token (category position + 1)'''
+    return self.id(token) + 1
+
+  def token(self, idx):
+    return self.tokens[idx]
+
+
+def as_vocabularies(TransEncoders):
+  '''
+  (encoder, decoder) Vocabulary of the pickled TransEncoders. Vocabularies
+  (and missing encoders) are passed through, so the call sites accept either.
+  '''
+  names = ('encoder vocabulary', 'decoder vocabulary')
+  return tuple(enc if enc is None or isinstance(enc, Vocabulary) else Vocabulary(enc.categories_[0], name)
+               for enc, name in zip(TransEncoders, names))
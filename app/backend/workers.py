@@ -0,0 +1,314 @@
+import os
+import pickle
+import importlib
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.connection import wait
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+
+# a worker process only generates: no nested workers, warm pool or result cache
+WORKER_ENV = {'SITHSYNTH_WORKERS': '0', 'SITHSYNTH_POOL_DEPTH': '0', 'SITHSYNTH_CACHE_MAX_MB': '0'}
+# the thread pools of TensorFlow (see registry.configure_threads) and of the BLAS behind NumPy
+THREAD_ENV = ('SITHSYNTH_INTRA_OP_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS')
+
+
+class WorkerError(Exception):
+  '''A worker exited, or failed with an exception that does not pickle'''
+
+
+def parse_cpus(spec):
+  '''"0-3,6" -> [0, 1, 2, 3, 6]'''
+  cpus = []
+  for part in spec.split(','):
+    if '-' in part:
+      first, last = part.split('-')
+      cpus.extend(range(int(first), int(last) + 1))
+    elif part.strip():
+      cpus.append(int(part))
+  return cpus
+
+
+def split_cpus(cpus, workers):
+  '''The cpus in workers contiguous sets of (almost) the same size, or None per worker when too few'''
+  cpus = sorted(cpus)
+  if len(cpus) < workers:
+    return [None] * workers
+  size, extra = divmod(len(cpus), workers)
+  sets, start = [], 0
+  for index in range(workers):
+    end = start + size + (index < extra)
+    sets.append(cpus[start:end])
+    start = end
+  return sets
+
+
+def resolve(spec):
+  '''"package.module:function" -> the function'''
+  module, name = spec.split(':')
+  return getattr(importlib.import_module(module), name)
+
+
+def serve(index, cpus, intra_op, inter_op, work, setup, conn):
+  '''
+  The loop of a worker process: pinned to cpus, runs work(*args) for every
+  task the pool sends over conn, its own pipe, and sends back the result.
+  '''
+  os.environ.update(WORKER_ENV)
+  if intra_op:
+    os.environ.update({name: str(intra_op) for name in THREAD_ENV})
+  if inter_op:
+    os.environ['SITHSYNTH_INTER_OP_THREADS'] = str(inter_op)
+  if cpus:
+    os.sched_setaffinity(0, cpus)
+  if setup is not None:
+    resolve(setup)()  # the models are loaded before the first task
+  work = resolve(work)
+  conn.send(('ready', os.getpid()))
+  while True:
+    try:
+      task = conn.recv()
+    except EOFError:
+      return  # the pool is gone
+    if task is None:
+      return
+    task_id, args = task
+    try:
+      conn.send(('done', task_id, work(*args)))
+    except Exception as e:
+      try:
+        pickle.dumps(e)
+      except Exception:
+        e = WorkerError(f'{type(e).__name__}: {e}')
+      conn.send(('failed', task_id, e))
+
+
+class WorkerPool:
+  '''
+  Generation in worker processes, each with its own resident models and so
+  its own TensorFlow session. submit returns a Future of work(*args). The
+  pool queues the tasks and sends each one to an idle worker over the
+  worker's own pipe, so it knows which task every worker holds. Every worker
+  is pinned to its cpu set (os.sched_setaffinity) with intra_op/inter_op
+  threads. A supervisor thread waits on the pipes and the processes and
+  restarts a worker that exits (after restart_delay, on a timer), failing
+  the task it held. work and setup
+  are "module:function" names, imported in the workers (which are spawned,
+  not forked). run waits at most timeout seconds for a result.
+  '''
+
+  def __init__(self, work, workers=2, cpu_sets=None, intra_op=None, inter_op=1, setup=None,
+               restart_delay=1.0, timeout=300.0):
+    self.work = work
+    self.setup = setup
+    self.workers = workers
+    self.cpu_sets = cpu_sets or [None] * workers
+    self.intra_op = intra_op
+    self.inter_op = inter_op
+    self.restart_delay = restart_delay
+    self.timeout = timeout
+    self._context = multiprocessing.get_context('spawn')
+    self.processes = [None] * workers
+    self.pipes = [None] * workers
+    self.pids = [None] * workers
+    self.ready = [False] * workers
+    self.holding = [None] * workers  # the task id each worker is running
+    self.queued = deque()  # task ids not sent yet
+    self.tasks = {}  # task id: (Future, args)
+    self._next_id = 0
+    self._closed = False
+    self._supervisor = None
+    self._lock = threading.Lock()
+    # stats
+    self.done = 0
+    self.failed = 0
+    self.restarts = 0
+
+  def _spawn(self, index):
+    cpus = self.cpu_sets[index]
+    intra_op = self.intra_op or (len(cpus) if cpus else None)
+    conn, child = self._context.Pipe()
+    process = self._context.Process(
+      target=serve, name=f'generation-worker-{index}', daemon=True,
+      args=(index, cpus, intra_op, self.inter_op, self.work, self.setup, child))
+    process.start()
+    child.close()
+    with self._lock:
+      self.processes[index] = process
+      self.pipes[index] = conn
+      self.ready[index] = False
+      self.holding[index] = None
+
+  def start(self):
+    for index in range(self.workers):
+      self._spawn(index)
+    self._supervisor = threading.Thread(target=self._supervise, name='worker-supervisor', daemon=True)
+    self._supervisor.start()
+    return self
+
+  def submit(self, *args):
+    future = Future()
+    with self._lock:
+      task_id = self._next_id
+      self._next_id += 1
+      self.tasks[task_id] = (future, args)
+      self.queued.append(task_id)
+      sends = self._dispatch()
+    self._send(sends)
+    return future
+
+  def run(self, *args):
+    '''work(*args) in a worker, a TimeoutError after timeout seconds (the task is dropped if still queued)'''
+    future = self.submit(*args)
+    try:
+      return future.result(timeout=self.timeout)
+    except FutureTimeout:
+      future.cancel()
+      raise TimeoutError(f'no worker result within {self.timeout:g} s') from None
+
+  def _dispatch(self):
+    # with the lock held: assigns the queued tasks to the idle workers, and
+    # returns the messages to send them once the lock is released
+    sends = []
+    for index in range(self.workers):
+      while self.ready[index] and self.holding[index] is None and self.queued:
+        task_id = self.queued.popleft()
+        future, args = self.tasks[task_id]
+        if not future.set_running_or_notify_cancel():
+          del self.tasks[task_id]
+          continue
+        self.holding[index] = task_id
+        sends.append((self.pipes[index], (task_id, args)))
+    return sends
+
+  def _send(self, sends):
+    for pipe, task in sends:
+      try:
+        pipe.send(task)
+      except (OSError, ValueError):
+        pass  # an exited worker, its task fails when it is restarted
+
+  def _supervise(self):
+    while not self._closed:
+      with self._lock:
+        # the workers waiting to be respawned have no pipe
+        live = [index for index in range(self.workers) if self.pipes[index] is not None]
+        sentinels = {self.processes[index].sentinel: index for index in live}
+        pipes = {id(self.pipes[index]): index for index in live}
+        handles = [self.pipes[index] for index in live] + list(sentinels)
+      for ready in wait(handles, timeout=0.2):
+        if self._closed:
+          return
+        index = sentinels[ready] if ready in sentinels else pipes[id(ready)]
+        if self.pipes[index] is None or ready not in (self.pipes[index], self.processes[index].sentinel):
+          continue  # a handle of a worker restarted in this round
+        if ready in sentinels or not self._drain(index):
+          self._restart(index)
+
+  def _drain(self, index):
+    '''Handles the messages of worker index, False once its pipe is closed'''
+    pipe = self.pipes[index]
+    try:
+      while pipe.poll():
+        self._handle(index, *pipe.recv())
+    except (EOFError, OSError):
+      return False
+    return True
+
+  def _handle(self, index, kind, *message):
+    with self._lock:
+      if kind == 'ready':
+        self.ready[index] = True
+        self.pids[index] = message[0]
+        sends = self._dispatch()
+      else:
+        task_id, value = message
+        self.holding[index] = None
+        future, _ = self.tasks.pop(task_id)
+        if kind == 'done':
+          self.done += 1
+        else:
+          self.failed += 1
+        sends = self._dispatch()
+    self._send(sends)
+    if kind == 'ready':
+      return
+    if kind == 'done':
+      future.set_result(value)
+    else:
+      future.set_exception(value)
+
+  def _restart(self, index):
+    '''
+    Fails the task of the exited worker index and respawns it after
+    restart_delay, on a timer so the other workers' pipes keep draining.
+    '''
+    process = self.processes[index]
+    self._drain(index)
+    with self._lock:
+      self.pipes[index].close()
+      self.pipes[index] = None
+      self.ready[index] = False
+      task_id, self.holding[index] = self.holding[index], None
+      future = self.tasks.pop(task_id)[0] if task_id is not None else None
+      self.failed += future is not None
+      self.restarts += 1
+    if future is not None:
+      exited = 'exited' if process.exitcode is None else f'exited with code {process.exitcode}'
+      future.set_exception(WorkerError(f'worker {index} {exited}'))
+    timer = threading.Timer(self.restart_delay, self._respawn, (index,))
+    timer.daemon = True
+    timer.start()
+
+  def _respawn(self, index):
+    process = self.processes[index]
+    if process.is_alive():
+      process.kill()  # its pipe closed, it cannot take tasks anymore
+    process.join()
+    if not self._closed:
+      self._spawn(index)
+
+  def close(self, timeout=5.0):
+    self._closed = True
+    with self._lock:
+      for pipe in self.pipes:
+        try:
+          pipe.send(None)
+        except (OSError, ValueError, AttributeError):
+          pass
+    for process in self.processes:
+      if process is not None:
+        process.join(timeout)
+        if process.is_alive():
+          process.terminate()
+
+  def status(self):
+    with self._lock:
+      return {'workers': self.workers, 'ready': sum(self.ready),
+              'cpu_sets': [list(cpus) if cpus else None for cpus in self.cpu_sets],
+              'pids': list(self.pids), 'running': sum(task is not None for task in self.holding),
+              'queued': len(self.queued), 'done': self.done, 'failed': self.failed,
+              'restarts': self.restarts}
+
+
+def workers_from_env(work, setup=None):
+  '''
+  The worker processes, unless SITHSYNTH_WORKERS is 0 (the default).
+  SITHSYNTH_WORKER_CPUS lists a cpu set per worker ("0-1;2-3"), by default
+  the cpus of the process are split evenly between the workers.
+  SITHSYNTH_WORKER_TIMEOUT bounds the wait for a result (seconds).
+  '''
+  workers = int(os.environ.get('SITHSYNTH_WORKERS', 0))
+  if workers <= 0:
+    return None
+  spec = os.environ.get('SITHSYNTH_WORKER_CPUS')
+  if spec:
+    cpu_sets = [parse_cpus(cpus) for cpus in spec.split(';')]
+    if len(cpu_sets) != workers:
+      raise ValueError(f'SITHSYNTH_WORKER_CPUS has {len(cpu_sets)} cpu sets for {workers} workers')
+  else:
+    cpu_sets = split_cpus(os.sched_getaffinity(0), workers)
+  intra_op = int(os.environ.get('SITHSYNTH_INTRA_OP_THREADS', 0)) or None
+  inter_op = int(os.environ.get('SITHSYNTH_INTER_OP_THREADS', 1))
+  return WorkerPool(work, workers, cpu_sets, intra_op, inter_op, setup,
+                    timeout=float(os.environ.get('SITHSYNTH_WORKER_TIMEOUT', 300)))